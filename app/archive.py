@@ -0,0 +1,123 @@
+# archive.py - Archivado en segundo plano de usuarios desactivados hace tiempo
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, List, Optional
+
+from .lease import Lease
+
+
+class UserArchiver:
+    """
+    Mueve a la colección de archivo, en lotes de `batch_size`, los usuarios
+    desactivados hace más de `archive_after`, para que la colección y sus índices
+    contengan solo usuarios vigentes. Entre lotes espera `batch_pause` segundos,
+    lo que acota el ritmo a batch_size / batch_pause usuarios por segundo, y
+    repite la pasada cada `interval` segundos.
+
+    `archive_batch(cutoff, limit)` copia y luego borra un lote de forma
+    idempotente y devuelve los id archivados, por lo que no hace falta guardar
+    un checkpoint: si el proceso se detiene a mitad de un lote, la siguiente
+    pasada lo retoma. `on_archived` recibe cada lote (para invalidar caches).
+
+    Con `lease` solo archiva el worker que lo tiene: lo renueva antes de cada
+    lote y al terminar la pasada lo retiene hasta la siguiente, así que entre
+    todos los workers hay una sola pasada por intervalo y el ritmo no se
+    multiplica por el número de procesos.
+    """
+
+    def __init__(
+        self,
+        archive_batch: Callable[[datetime, int], Awaitable[List[str]]],
+        archive_after: timedelta,
+        batch_size: int = 500,
+        batch_pause: float = 1.0,
+        interval: float = 3600,
+        clock: Callable[[], datetime] = lambda: datetime.now(timezone.utc),
+        on_archived: Optional[Callable[[List[str]], Awaitable[None]]] = None,
+        lease: Optional[Lease] = None
+    ):
+        self._archive_batch = archive_batch
+        self._on_archived = on_archived
+        self._archive_after = archive_after
+        self._batch_size = batch_size
+        self._batch_pause = batch_pause
+        self._interval = interval
+        self._clock = clock
+        self._lease = lease
+        self._task: Optional[asyncio.Task] = None
+        self.runs = 0
+        self.batches = 0
+        self.archived = 0
+        self.errors = 0
+        self.last_run_archived = 0
+        self.skipped_runs = 0
+
+    async def run_once(self) -> int:
+        """Archivar todo lo que cumpla el plazo al inicio de la pasada"""
+        cutoff = self._clock() - self._archive_after
+        archived = 0
+        while True:
+            # Si otro worker tomó el lease (este se demoró más que su vigencia) se deja la pasada
+            if self._lease is not None and not await self._lease.acquire():
+                break
+            user_ids = await self._archive_batch(cutoff, self._batch_size)
+            self.batches += 1
+            archived += len(user_ids)
+            self.archived += len(user_ids)
+            if user_ids and self._on_archived is not None:
+                await self._on_archived(user_ids)
+            if len(user_ids) < self._batch_size:
+                break
+            await asyncio.sleep(self._batch_pause)
+        self.runs += 1
+        self.last_run_archived = archived
+        if archived:
+            logging.info("Usuarios archivados: %s", archived)
+        return archived
+
+    async def _run(self):
+        while True:
+            try:
+                if self._lease is None or await self._lease.acquire():
+                    await self.run_once()
+                    if self._lease is not None:
+                        # Retenerlo hasta la próxima pasada propia (un poco más por si se atrasa)
+                        await self._lease.acquire(self._interval * 1.5)
+                else:
+                    self.skipped_runs += 1
+            except Exception as e:
+                self.errors += 1
+                logging.error("Error al archivar usuarios: %s", e)
+            await asyncio.sleep(self._interval)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Cancelar a mitad de un lote es seguro: el lote se repite en la siguiente pasada
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            if self._lease is not None:
+                # Otro worker lo toma en su próxima pasada sin esperar a que venza
+                try:
+                    await self._lease.release()
+                except Exception as e:
+                    logging.error("No se pudo liberar el lease de archivado: %s", e)
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "runs": self.runs,
+            "batches": self.batches,
+            "archived": self.archived,
+            "last_run_archived": self.last_run_archived,
+            "skipped_runs": self.skipped_runs,
+            "errors": self.errors,
+        }
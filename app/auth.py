@@ -0,0 +1,56 @@
+# auth.py - Cache de tokens JWT ya verificados
+import time
+from typing import Callable, Dict, Optional
+
+
+class VerifiedTokenCache:
+    """
+    Claims de tokens cuya firma, expiración y usuario ya se validaron, para no
+    repetir la verificación ni la lectura del usuario en cada request. Cada
+    usuario tiene un único token vigente (el guardado en su documento), por lo
+    que `invalidate(user_id)` descarta ese token. Las entradas nunca viven más
+    allá del `exp` del token. `cache` es un LRUTTLCache dedicado; el índice de
+    token por usuario se poda cuando el cache descarta el token, por lo que
+    nunca tiene más entradas que el cache.
+    """
+
+    def __init__(self, cache, wall_clock: Callable[[], float] = time.time):
+        self._cache = cache
+        self._cache.on_evict = self._forget
+        self._wall_clock = wall_clock
+        self._token_by_user: Dict[str, str] = {}
+
+    @property
+    def generation(self) -> int:
+        return self._cache.generation
+
+    def get(self, token: str) -> Optional[dict]:
+        return self._cache.get(token)
+
+    def set(self, token: str, claims: dict, generation: Optional[int] = None):
+        remaining = claims["exp"] - self._wall_clock()
+        if remaining <= 0 or (generation is not None and generation != self._cache.generation):
+            return
+        self._cache.set(token, claims, generation, ttl=remaining)
+        self._token_by_user[claims["user_id"]] = token
+
+    def _forget(self, token: str, claims: dict):
+        # El usuario pudo haber cacheado después otro token: solo se quita si es este
+        if self._token_by_user.get(claims["user_id"]) == token:
+            del self._token_by_user[claims["user_id"]]
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """Descartar el token cacheado del usuario, o todos si user_id es None"""
+        if user_id is None:
+            self._token_by_user.clear()
+            self._cache.invalidate()
+            return
+        token = self._token_by_user.pop(user_id, None)
+        if token is None:
+            # Igual se avanza la generación por si hay una verificación en curso
+            self._cache.generation += 1
+            return
+        self._cache.invalidate(token)
+
+    def stats(self) -> dict:
+        return dict(self._cache.stats(), users=len(self._token_by_user))
@@ -0,0 +1,263 @@
+# bloom.py - Filtro de Bloom de correos registrados para evitar consultas de duplicados
+import asyncio
+import hashlib
+import logging
+import math
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, Optional, Tuple
+
+from .lease import Lease
+
+
+def _utcnow() -> datetime:
+    # Sin zona horaria, igual que las fechas leídas desde MongoDB
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class BloomFilter:
+    """
+    Conjunto probabilístico: `in` nunca da falsos negativos y da falsos positivos
+    con probabilidad cercana a `error_rate` mientras no se superen `capacity`
+    elementos. Las k posiciones salen de un solo blake2b partido en dos hashes
+    de 64 bits (h1 + i*h2, Kirsch-Mitzenmacher).
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def add(self, item: str):
+        bits = self._bits
+        for position in self._positions(item):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self._bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    @property
+    def memory_bytes(self) -> int:
+        return len(self._bits)
+
+    def false_positive_rate(self) -> float:
+        """Tasa de falsos positivos esperada con los elementos agregados"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def to_doc(self) -> dict:
+        return {"capacity": self.capacity, "error_rate": self.error_rate, "count": self.count,
+                "bits": bytes(self._bits)}
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> "BloomFilter":
+        bloom = cls(doc["capacity"], doc["error_rate"])
+        bloom._bits = bytearray(doc["bits"])
+        bloom.count = doc["count"]
+        return bloom
+
+
+class MongoFilterSnapshot:
+    """
+    Última versión del filtro publicada en un documento (`_id` = `name`), para
+    que los workers la carguen en lugar de recorrer todos los correos. Un
+    documento de MongoDB admite hasta 16 MB: unos 13M de correos al 1%.
+    """
+
+    def __init__(self, collection, name: str = "emails"):
+        self._collection = collection
+        self._name = name
+
+    async def published(self) -> Optional[dict]:
+        """`version` y `built` de la copia publicada, sin leer los bits"""
+        return await self._collection.find_one({"_id": self._name}, {"version": 1, "built": 1})
+
+    async def load(self) -> Optional[Tuple[BloomFilter, str]]:
+        doc = await self._collection.find_one({"_id": self._name})
+        return None if doc is None else (BloomFilter.from_doc(doc), doc["version"])
+
+    async def save(self, bloom: BloomFilter, version: str):
+        await self._collection.replace_one(
+            {"_id": self._name}, dict(bloom.to_doc(), version=version, built=_utcnow()), upsert=True
+        )
+
+
+class EmailFilter:
+    """
+    Filtro de Bloom de los correos registrados en este proceso. Se construye en
+    segundo plano con un recorrido en streaming de los correos (`load_emails`),
+    los handlers agregan cada correo nuevo y se reconstruye cada
+    `rebuild_interval` segundos para descartar correos que ya no existen y
+    redimensionarlo si creció. Mientras no está construido responde "puede
+    estar" para todo, de modo que nunca se omite una consulta necesaria.
+
+    Con `snapshot` el recorrido lo hace un solo worker: cada `sync_interval`
+    segundos, si la copia publicada tiene más de `rebuild_interval` segundos,
+    el que toma `lease` reconstruye y publica; los demás cargan la copia
+    publicada cuando cambia.
+
+    Solo sirve como atajo: otros workers o réplicas registran correos que este
+    filtro no ve hasta la siguiente reconstrucción, por lo que el índice único
+    sobre email sigue siendo la verificación definitiva.
+    """
+
+    def __init__(
+        self,
+        load_emails: Callable[[], AsyncIterator[str]],
+        capacity: int = 1000000,
+        error_rate: float = 0.01,
+        rebuild_interval: float = 3600,
+        lease: Optional[Lease] = None,
+        snapshot: Optional[MongoFilterSnapshot] = None,
+        sync_interval: float = 60
+    ):
+        self._load_emails = load_emails
+        self._lease = lease or Lease()
+        self._snapshot = snapshot
+        self._sync_interval = sync_interval
+        self._version: Optional[str] = None
+        self._rebuilt_at: Optional[float] = None
+        self._capacity = capacity
+        self._error_rate = error_rate
+        self._rebuild_interval = rebuild_interval
+        self._filter: Optional[BloomFilter] = None
+        self._building: Optional[BloomFilter] = None
+        self._task: Optional[asyncio.Task] = None
+        self.rebuilds = 0
+        self.loads = 0
+        self.checks = 0
+        self.skipped = 0
+        self.possible_hits = 0
+        self.false_positives = 0
+
+    @property
+    def ready(self) -> bool:
+        return self._filter is not None
+
+    def might_contain(self, email: str) -> bool:
+        self.checks += 1
+        if self._filter is None:
+            return True
+        if email in self._filter:
+            self.possible_hits += 1
+            return True
+        self.skipped += 1
+        return False
+
+    def record_false_positives(self, count: int):
+        """Posibles coincidencias que la base confirmó como inexistentes"""
+        if self._filter is not None:
+            self.false_positives += count
+
+    def add(self, email: str):
+        if self._filter is not None:
+            self._filter.add(email)
+        # Los correos registrados durante una reconstrucción también van al filtro nuevo
+        if self._building is not None:
+            self._building.add(email)
+
+    async def rebuild(self):
+        capacity = self._capacity
+        if self._filter is not None:
+            # Margen para crecer hasta la siguiente reconstrucción
+            capacity = max(capacity, self._filter.count * 2)
+        self._building = BloomFilter(capacity, self._error_rate)
+        try:
+            count = 0
+            async for email in self._load_emails():
+                self._building.add(email)
+                count += 1
+                # Ceder el event loop de vez en cuando durante recorridos grandes
+                if count % 10000 == 0:
+                    await asyncio.sleep(0)
+                    # Un recorrido largo no debe perder el lease a mitad de camino
+                    if self._snapshot is not None:
+                        await self._lease.acquire()
+            self._filter = self._building
+        finally:
+            self._building = None
+        self.rebuilds += 1
+        logging.info("Filtro de correos construido con %s correos", count)
+
+    async def sync(self):
+        """Reconstruir y publicar si toca y este worker toma el lease; si no, cargar la copia publicada"""
+        published = await self._snapshot.published()
+        due = published is None or _utcnow() - published["built"] >= timedelta(seconds=self._rebuild_interval)
+        # Si no se pudo publicar, este worker no vuelve a recorrer antes de tiempo
+        own_due = self._rebuilt_at is None or time.monotonic() - self._rebuilt_at >= self._rebuild_interval
+        if due and own_due and await self._lease.acquire():
+            await self.rebuild()
+            self._rebuilt_at = time.monotonic()
+            self._version = uuid.uuid4().hex
+            try:
+                await self._snapshot.save(self._filter, self._version)
+            except Exception as e:
+                # Por ejemplo un filtro de más de 16 MB: los demás siguen sin filtro (nunca omiten
+                # una consulta) y el lease se retiene para que tampoco recorran ellos
+                logging.error("No se pudo publicar el filtro de correos: %s", e)
+                await self._lease.acquire(self._rebuild_interval)
+                return
+            await self._lease.release()
+        elif published is not None and published["version"] != self._version:
+            loaded = await self._snapshot.load()
+            if loaded is not None:
+                self._filter, self._version = loaded
+                self.loads += 1
+
+    async def _run(self):
+        while True:
+            try:
+                if self._snapshot is None:
+                    await self.rebuild()
+                else:
+                    await self.sync()
+            except Exception as e:
+                logging.error("Error al construir el filtro de correos: %s", e)
+            await asyncio.sleep(self._rebuild_interval if self._snapshot is None else self._sync_interval)
+
+    async def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        bloom = self._filter
+        return {
+            "ready": bloom is not None,
+            "emails": bloom.count if bloom else 0,
+            "capacity": bloom.capacity if bloom else self._capacity,
+            "bits": bloom.size if bloom else 0,
+            "hashes": bloom.hashes if bloom else 0,
+            "memory_bytes": bloom.memory_bytes if bloom else 0,
+            "expected_false_positive_rate": bloom.false_positive_rate() if bloom else None,
+            "rebuilds": self.rebuilds,
+            "loads": self.loads,
+            "checks": self.checks,
+            "skipped": self.skipped,
+            "possible_hits": self.possible_hits,
+            "false_positives": self.false_positives,
+            "observed_false_positive_rate": (
+                self.false_positives / (self.false_positives + self.skipped)
+                if self.false_positives + self.skipped else None
+            ),
+        }
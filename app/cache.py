@@ -0,0 +1,222 @@
+# cache.py - Cache en proceso de respuestas de usuarios e invalidación entre réplicas
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
+
+from pymongo.errors import PyMongoError
+
+
+class LRUTTLCache:
+    """
+    Cache LRU con expiración por TTL. Se usa solo desde el event loop, por lo
+    que no requiere locks. `generation` permite descartar valores leídos de la
+    base antes de una invalidación concurrente: el lector toma la generación
+    antes de consultar y `set` ignora el valor si hubo invalidaciones entre medio.
+    `on_evict(key, value)` se llama cuando una entrada sale por capacidad o por
+    expiración (no al invalidarla).
+    """
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float,
+        clock: Callable[[], float] = time.monotonic,
+        on_evict: Optional[Callable[[Any, Any], None]] = None
+    ):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self.on_evict = on_evict
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[Any]:
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at <= self._clock():
+            del self._data[key]
+            self._evicted(key, value)
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, generation: Optional[int] = None, ttl: Optional[float] = None):
+        """`ttl` acorta la vigencia de esta entrada por debajo del TTL del cache"""
+        if self.maxsize <= 0:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self._data[key] = (value, self._clock() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            evicted_key, (evicted_value, _) = self._data.popitem(last=False)
+            self._evicted(evicted_key, evicted_value)
+
+    def _evicted(self, key, value):
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def invalidate(self, key=None):
+        """Invalidar una clave, o todo el cache si key es None"""
+        self.generation += 1
+        if key is None:
+            self._data.clear()
+        else:
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class InMemoryInvalidationBackend:
+    """
+    Canal de invalidación en memoria: entrega cada clave publicada a todos los
+    suscriptores del mismo proceso. Sirve para una sola réplica y para tests
+    (varias instancias de cache suscritas al mismo backend).
+    """
+
+    def __init__(self):
+        self._listeners: List[Callable[[Any], None]] = []
+
+    def subscribe(self, listener: Callable[[Any], None]):
+        self._listeners.append(listener)
+
+    def _notify(self, key):
+        for listener in self._listeners:
+            listener(key)
+
+    async def publish(self, key):
+        self._notify(key)
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class ChangeFeedInvalidationBackend(InMemoryInvalidationBackend):
+    """
+    Invalidación entre workers y réplicas siguiendo el feed de cambios de la
+    API (con CHANGE_FEED=log, la colección user_changes: funciona con un
+    MongoDB standalone). `publish` invalida en el proceso local de inmediato;
+    los demás procesos reciben la escritura como evento del feed, con un
+    retraso de hasta `poll_interval`. Si la lectura falla se vacía todo el
+    cache y se sigue desde el final del feed, ya que pudieron perderse eventos.
+    """
+
+    def __init__(self, feed, poll_interval: float = 1.0, retry_seconds: float = 1.0):
+        super().__init__()
+        self._feed = feed
+        self._poll_interval = poll_interval
+        self._retry_seconds = retry_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        # Lo escrito antes de arrancar no está en los caches de este proceso
+        since = await self._feed.head()
+        self._task = asyncio.create_task(self._follow(since))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _follow(self, since: Optional[str]):
+        while True:
+            try:
+                async for event in self._feed.follow(since, self._poll_interval):
+                    if event is not None:
+                        self._notify(event["id"])
+            except Exception as e:
+                logging.error("Feed de invalidación interrumpido: %s", e)
+                self._notify(None)
+                await asyncio.sleep(self._retry_seconds)
+                try:
+                    since = await self._feed.head()
+                except Exception as e:
+                    logging.error("No se pudo leer el final del feed de invalidación: %s", e)
+
+
+class ChangeStreamInvalidationBackend(InMemoryInvalidationBackend):
+    """
+    Invalidación entre réplicas a partir del change stream de MongoDB (requiere
+    replica set). `publish` solo invalida en el proceso local: las demás réplicas
+    reciben la escritura como evento de MongoDB. Un borrado no trae el documento:
+    el id público se busca por `documentKey._id` en `archive` (el archivado
+    conserva el `_id`), y solo si no aparece se vacía todo el cache. Si el stream
+    se corta también se vacía todo, ya que pudieron perderse eventos mientras
+    estaba desconectado.
+    """
+
+    PIPELINE = [
+        {"$match": {"operationType": {"$in": ["update", "replace", "delete"]}}},
+        {"$project": {"operationType": 1, "fullDocument.id": 1, "documentKey._id": 1}},
+    ]
+
+    def __init__(self, collection, archive=None, retry_seconds: float = 1.0):
+        super().__init__()
+        self._collection = collection
+        self._archive = archive
+        self._retry_seconds = retry_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _watch(self):
+        while True:
+            try:
+                async with await self._collection.watch(
+                    self.PIPELINE, full_document="updateLookup"
+                ) as stream:
+                    async for change in stream:
+                        if change["operationType"] == "delete":
+                            user_id = await self._deleted_user_id(change["documentKey"]["_id"])
+                        else:
+                            user_id = (change.get("fullDocument") or {}).get("id")
+                        self._notify(user_id)
+            except PyMongoError as e:
+                logging.error("Change stream de invalidación interrumpido: %s", e)
+                self._notify(None)
+                await asyncio.sleep(self._retry_seconds)
+
+    async def _deleted_user_id(self, object_id) -> Optional[str]:
+        """Id público de un documento borrado, o None si no se encuentra en el archivo"""
+        if self._archive is None:
+            return None
+        try:
+            archived = await self._archive.find_one({"_id": object_id}, {"_id": 0, "id": 1})
+        except PyMongoError as e:
+            logging.error("No se pudo buscar el usuario borrado en el archivo: %s", e)
+            return None
+        return None if archived is None else archived["id"]
@@ -0,0 +1,317 @@
+# changes.py - Feed de cambios de usuarios (altas, modificaciones y bajas) reanudable por token
+import asyncio
+import base64
+import binascii
+from abc import ABC, abstractmethod
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Callable, Deque, List, Optional, Tuple
+
+import bson
+from bson.errors import BSONError
+from pymongo import ASCENDING, IndexModel, ReturnDocument
+from pymongo.errors import PyMongoError
+
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+
+
+class ChangeFeedExpired(Exception):
+    """El token es anterior a lo que todavía se conserva del feed"""
+
+
+def _invalid_token() -> ValueError:
+    return ValueError("El token del feed de cambios no es válido")
+
+
+def _utcnow() -> datetime:
+    # Sin zona horaria, igual que las fechas leídas desde MongoDB
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _event(token: str, operation: str, user_id: str, ts: datetime, user: Optional[dict]) -> dict:
+    return {"token": token, "operacion": operation, "id": user_id, "fecha": ts, "usuario": user}
+
+
+class ChangeFeed(ABC):
+    """
+    Cambios de usuarios en orden, leídos desde la posición `since` (token
+    opaco devuelto en cada evento). Las bajas (soft delete) se informan como
+    "delete" sin usuario. `to_wire` convierte el documento a la forma pública.
+    """
+
+    def __init__(self, to_wire: Callable[[dict], dict]):
+        self._to_wire = to_wire
+        self._recorded = asyncio.Event()
+
+    async def ensure_indexes(self):
+        pass
+
+    async def record(self, operation: str, user_id: str, user_doc: Optional[dict] = None):
+        """Registrar un cambio hecho por esta réplica (no-op si la base ya lo emite)"""
+
+    async def record_many(self, operation: str, user_docs: List[dict]):
+        for user_doc in user_docs:
+            await self.record(operation, user_doc["id"], user_doc)
+
+    def _notify(self):
+        # Despierta a los suscriptores SSE de esta réplica sin esperar al siguiente poll
+        self._recorded.set()
+        self._recorded = asyncio.Event()
+
+    async def validate(self, since: Optional[str]):
+        """ValueError si el token no es válido, ChangeFeedExpired si ya no se conserva"""
+
+    async def head(self) -> Optional[str]:
+        """Token desde el que se leen solo los cambios posteriores a este momento"""
+        return None
+
+    @abstractmethod
+    async def read(self, since: Optional[str], limit: int) -> Tuple[List[dict], Optional[str]]:
+        """Hasta `limit` eventos posteriores a `since` y el token desde el que continuar"""
+
+    async def follow(self, since: Optional[str], poll_interval: float) -> AsyncIterator[Optional[dict]]:
+        """
+        Eventos a medida que ocurren. Entrega None cada `poll_interval` sin
+        cambios, para que el llamador pueda enviar keepalives.
+        """
+        token = since
+        while True:
+            # Se toma antes de leer para no perder un aviso que llegue durante la lectura
+            recorded = self._recorded
+            events, token = await self.read(token, 100)
+            for event in events:
+                yield event
+            if events:
+                continue
+            try:
+                await asyncio.wait_for(recorded.wait(), poll_interval)
+            except asyncio.TimeoutError:
+                yield None
+
+
+class InMemoryChangeFeed(ChangeFeed):
+    """Log acotado en memoria con números de secuencia; para USER_REPOSITORY=memory"""
+
+    def __init__(self, to_wire: Callable[[dict], dict], maxlen: int = 100000):
+        super().__init__(to_wire)
+        self._events: Deque[Tuple[int, dict]] = deque(maxlen=maxlen)
+        self._sequence = 0
+
+    async def record(self, operation: str, user_id: str, user_doc: Optional[dict] = None):
+        self._sequence += 1
+        user = None if operation == DELETE or user_doc is None else self._to_wire(user_doc)
+        self._events.append((
+            self._sequence,
+            _event(str(self._sequence), operation, user_id, _utcnow(), user)
+        ))
+        self._notify()
+
+    def _position(self, since: Optional[str]) -> int:
+        if since is None:
+            return 0
+        if not since.isdigit():
+            raise _invalid_token()
+        after = int(since)
+        if self._events and after < self._events[0][0] - 1:
+            raise ChangeFeedExpired(since)
+        return after
+
+    async def validate(self, since: Optional[str]):
+        self._position(since)
+
+    async def head(self) -> Optional[str]:
+        return str(self._sequence)
+
+    async def read(self, since: Optional[str], limit: int) -> Tuple[List[dict], Optional[str]]:
+        after = self._position(since)
+        # Las secuencias son consecutivas: la posición en el deque se calcula directo
+        start = 0 if not self._events else max(0, after - self._events[0][0] + 1)
+        events = [self._events[index][1] for index in range(start, min(start + limit, len(self._events)))]
+        return events, events[-1]["token"] if events else since
+
+
+class ChangeLogFeed(ChangeFeed):
+    """
+    Log append-only en la colección user_changes, escrito por los handlers tras
+    cada escritura. Cada evento recibe como _id (y token) un número de secuencia
+    del contador `counters`, incrementado con $inc en el servidor, por lo que el
+    orden es el mismo en todas las réplicas. Dos inserciones pueden confirmarse
+    en otro orden que el de sus secuencias (corrutinas o workers distintos): la
+    lectura se detiene en el primer hueco y el evento que falta se entrega en
+    cuanto se confirma. Un hueco seguido de un evento con más de `gap_timeout`
+    se da por perdido (la escritura falló después de reservar la secuencia).
+    Los eventos se eliminan por TTL después de `retention`.
+    """
+
+    COUNTER_ID = "user_changes"
+
+    def __init__(
+        self,
+        collection,
+        to_wire: Callable[[dict], dict],
+        retention: timedelta = timedelta(days=7),
+        counters=None,
+        gap_timeout: timedelta = timedelta(seconds=10)
+    ):
+        super().__init__(to_wire)
+        self._collection = collection
+        self._counters = collection.database.counters if counters is None else counters
+        self._retention = retention
+        self._gap_timeout = gap_timeout
+
+    async def ensure_indexes(self):
+        await self._collection.create_indexes([
+            IndexModel([("fecha", ASCENDING)], name="fecha_ttl",
+                       expireAfterSeconds=int(self._retention.total_seconds()))
+        ])
+
+    async def _reserve(self, count: int) -> int:
+        """Primera de `count` secuencias consecutivas reservadas para esta réplica"""
+        counter = await self._counters.find_one_and_update(
+            {"_id": self.COUNTER_ID},
+            {"$inc": {"seq": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter["seq"] - count + 1
+
+    def _log_doc(self, seq: int, operation: str, user_id: str, user_doc: Optional[dict]) -> dict:
+        user = None if operation == DELETE or user_doc is None else self._to_wire(user_doc)
+        # fecha se toma después de reservar: el hueco de una secuencia anterior es más antiguo
+        return {"_id": seq, "operacion": operation, "id": user_id, "fecha": _utcnow(), "usuario": user}
+
+    async def record(self, operation: str, user_id: str, user_doc: Optional[dict] = None):
+        seq = await self._reserve(1)
+        await self._collection.insert_one(self._log_doc(seq, operation, user_id, user_doc))
+        self._notify()
+
+    async def record_many(self, operation: str, user_docs: List[dict]):
+        if user_docs:
+            first = await self._reserve(len(user_docs))
+            await self._collection.insert_many([
+                self._log_doc(first + offset, operation, user_doc["id"], user_doc)
+                for offset, user_doc in enumerate(user_docs)
+            ])
+            self._notify()
+
+    async def _position(self, since: Optional[str]) -> int:
+        if since is None:
+            return 0
+        if not since.isdigit():
+            raise _invalid_token()
+        after = int(since)
+        oldest = await self._collection.find_one({}, sort=[("_id", ASCENDING)])
+        if oldest is not None:
+            expired = after < oldest["_id"] - 1
+        else:
+            counter = await self._counters.find_one({"_id": self.COUNTER_ID})
+            expired = counter is not None and after < counter["seq"]
+        if expired:
+            raise ChangeFeedExpired(since)
+        return after
+
+    async def validate(self, since: Optional[str]):
+        await self._position(since)
+
+    async def head(self) -> Optional[str]:
+        counter = await self._counters.find_one({"_id": self.COUNTER_ID})
+        return None if counter is None else str(counter["seq"])
+
+    async def read(self, since: Optional[str], limit: int) -> Tuple[List[dict], Optional[str]]:
+        after = await self._position(since)
+        log_docs = await self._collection.find({"_id": {"$gt": after}}).sort("_id", ASCENDING).limit(
+            limit
+        ).to_list()
+        settled = _utcnow() - self._gap_timeout
+        events = []
+        expected = after + 1
+        for log_doc in log_docs:
+            # Falta una secuencia anterior que todavía se puede confirmar: se espera por ella
+            if log_doc["_id"] != expected and log_doc["fecha"] > settled:
+                break
+            events.append(_event(
+                str(log_doc["_id"]), log_doc["operacion"], log_doc["id"], log_doc["fecha"], log_doc["usuario"]
+            ))
+            expected = log_doc["_id"] + 1
+        return events, events[-1]["token"] if events else since
+
+
+def encode_resume_token(resume_token: dict) -> str:
+    return base64.urlsafe_b64encode(bson.encode(resume_token)).decode("ascii").rstrip("=")
+
+
+def decode_resume_token(token: str) -> dict:
+    try:
+        return bson.decode(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (binascii.Error, BSONError, ValueError):
+        raise _invalid_token()
+
+
+class ChangeStreamFeed(ChangeFeed):
+    """
+    Change streams nativos sobre la colección users (requiere replica set). El
+    token es el resume token del stream; sin `since` se empieza desde ahora.
+    Las escrituras diferidas que solo tocan last_login no se informan.
+    """
+
+    PIPELINE = [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}]
+    IGNORED_FIELDS = {"last_login"}
+
+    def __init__(self, collection, to_wire: Callable[[dict], dict]):
+        super().__init__(to_wire)
+        self._collection = collection
+
+    def _to_event(self, change: dict) -> Optional[dict]:
+        user_doc = change.get("fullDocument")
+        if user_doc is None:
+            return None
+        operation = CREATE if change["operationType"] == "insert" else UPDATE
+        if change["operationType"] == "update":
+            updated = change.get("updateDescription", {}).get("updatedFields", {})
+            if set(updated) <= self.IGNORED_FIELDS:
+                return None
+            if updated.get("isactive") is False:
+                operation = DELETE
+        ts = change.get("wallTime") or _utcnow()
+        user = None if operation == DELETE else self._to_wire(user_doc)
+        return _event(encode_resume_token(change["_id"]), operation, user_doc["id"], ts, user)
+
+    async def validate(self, since: Optional[str]):
+        # El historial perdido solo se detecta al abrir el stream
+        if since is not None:
+            decode_resume_token(since)
+
+    async def _watch(self, since: Optional[str], max_await_ms: int):
+        options = {"full_document": "updateLookup", "max_await_time_ms": max_await_ms}
+        if since is not None:
+            options["resume_after"] = decode_resume_token(since)
+        try:
+            return await self._collection.watch(self.PIPELINE, **options)
+        except PyMongoError as e:
+            # Resume token fuera del oplog (ChangeStreamHistoryLost)
+            if getattr(e, "code", None) == 286:
+                raise ChangeFeedExpired(since) from e
+            raise
+
+    async def read(self, since: Optional[str], limit: int) -> Tuple[List[dict], Optional[str]]:
+        events = []
+        # Un poll no debe esperar cambios nuevos: el mínimo de espera del servidor
+        async with await self._watch(since, 1) as stream:
+            while len(events) < limit:
+                change = await stream.try_next()
+                if change is None:
+                    break
+                event = self._to_event(change)
+                if event is not None:
+                    events.append(event)
+            token = stream.resume_token
+        return events, encode_resume_token(token) if token else since
+
+    async def follow(self, since: Optional[str], poll_interval: float) -> AsyncIterator[Optional[dict]]:
+        async with await self._watch(since, int(poll_interval * 1000)) as stream:
+            while True:
+                change = await stream.try_next()
+                event = None if change is None else self._to_event(change)
+                yield event
@@ -0,0 +1,181 @@
+# circuit.py - Circuit breaker para cortar rápido las llamadas a una dependencia caída o lenta
+import math
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Optional, TypeVar
+
+T = TypeVar("T")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """El circuito está abierto; el cliente debe reintentar más tarde"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Circuito abierto")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Registra el resultado de las últimas `window_size` llamadas y abre el
+    circuito cuando, con al menos `min_calls` registradas, la proporción de
+    fallos alcanza `failure_rate` o la de llamadas más lentas que
+    `slow_call_seconds` alcanza `slow_call_rate`. Abierto, rechaza de inmediato
+    con CircuitOpen durante `open_seconds`; luego deja pasar `half_open_calls`
+    llamadas de prueba: si todas terminan bien y a tiempo se cierra, y si una
+    falla o es lenta vuelve a abrirse.
+
+    `is_failure` decide qué excepciones cuentan como fallo de la dependencia
+    (un correo duplicado, por ejemplo, no lo es). `on_state_change` recibe cada
+    nuevo estado (para métricas).
+    """
+
+    def __init__(
+        self,
+        failure_rate: float = 0.5,
+        slow_call_rate: float = 0.8,
+        slow_call_seconds: float = 1.0,
+        window_size: int = 100,
+        min_calls: int = 20,
+        open_seconds: float = 10,
+        half_open_calls: int = 3,
+        is_failure: Callable[[BaseException], bool] = lambda exc: True,
+        clock: Callable[[], float] = time.monotonic,
+        on_state_change: Optional[Callable[[str], None]] = None
+    ):
+        self._failure_rate = failure_rate
+        self._slow_call_rate = slow_call_rate
+        self._slow_call_seconds = slow_call_seconds
+        self._min_calls = min_calls
+        self._open_seconds = open_seconds
+        self._half_open_calls = half_open_calls
+        self._is_failure = is_failure
+        self._clock = clock
+        self._on_state_change = on_state_change
+        # Cada elemento es (falló, fue lenta); los contadores evitan recorrer la ventana
+        self._window = deque(maxlen=window_size)
+        self._failures = 0
+        self._slow = 0
+        self._state = CLOSED
+        # Cambia en cada transición para descartar resultados de llamadas de otro estado
+        self._generation = 0
+        self._opened_at = 0.0
+        self._trials = 0
+        self._trial_successes = 0
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self._open_seconds:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state: str):
+        self._state = state
+        self._generation += 1
+        self._window.clear()
+        self._failures = self._slow = 0
+        self._trials = self._trial_successes = 0
+        if state == OPEN:
+            self._opened_at = self._clock()
+            self.opened += 1
+        if self._on_state_change is not None:
+            self._on_state_change(state)
+
+    @property
+    def retry_after(self) -> int:
+        """Segundos hasta la siguiente llamada de prueba"""
+        remaining = self._open_seconds - (self._clock() - self._opened_at)
+        return max(1, math.ceil(remaining))
+
+    def _acquire(self) -> int:
+        """Admitir una llamada o fallar con CircuitOpen; devuelve la generación"""
+        state = self.state
+        if state == OPEN or (state == HALF_OPEN and self._trials >= self._half_open_calls):
+            self.rejected += 1
+            raise CircuitOpen(self.retry_after if state == OPEN else 1)
+        if state == HALF_OPEN:
+            self._trials += 1
+        return self._generation
+
+    def _record(self, generation: int, failed: bool, slow: bool):
+        if generation != self._generation:
+            return
+        if self._state == HALF_OPEN:
+            if failed or slow:
+                self._transition(OPEN)
+                return
+            self._trial_successes += 1
+            if self._trial_successes >= self._half_open_calls:
+                self._transition(CLOSED)
+            return
+
+        if len(self._window) == self._window.maxlen:
+            old_failed, old_slow = self._window[0]
+            self._failures -= old_failed
+            self._slow -= old_slow
+        self._window.append((failed, slow))
+        self._failures += failed
+        self._slow += slow
+        calls = len(self._window)
+        if calls >= self._min_calls and (
+            self._failures / calls >= self._failure_rate or self._slow / calls >= self._slow_call_rate
+        ):
+            self._transition(OPEN)
+
+    def _release(self, generation: int):
+        """Una llamada de prueba cancelada no cuenta como resultado, pero libera su cupo"""
+        if generation == self._generation and self._state == HALF_OPEN:
+            self._trials -= 1
+
+    def _record_exception(self, generation: int, exc: BaseException):
+        if isinstance(exc, Exception):
+            self._record(generation, self._is_failure(exc), False)
+        else:
+            self._release(generation)
+
+    async def call(self, fn: Callable[[], Awaitable[T]]) -> T:
+        generation = self._acquire()
+        start = self._clock()
+        try:
+            result = await fn()
+        except BaseException as exc:
+            self._record_exception(generation, exc)
+            raise
+        self._record(generation, False, self._clock() - start >= self._slow_call_seconds)
+        return result
+
+    async def stream(self, items: AsyncIterator[T]) -> AsyncIterator[T]:
+        """
+        Recorrer un iterador asíncrono como una sola llamada. No se mide la
+        lentitud: un recorrido largo (una exportación) no indica una base lenta.
+        """
+        generation = self._acquire()
+        try:
+            async for item in items:
+                yield item
+        except BaseException as exc:
+            self._record_exception(generation, exc)
+            raise
+        finally:
+            # Si el consumidor corta el recorrido, cerrar también el iterador (y su cursor)
+            aclose = getattr(items, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        self._record(generation, False, False)
+
+    def stats(self) -> dict:
+        calls = len(self._window)
+        return {
+            "state": self.state,
+            "calls": calls,
+            "failure_rate": self._failures / calls if calls else None,
+            "slow_call_rate": self._slow / calls if calls else None,
+            "opened": self.opened,
+            "rejected": self.rejected,
+        }
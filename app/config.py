@@ -0,0 +1,132 @@
+# config.py - Configuración del servicio leída desde variables de entorno
+from typing import Dict, Optional
+
+from pydantic_settings import BaseSettings
+
+
+class Settings(BaseSettings):
+    # Motor de persistencia: "mongo" o "memory" (tests y benchmarks sin MongoDB)
+    user_repository: str = "mongo"
+
+    # Conexión a MongoDB
+    mongo_host: str = "users_service_mongodb"
+    mongo_port: int = 27017
+    mongo_database: str = "users_service"
+
+    # Pool de conexiones y timeouts del driver (milisegundos)
+    mongo_max_pool_size: int = 100
+    mongo_min_pool_size: int = 0
+    mongo_connect_timeout_ms: int = 5000
+    mongo_server_selection_timeout_ms: int = 5000
+    mongo_socket_timeout_ms: Optional[int] = None
+    mongo_wait_queue_timeout_ms: Optional[int] = None
+    mongo_max_idle_time_ms: Optional[int] = None
+    # Límite total de cada operación (CSOT); sin valor, solo rigen los timeouts anteriores
+    mongo_timeout_ms: Optional[int] = None
+
+    # Read preference de listados, conteos y exportaciones ("primary",
+    # "primaryPreferred", "secondary", "secondaryPreferred" o "nearest"); las
+    # lecturas por id y las escrituras siempre van al primario
+    mongo_list_read_preference: str = "primary"
+    mongo_max_staleness_seconds: Optional[int] = None
+
+    # Circuit breaker de MongoDB: se abre si en las últimas WINDOW_SIZE llamadas
+    # fallan FAILURE_RATE o tardan más de SLOW_CALL_SECONDS SLOW_CALL_RATE
+    circuit_breaker_enabled: bool = True
+    circuit_breaker_window_size: int = 100
+    circuit_breaker_min_calls: int = 20
+    circuit_breaker_failure_rate: float = 0.5
+    circuit_breaker_slow_call_rate: float = 0.8
+    circuit_breaker_slow_call_seconds: float = 1.0
+    circuit_breaker_open_seconds: float = 10
+    circuit_breaker_half_open_calls: int = 3
+
+    # /ready: el ping a la base se cachea para no repetirlo en cada sondeo
+    ready_cache_seconds: float = 2.0
+    ready_timeout_seconds: float = 1.0
+
+    # Pool de procesos para bcrypt
+    hash_workers: int = 2
+    hash_max_queue: int = 32
+    hash_retry_after_seconds: int = 1
+    # Contraseñas por bloque de POST /usuarios/bulk; entre bloques se intercalan
+    # los hashes de registros, logins y cambios de contraseña
+    hash_bulk_chunk_size: int = 4
+
+    # Cache de GET /usuarios/{user_id} y de tokens verificados. Invalidación:
+    # "change_feed" (sigue el feed de cambios, sirve para varios workers y réplicas
+    # con un MongoDB standalone), "change_stream" (requiere replica set) o
+    # "local" (solo el proceso que escribe, para un único worker)
+    user_cache_size: int = 10000
+    user_cache_ttl_seconds: float = 60
+    user_cache_invalidation: str = "change_feed"
+
+    # Workers del servidor (la imagen de producción exporta WEB_CONCURRENCY)
+    web_concurrency: int = 1
+
+    # Valida cada respuesta con pydantic antes de enviarla (más lento, útil para depurar)
+    validate_responses: bool = False
+
+    # Carga masiva POST /usuarios/bulk. Con ~250 ms por hash y HASH_WORKERS=2, un
+    # lote de 250 usuarios tarda ~30 s: debe terminar dentro del timeout HTTP
+    bulk_max_items: int = 250
+    bulk_insert_chunk_size: int = 1000
+
+    # Filtro de Bloom de correos registrados que evita consultar duplicados en
+    # POST /usuarios/bulk cuando ningún correo del lote puede estar registrado
+    email_filter_enabled: bool = True
+    email_filter_capacity: int = 1000000
+    email_filter_error_rate: float = 0.01
+    email_filter_rebuild_seconds: float = 3600
+    # Cada cuánto cada worker revisa si hay una copia publicada más nueva
+    email_filter_sync_seconds: float = 60
+
+    # Archivado de usuarios desactivados hace más de ARCHIVE_AFTER_DAYS en
+    # users_archive, en lotes con pausa entre ellos para no competir con el tráfico
+    archive_enabled: bool = True
+    archive_after_days: int = 30
+    archive_batch_size: int = 500
+    archive_batch_pause_seconds: float = 1.0
+    archive_interval_seconds: float = 3600
+
+    # Tareas de un solo worker entre todos (archivado, construcción del filtro de
+    # correos): las toma quien tenga el lease en la colección leases; si ese
+    # worker muere, otro la toma cuando el lease vence
+    leader_lease_seconds: float = 120
+
+    # Idempotency-Key en POST /usuarios y PUT /usuarios/{user_id}: "mongo" (colección
+    # idempotency_keys compartida entre workers) o "memory" (por worker, solo con
+    # un worker). Con USER_REPOSITORY=memory siempre se guardan en memoria
+    idempotency_store: str = "mongo"
+    idempotency_max_keys: int = 10000
+    idempotency_ttl_seconds: float = 86400
+    idempotency_wait_seconds: float = 30
+
+    # Autenticación: vigencia de los JWT y cache de tokens ya verificados
+    access_token_expire_minutes: int = 60
+    auth_cache_size: int = 10000
+    auth_cache_ttl_seconds: float = 300
+
+    # Write-behind de last_login: flush por tamaño o por tiempo
+    write_behind_max_pending: int = 1000
+    write_behind_flush_seconds: float = 1.0
+
+    # Feed de cambios GET /usuarios/changes: "log" (colección user_changes escrita
+    # por la API) o "change_stream" (change streams nativos, requiere replica set)
+    change_feed: str = "log"
+    change_feed_retention_days: int = 7
+    # Espera máxima por un evento con secuencia reservada que aún no se confirmó
+    change_feed_gap_seconds: float = 10
+    change_feed_memory_size: int = 100000
+    change_feed_poll_seconds: float = 1.0
+    change_feed_keepalive_seconds: float = 15
+
+    # Logging: nivel, formato ("json" o "text") y muestreo 1 de cada N por handler
+    # de ruta, ej. LOG_SAMPLE_RATES='{"get_user": 100, "get_users": 10}'
+    log_level: str = "INFO"
+    log_format: str = "json"
+    log_sample_rates: Dict[str, int] = {}
+    log_queue_size: int = 10000
+
+
+settings = Settings()
@@ -0,0 +1,97 @@
+# export.py - Exportación de usuarios en streaming (NDJSON / CSV) sin modelos pydantic
+import csv
+import io
+import zlib
+from typing import AsyncIterable, AsyncIterator, Optional
+
+from .serialization import dumps
+
+# Campos proyectados en la base: nunca se leen el hash de la contraseña ni el token
+EXPORT_FIELDS = ("id", "name", "email", "phones", "created", "modified", "last_login", "isactive")
+CSV_COLUMNS = list(EXPORT_FIELDS)
+
+# Tamaño aproximado de cada bloque enviado al socket
+CHUNK_SIZE = 64 * 1024
+
+
+def _format_phones(phones: list) -> str:
+    """Teléfonos en una celda CSV: contrycode-citycode-number separados por ';'"""
+    return ";".join(
+        f"{phone['contrycode']}-{phone['citycode']}-{phone['number']}" for phone in phones
+    )
+
+
+async def ndjson_chunks(user_docs: AsyncIterable[dict]) -> AsyncIterator[bytes]:
+    """Un usuario por línea, agrupando líneas en bloques de ~CHUNK_SIZE bytes"""
+    buffer = []
+    size = 0
+    async for user_doc in user_docs:
+        line = dumps(user_doc) + b"\n"
+        buffer.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield b"".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield b"".join(buffer)
+
+
+async def csv_chunks(user_docs: AsyncIterable[dict]) -> AsyncIterator[bytes]:
+    """CSV con encabezado y columnas fijas, en bloques de ~CHUNK_SIZE bytes"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(CSV_COLUMNS)
+    async for user_doc in user_docs:
+        writer.writerow([
+            user_doc.get("id"),
+            user_doc.get("name"),
+            user_doc.get("email"),
+            _format_phones(user_doc.get("phones", [])),
+            user_doc["created"].isoformat() if user_doc.get("created") else "",
+            user_doc["modified"].isoformat() if user_doc.get("modified") else "",
+            user_doc["last_login"].isoformat() if user_doc.get("last_login") else "",
+            user_doc.get("isactive"),
+        ])
+        if output.tell() >= CHUNK_SIZE:
+            yield output.getvalue().encode()
+            output.seek(0)
+            output.truncate(0)
+    if output.tell():
+        yield output.getvalue().encode()
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """
+    Si Accept-Encoding admite gzip, respetando los q-values: "gzip;q=0" lo
+    rechaza y "*" lo admite solo cuando gzip no aparece por nombre
+    """
+    qvalues = {}
+    for item in (accept_encoding or "").split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        qvalue = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[coding] = qvalue
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qvalues:
+            return qvalues[coding] > 0
+    return False
+
+
+async def gzip_chunks(chunks: AsyncIterable[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    """Comprimir en gzip a medida que se generan los bloques"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,128 @@
+# hashing.py - Hashing de contraseñas en un pool de procesos acotado
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+
+class HashingOverloaded(Exception):
+    """La cola de hashing está llena; el cliente debe reintentar más tarde"""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Cola de hashing de contraseñas llena")
+        self.retry_after = retry_after
+
+
+def _timed_call(fn, *args) -> Tuple[object, float]:
+    """Ejecutar `fn` dentro del proceso del pool midiendo solo su tiempo propio"""
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def _hash_chunk(hash_fn: Callable[[str], str], passwords: List[str]) -> List[Tuple[str, float]]:
+    """Hash de un bloque de contraseñas dentro de un proceso del pool"""
+    return [_timed_call(hash_fn, password) for password in passwords]
+
+
+class PasswordHasher:
+    """
+    Ejecuta bcrypt en procesos dedicados para no ocupar el event loop ni el GIL
+    del proceso que atiende requests. Admite como máximo `workers + max_queue`
+    contraseñas pendientes; sobre ese límite falla inmediatamente con
+    HashingOverloaded en lugar de encolar sin límite. Los lotes se envían en
+    bloques de hasta `bulk_chunk_size` contraseñas. `on_duration` recibe la
+    operación ("hash" o "verify") y el tiempo de bcrypt sin la espera en cola.
+    """
+
+    def __init__(
+        self,
+        hash_fn: Callable[[str], str],
+        verify_fn: Callable[[str, str], bool],
+        workers: int = 2,
+        max_queue: int = 32,
+        retry_after: int = 1,
+        bulk_chunk_size: int = 4,
+        on_duration: Optional[Callable[[str, float], None]] = None
+    ):
+        self._hash_fn = hash_fn
+        self._verify_fn = verify_fn
+        self._workers = workers
+        self._capacity = workers + max_queue
+        self._retry_after = retry_after
+        self._bulk_chunk_size = bulk_chunk_size
+        self._on_duration = on_duration
+        self._pending = 0
+        # "spawn" evita heredar hilos y sockets del proceso principal
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def _observe(self, operation: str, seconds: float):
+        if self._on_duration is not None:
+            self._on_duration(operation, seconds)
+
+    async def _submit(self, operation: str, fn, *args):
+        # Sólo se accede desde el event loop, por lo que el contador no necesita lock
+        if self._pending >= self._capacity:
+            raise HashingOverloaded(self._retry_after)
+        self._pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            result, seconds = await loop.run_in_executor(self._executor, _timed_call, fn, *args)
+        finally:
+            self._pending -= 1
+        self._observe(operation, seconds)
+        return result
+
+    async def hash(self, password: str) -> str:
+        """Hash de la contraseña en el pool de procesos"""
+        return await self._submit("hash", self._hash_fn, password)
+
+    async def hash_many(self, passwords: List[str]) -> List[str]:
+        """
+        Hash de un lote en bloques pequeños, con a lo sumo un bloque en curso por
+        proceso del pool. Cada contraseña en curso ocupa un cupo de admisión: el
+        lote se reparte en los cupos libres al empezar (HashingOverloaded si no
+        queda ninguno) y entre un bloque y el siguiente las operaciones
+        individuales se intercalan en la cola del pool en lugar de esperar al lote.
+        """
+        if not passwords:
+            return []
+        free = self._capacity - self._pending
+        if free <= 0:
+            raise HashingOverloaded(self._retry_after)
+        lanes = min(self._workers, free, len(passwords))
+        chunk_size = max(1, min(self._bulk_chunk_size, free // lanes))
+        starts = iter(range(0, len(passwords), chunk_size))
+        hashes: List[Optional[str]] = [None] * len(passwords)
+        loop = asyncio.get_running_loop()
+
+        async def lane():
+            # Los carriles comparten el iterador: cada uno toma el siguiente bloque libre
+            for start in starts:
+                chunk = passwords[start:start + chunk_size]
+                self._pending += len(chunk)
+                try:
+                    results = await loop.run_in_executor(self._executor, _hash_chunk, self._hash_fn, chunk)
+                finally:
+                    self._pending -= len(chunk)
+                for offset, (hashed, seconds) in enumerate(results):
+                    self._observe("hash", seconds)
+                    hashes[start + offset] = hashed
+
+        await asyncio.gather(*(lane() for _ in range(lanes)))
+        return hashes
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        """Verificar contraseña en el pool de procesos"""
+        return await self._submit("verify", self._verify_fn, plain_password, hashed_password)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
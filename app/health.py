@@ -0,0 +1,46 @@
+# health.py - Comprobación de dependencias cacheada para /ready
+import asyncio
+import time
+from typing import Awaitable, Callable, Optional
+
+
+class CachedProbe:
+    """
+    Ejecuta `check` (por ejemplo un ping a MongoDB) como mucho una vez cada
+    `ttl` segundos y con un límite de `timeout`, para que los sondeos frecuentes
+    del orquestador no agreguen carga ni esperen al timeout del driver.
+    Solo una comprobación está en curso a la vez; el resto espera su resultado.
+    """
+
+    def __init__(
+        self,
+        check: Callable[[], Awaitable[object]],
+        ttl: float = 2.0,
+        timeout: float = 1.0,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self._check = check
+        self._ttl = ttl
+        self._timeout = timeout
+        self._clock = clock
+        self._lock = asyncio.Lock()
+        self._checked_at: Optional[float] = None
+        self.ok = False
+        self.error: Optional[str] = None
+
+    def _fresh(self) -> bool:
+        return self._checked_at is not None and self._clock() - self._checked_at < self._ttl
+
+    async def __call__(self) -> bool:
+        if self._fresh():
+            return self.ok
+        async with self._lock:
+            if self._fresh():
+                return self.ok
+            try:
+                await asyncio.wait_for(self._check(), self._timeout)
+                self.ok, self.error = True, None
+            except Exception as e:
+                self.ok, self.error = False, str(e) or type(e).__name__
+            self._checked_at = self._clock()
+        return self.ok
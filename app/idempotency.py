@@ -0,0 +1,274 @@
+# idempotency.py - Soporte de Idempotency-Key: respuestas guardadas por clave y huella de la solicitud
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import DuplicateKeyError
+
+
+class StoredResponse(NamedTuple):
+    status_code: int
+    body: bytes
+    headers: Dict[str, str]
+
+
+class IdempotencyConflict(Exception):
+    """La clave ya se usó con una solicitud distinta"""
+
+
+class IdempotencyInProgress(Exception):
+    """Otro proceso sigue ejecutando la solicitud con esta clave"""
+
+
+def request_fingerprint(*parts, secret: Optional[str] = None) -> str:
+    """
+    Huella de la solicitud (método, ruta, cuerpo, precondiciones). Con `secret`
+    es un HMAC: si el cuerpo trae la contraseña en claro, la huella guardada no
+    sirve para probar contraseñas sin la clave del servidor.
+    """
+    payload = json.dumps(parts, sort_keys=True, default=str).encode()
+    if secret is None:
+        return hashlib.sha256(payload).hexdigest()
+    return hmac.new(secret.encode(), payload, hashlib.sha256).hexdigest()
+
+
+class IdempotencyStore(ABC):
+    """
+    Registros por clave: {"fingerprint", "response"}, con response None mientras
+    la solicitud está en curso (reservada).
+    """
+
+    async def ensure_indexes(self):
+        pass
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[dict]:
+        """Registro de la clave, o None si no existe o expiró"""
+
+    @abstractmethod
+    async def reserve(self, key: str, fingerprint: str) -> bool:
+        """Marcar la clave como en curso; False si ya existe"""
+
+    @abstractmethod
+    async def complete(self, key: str, fingerprint: str, response: StoredResponse):
+        """Guardar la respuesta de la clave reservada"""
+
+    @abstractmethod
+    async def release(self, key: str):
+        """Liberar una reserva sin respuesta (la solicitud falló y se puede reintentar)"""
+
+
+class InMemoryIdempotencyStore(IdempotencyStore):
+    """Registros en un LRUTTLCache dedicado: acotado en cantidad y con expiración"""
+
+    def __init__(self, cache):
+        self._cache = cache
+
+    async def get(self, key: str) -> Optional[dict]:
+        return self._cache.get(key)
+
+    async def reserve(self, key: str, fingerprint: str) -> bool:
+        if self._cache.get(key) is not None:
+            return False
+        self._cache.set(key, {"fingerprint": fingerprint, "response": None})
+        return True
+
+    async def complete(self, key: str, fingerprint: str, response: StoredResponse):
+        self._cache.set(key, {"fingerprint": fingerprint, "response": response})
+
+    async def release(self, key: str):
+        self._cache.invalidate(key)
+
+
+class MongoIdempotencyStore(IdempotencyStore):
+    """
+    Registros en la colección idempotency_keys, compartidos entre workers y
+    réplicas. La reserva es un insert con la clave como _id, por lo que solo un
+    proceso ejecuta la solicitud. Una reserva de un proceso caído se puede tomar
+    después de `lock_seconds`. Los registros expiran por TTL.
+    """
+
+    def __init__(self, collection, ttl: float = 86400, lock_seconds: float = 60):
+        self._collection = collection
+        self._ttl = ttl
+        self._lock = timedelta(seconds=lock_seconds)
+
+    async def ensure_indexes(self):
+        await self._collection.create_indexes([
+            IndexModel([("created", ASCENDING)], name="created_ttl", expireAfterSeconds=int(self._ttl))
+        ])
+
+    async def get(self, key: str) -> Optional[dict]:
+        doc = await self._collection.find_one({"_id": key})
+        if doc is None:
+            return None
+        response = None
+        if doc["state"] == "done":
+            response = StoredResponse(doc["status_code"], bytes(doc["body"]), doc["headers"])
+        return {"fingerprint": doc["fingerprint"], "response": response}
+
+    async def reserve(self, key: str, fingerprint: str) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            await self._collection.insert_one(
+                {"_id": key, "fingerprint": fingerprint, "state": "pending", "created": now}
+            )
+            return True
+        except DuplicateKeyError:
+            result = await self._collection.update_one(
+                {"_id": key, "state": "pending", "created": {"$lt": now - self._lock}},
+                {"$set": {"fingerprint": fingerprint, "created": now}}
+            )
+            return result.modified_count == 1
+
+    async def complete(self, key: str, fingerprint: str, response: StoredResponse):
+        await self._collection.update_one({"_id": key}, {"$set": {
+            "fingerprint": fingerprint,
+            "state": "done",
+            "status_code": response.status_code,
+            "body": response.body,
+            "headers": response.headers,
+            "created": datetime.now(timezone.utc),
+        }})
+
+    async def release(self, key: str):
+        await self._collection.delete_one({"_id": key, "state": "pending"})
+
+
+class IdempotencyManager:
+    """
+    Ejecuta cada clave una sola vez. Un reintento con la misma clave y la misma
+    huella recibe la respuesta guardada; con otra huella, IdempotencyConflict.
+    Los duplicados concurrentes del mismo proceso esperan a la ejecución en curso
+    y los de otros procesos consultan el store hasta `wait_timeout`. Las
+    respuestas 5xx no se guardan, para que el reintento vuelva a ejecutarse.
+    """
+
+    def __init__(
+        self,
+        store: IdempotencyStore,
+        wait_timeout: float = 30,
+        poll_interval: float = 0.1,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self._store = store
+        self._wait_timeout = wait_timeout
+        self._poll_interval = poll_interval
+        self._clock = clock
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.executed = 0
+        self.replayed = 0
+        self.waited = 0
+        self.conflicts = 0
+
+    async def run(
+        self,
+        key: str,
+        fingerprint: str,
+        handler: Callable[[], Awaitable[StoredResponse]]
+    ) -> Tuple[StoredResponse, bool]:
+        """Respuesta de la clave y si es una repetición de una ya ejecutada"""
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.waited += 1
+            inflight_fingerprint, response = await asyncio.shield(inflight)
+            self._check_fingerprint(inflight_fingerprint, fingerprint)
+            self.replayed += 1
+            return response, True
+
+        # Se registra antes del primer await para que un duplicado concurrente lo vea
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response, replayed = await self._execute(key, fingerprint, handler)
+            future.set_result((fingerprint, response))
+            return response, replayed
+        except BaseException as e:
+            future.set_exception(e)
+            # Marcar la excepción como leída aunque no haya duplicados esperando
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+
+    async def replay(self, key: str, fingerprint: str) -> Optional[StoredResponse]:
+        """
+        Respuesta ya obtenida para la clave con la misma huella, sin ejecutar
+        nada: espera a la ejecución en curso y devuelve None si no hay registro,
+        si la huella es otra o si no termina antes de `wait_timeout`.
+        """
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.waited += 1
+            try:
+                inflight_fingerprint, response = await asyncio.shield(inflight)
+            except Exception:
+                return None
+        else:
+            deadline = self._clock() + self._wait_timeout
+            while True:
+                record = await self._store.get(key)
+                if record is None:
+                    return None
+                inflight_fingerprint, response = record["fingerprint"], record["response"]
+                if response is not None or inflight_fingerprint != fingerprint:
+                    break
+                if self._clock() >= deadline:
+                    return None
+                await asyncio.sleep(self._poll_interval)
+        if inflight_fingerprint != fingerprint:
+            return None
+        self.replayed += 1
+        return response
+
+    def _check_fingerprint(self, stored: str, fingerprint: str):
+        if stored != fingerprint:
+            self.conflicts += 1
+            raise IdempotencyConflict()
+
+    async def _execute(self, key, fingerprint, handler) -> Tuple[StoredResponse, bool]:
+        deadline = None
+        while True:
+            record = await self._store.get(key)
+            if record is None:
+                if await self._store.reserve(key, fingerprint):
+                    return await self._run_handler(key, fingerprint, handler), False
+                continue
+            self._check_fingerprint(record["fingerprint"], fingerprint)
+            if record["response"] is not None:
+                self.replayed += 1
+                return record["response"], True
+            # Reservada por otro proceso: esperar a que guarde su respuesta
+            if deadline is None:
+                deadline = self._clock() + self._wait_timeout
+            elif self._clock() >= deadline:
+                raise IdempotencyInProgress()
+            await asyncio.sleep(self._poll_interval)
+
+    async def _run_handler(self, key, fingerprint, handler) -> StoredResponse:
+        try:
+            response = await handler()
+        except BaseException:
+            await self._store.release(key)
+            raise
+        self.executed += 1
+        if response.status_code >= 500:
+            await self._store.release(key)
+        else:
+            await self._store.complete(key, fingerprint, response)
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "executed": self.executed,
+            "replayed": self.replayed,
+            "waited": self.waited,
+            "conflicts": self.conflicts,
+        }
@@ -0,0 +1,52 @@
+# indexes.py - Índices requeridos por la colección de usuarios
+import logging
+
+from pymongo import ASCENDING, IndexModel
+
+# La paginación de GET /usuarios ordena por _id, que MongoDB indexa siempre
+USER_INDEXES = [
+    IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+    IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    # Validación de ETag (If-None-Match) con una consulta cubierta, sin leer el documento
+    IndexModel([("id", ASCENDING), ("version", ASCENDING)], name="id_version"),
+    # Exportación incremental con modified_since y rangos de modified en la búsqueda
+    IndexModel([("modified", ASCENDING)], name="modified"),
+    # Filtros de GET /usuarios: igualdad o prefijo primero y _id al final, para
+    # que la paginación por _id salga ordenada del mismo índice
+    IndexModel([("name", ASCENDING), ("_id", ASCENDING)], name="name_id"),
+    # Índices parciales: solo contienen a los usuarios activos o solo a los
+    # desactivados, y MongoDB los usa cuando la consulta incluye el mismo filtro
+    # sobre isactive. Los activos se listan paginados por _id; los desactivados
+    # son pocos (se archivan) y el archivador los recorre por modified.
+    IndexModel(
+        [("isactive", ASCENDING), ("_id", ASCENDING)], name="active_id",
+        partialFilterExpression={"isactive": True}
+    ),
+    IndexModel(
+        [("modified", ASCENDING)], name="inactive_modified",
+        partialFilterExpression={"isactive": False}
+    ),
+    IndexModel([("created", ASCENDING)], name="created"),
+    IndexModel(
+        [("phones.contrycode", ASCENDING), ("phones.citycode", ASCENDING), ("_id", ASCENDING)],
+        name="phones_contrycode_citycode_id"
+    ),
+    # citycode sin contrycode no puede usar el índice anterior (falta su prefijo)
+    IndexModel([("phones.citycode", ASCENDING), ("_id", ASCENDING)], name="phones_citycode_id"),
+]
+
+
+# Colección users_archive: consulta por id al leer un usuario que ya no existe
+ARCHIVE_INDEXES = [
+    IndexModel([("id", ASCENDING)], name="id_unique", unique=True),
+]
+
+
+async def ensure_indexes(collection, indexes: list = USER_INDEXES) -> list:
+    """
+    Crear los índices declarados si no existen. create_indexes es idempotente
+    cuando la definición no cambia, por lo que se puede ejecutar en cada arranque.
+    """
+    names = await collection.create_indexes(indexes)
+    logging.info("Índices de %s verificados: %s", collection.name, ', '.join(names))
+    return names
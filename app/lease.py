@@ -0,0 +1,57 @@
+# lease.py - Lease para tareas de fondo que debe ejecutar un solo worker entre todos
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from pymongo.errors import DuplicateKeyError
+
+
+def _utcnow() -> datetime:
+    # Sin zona horaria, igual que las fechas leídas desde MongoDB
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class Lease:
+    """
+    Siempre concedido: un único proceso (USER_REPOSITORY=memory) no compite con
+    nadie por la tarea.
+    """
+
+    async def acquire(self, seconds: Optional[float] = None) -> bool:
+        """Tomar o renovar el lease por `seconds` (o su duración por defecto)"""
+        return True
+
+    async def release(self):
+        pass
+
+
+class MongoLease(Lease):
+    """
+    Lease en un documento de la colección `leases` con `_id` = `name`. Lo toma
+    el proceso que lo encuentra vencido (o que ya lo tiene) con un solo
+    find_one_and_update; si otro lo tiene vigente, el upsert choca con el _id y
+    no se concede. Si el dueño muere, otro worker lo toma al vencer `ttl`.
+    """
+
+    def __init__(self, collection, name: str, ttl: float = 120):
+        self._collection = collection
+        self._name = name
+        self._ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    async def acquire(self, seconds: Optional[float] = None) -> bool:
+        now = _utcnow()
+        try:
+            await self._collection.find_one_and_update(
+                {"_id": self._name, "$or": [{"holder": self.holder}, {"expires": {"$lt": now}}]},
+                {"$set": {"holder": self.holder, "expires": now + timedelta(seconds=seconds or self._ttl)}},
+                upsert=True
+            )
+        except DuplicateKeyError:
+            return False
+        return True
+
+    async def release(self):
+        await self._collection.delete_one({"_id": self._name, "holder": self.holder})
@@ -0,0 +1,116 @@
+# logs.py - Logging estructurado en JSON, escrito desde un hilo aparte y con muestreo por ruta
+import atexit
+import itertools
+import logging
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+import orjson
+
+# Atributos propios de LogRecord; el resto llega por `extra` y se emite como campo
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Un objeto JSON por línea con los campos de `extra` al mismo nivel"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "func": record.funcName,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return orjson.dumps(entry, default=str).decode()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Deja pasar 1 de cada N registros INFO/DEBUG emitidos desde la función
+    indicada (el handler de la ruta, ej. {"get_user": 100}). WARNING y superiores
+    nunca se descartan. El contador de cada función es un itertools.count, cuyo
+    next() es atómico bajo el GIL, así que no se necesita lock.
+    """
+
+    def __init__(self, rates: Dict[str, int]):
+        super().__init__()
+        self._rates = {func: rate for func, rate in rates.items() if rate > 1}
+        self._counters = {func: itertools.count() for func in self._rates}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rates.get(record.funcName)
+        if rate is None:
+            return True
+        return next(self._counters[record.funcName]) % rate == 0
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Encola el registro sin formatearlo: el mensaje se arma en el hilo del
+    listener. Si la cola está llena el registro se descarta (y se cuenta) en
+    lugar de bloquear el event loop.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # El traceback no puede esperar: referencia frames que van a cambiar
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(
+    level: str = "INFO",
+    json_format: bool = True,
+    sample_rates: Optional[Dict[str, int]] = None,
+    max_queue: int = 10000
+) -> QueueListener:
+    """
+    Reemplazar los handlers del logger raíz por una cola acotada que un
+    QueueListener vacía a stdout desde un hilo propio. Se detiene al salir del
+    proceso para no perder lo que quede en la cola.
+    """
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if json_format:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter("%(asctime)s:%(levelname)s:%(name)s:%(message)s"))
+
+    log_queue = queue.Queue(maxsize=max_queue)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    if sample_rates:
+        queue_handler.addFilter(SamplingFilter(sample_rates))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
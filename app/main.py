@@ -1,30 +1,324 @@
+import json
 import logging
+import os
+import time
 import uuid
-from datetime import datetime, timezone
-from typing import List
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Awaitable, Callable, List, Optional
 
-from fastapi import FastAPI, HTTPException, status
-from fastapi.responses import JSONResponse
-from pymongo import MongoClient
-from pydantic import BaseModel
+import jwt
+import orjson
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, status
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from pymongo import AsyncMongoClient
+from pydantic import BaseModel, ValidationError
 
+from .archive import UserArchiver
+from .auth import VerifiedTokenCache
+from .bloom import EmailFilter, MongoFilterSnapshot
+from .cache import (
+    ChangeFeedInvalidationBackend,
+    ChangeStreamInvalidationBackend,
+    InMemoryInvalidationBackend,
+    LRUTTLCache
+)
+from .changes import (
+    CREATE,
+    DELETE,
+    UPDATE,
+    ChangeFeed,
+    ChangeFeedExpired,
+    ChangeLogFeed,
+    ChangeStreamFeed,
+    InMemoryChangeFeed
+)
+from .circuit import OPEN, CircuitBreaker, CircuitOpen
+from .config import settings
+from .export import EXPORT_FIELDS, accepts_gzip, csv_chunks, gzip_chunks, ndjson_chunks
+from .hashing import HashingOverloaded, PasswordHasher
+from .lease import Lease, MongoLease
+from .idempotency import (
+    IdempotencyConflict,
+    IdempotencyInProgress,
+    IdempotencyManager,
+    IdempotencyStore,
+    InMemoryIdempotencyStore,
+    MongoIdempotencyStore,
+    StoredResponse,
+    request_fingerprint
+)
+from .health import CachedProbe
+from .logs import setup_logging
+from .metrics import (
+    CommandMetricsListener,
+    MetricsMiddleware,
+    PoolMetricsListener,
+    mark_worker_stopped,
+    observe_circuit_state,
+    observe_password_hash,
+    render as render_metrics
+)
+from .mongo_repository import MongoUserRepository, is_unavailable_error, read_preference
+from .repository import DuplicateEmailError, InMemoryUserRepository, UserRepository, VersionMismatchError
+from .search import UserFilters
+from .serialization import (
+    TOKEN_RESPONSE_FIELDS,
+    dumps,
+    etag_matches,
+    parse_fields,
+    parse_if_match,
+    user_doc_to_wire,
+    user_etag,
+    user_version
+)
+from .write_behind import WriteBehindBuffer
 # Importar funciones y modelos desde utils
 from  .utils import (
+    SECRET_KEY,
     create_access_token, 
+    decode_access_token,
+    decode_cursor,
+    encode_cursor,
     hash_password, 
+    verify_password,
+    LoginRequest,
     Phone, 
     UserRequest, 
     UserUpdateRequest
 )
 
-app = FastAPI()
+# Configuración de logging: cola acotada vaciada desde un hilo aparte
+log_listener = setup_logging(
+    settings.log_level,
+    json_format=settings.log_format == "json",
+    sample_rates=settings.log_sample_rates,
+    max_queue=settings.log_queue_size
+)
+
+# Paginación de GET /usuarios
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+# Sobre este número el conteo con filtros se corta y se informa como aproximado
+COUNT_LIMIT = 10000
+# Eventos por página de GET /usuarios/changes
+DEFAULT_CHANGES_PAGE_SIZE = 100
+# Hash bcrypt (mismo costo que los reales) contra el que se verifica en un login
+# con correo desconocido o inactivo, para que tarde lo mismo que uno registrado
+DUMMY_PASSWORD_HASH = "$2b$12$CccH0Inu3xZUaIQFrniRWOT6ECYOmMH1d9Ck65/HqK.P/8/nl7n.y"
+
+
+def create_user_repository() -> UserRepository:
+    """Motor de persistencia según USER_REPOSITORY ("mongo" o "memory")"""
+    if settings.user_repository == "memory":
+        logging.info("Usando repositorio de usuarios en memoria")
+        return InMemoryUserRepository()
+
+    mongodb_client = AsyncMongoClient(
+        settings.mongo_host,
+        settings.mongo_port,
+        maxPoolSize=settings.mongo_max_pool_size,
+        minPoolSize=settings.mongo_min_pool_size,
+        connectTimeoutMS=settings.mongo_connect_timeout_ms,
+        serverSelectionTimeoutMS=settings.mongo_server_selection_timeout_ms,
+        socketTimeoutMS=settings.mongo_socket_timeout_ms,
+        waitQueueTimeoutMS=settings.mongo_wait_queue_timeout_ms,
+        maxIdleTimeMS=settings.mongo_max_idle_time_ms,
+        timeoutMS=settings.mongo_timeout_ms,
+        event_listeners=[CommandMetricsListener(), PoolMetricsListener()]
+    )
+    return MongoUserRepository(
+        mongodb_client,
+        settings.mongo_database,
+        batch_size=STREAM_BATCH_SIZE,
+        list_read_preference=read_preference(
+            settings.mongo_list_read_preference, settings.mongo_max_staleness_seconds
+        ),
+        breaker=database_breaker if settings.circuit_breaker_enabled else None
+    )
+
+
+# Circuit breaker de MongoDB: con la base caída o lenta se responde 503 de
+# inmediato en lugar de esperar los timeouts del driver en cada request
+database_breaker = CircuitBreaker(
+    failure_rate=settings.circuit_breaker_failure_rate,
+    slow_call_rate=settings.circuit_breaker_slow_call_rate,
+    slow_call_seconds=settings.circuit_breaker_slow_call_seconds,
+    window_size=settings.circuit_breaker_window_size,
+    min_calls=settings.circuit_breaker_min_calls,
+    open_seconds=settings.circuit_breaker_open_seconds,
+    half_open_calls=settings.circuit_breaker_half_open_calls,
+    is_failure=is_unavailable_error,
+    on_state_change=observe_circuit_state
+)
+
+
+# Pool de procesos para bcrypt con cola acotada
+password_hasher = PasswordHasher(
+    hash_password,
+    verify_password,
+    workers=settings.hash_workers,
+    max_queue=settings.hash_max_queue,
+    retry_after=settings.hash_retry_after_seconds,
+    bulk_chunk_size=settings.hash_bulk_chunk_size,
+    on_duration=observe_password_hash
+)
+
+# Cache de usuarios serializados (cuerpo, ETag) para GET /usuarios/{user_id}
+user_cache = LRUTTLCache(settings.user_cache_size, settings.user_cache_ttl_seconds)
+
+# Tokens verificados; cualquier escritura sobre el usuario descarta su token cacheado
+token_cache = VerifiedTokenCache(LRUTTLCache(settings.auth_cache_size, settings.auth_cache_ttl_seconds))
+bearer_scheme = HTTPBearer(auto_error=False)
+
+def create_cache_invalidation(
+    user_repository: UserRepository,
+    change_feed: ChangeFeed
+) -> InMemoryInvalidationBackend:
+    """
+    Invalidación de caches según USER_CACHE_INVALIDATION ("change_feed",
+    "change_stream" o "local"). Con varios workers "local" dejaría en los demás
+    procesos tokens revocados y usuarios desactualizados: no se permite.
+    """
+    if settings.user_cache_invalidation == "local" and settings.web_concurrency > 1:
+        raise RuntimeError(
+            f"USER_CACHE_INVALIDATION=local no invalida entre los {settings.web_concurrency} workers: "
+            "usar change_feed o change_stream"
+        )
+    if settings.user_cache_invalidation == "change_stream" and isinstance(user_repository, MongoUserRepository):
+        backend = ChangeStreamInvalidationBackend(user_repository.collection, user_repository.archive)
+    elif settings.user_cache_invalidation == "change_feed":
+        backend = ChangeFeedInvalidationBackend(change_feed, poll_interval=settings.change_feed_poll_seconds)
+    else:
+        backend = InMemoryInvalidationBackend()
+    backend.subscribe(user_cache.invalidate)
+    backend.subscribe(token_cache.invalidate)
+    return backend
+
+
+def create_idempotency_store(user_repository: UserRepository) -> IdempotencyStore:
+    """
+    Registros de Idempotency-Key según IDEMPOTENCY_STORE ("mongo" o "memory").
+    Con varios workers "memory" dejaría que un reintento atendido por otro
+    worker repita la escritura: no se permite.
+    """
+    if settings.idempotency_store == "memory" and settings.web_concurrency > 1:
+        raise RuntimeError(
+            f"IDEMPOTENCY_STORE=memory no es compartido entre los {settings.web_concurrency} workers: "
+            "usar mongo"
+        )
+    if settings.idempotency_store == "mongo" and isinstance(user_repository, MongoUserRepository):
+        return MongoIdempotencyStore(
+            user_repository.collection.database.idempotency_keys,
+            ttl=settings.idempotency_ttl_seconds
+        )
+    return InMemoryIdempotencyStore(LRUTTLCache(settings.idempotency_max_keys, settings.idempotency_ttl_seconds))
+
+
+def create_lease(user_repository: UserRepository, name: str) -> Lease:
+    """Lease de una tarea de fondo que corre en un solo worker (siempre concedido en memoria)"""
+    if not isinstance(user_repository, MongoUserRepository):
+        return Lease()
+    return MongoLease(user_repository.collection.database.leases, name, ttl=settings.leader_lease_seconds)
+
+
+def create_email_filter_snapshot(user_repository: UserRepository) -> Optional[MongoFilterSnapshot]:
+    """Copia compartida del filtro de correos (sin copia en memoria: un solo proceso)"""
+    if not isinstance(user_repository, MongoUserRepository):
+        return None
+    return MongoFilterSnapshot(user_repository.collection.database.email_filter)
+
+
+def create_change_feed(user_repository: UserRepository) -> ChangeFeed:
+    """Feed de cambios según CHANGE_FEED ("log" o "change_stream")"""
+    if not isinstance(user_repository, MongoUserRepository):
+        return InMemoryChangeFeed(user_doc_to_wire, maxlen=settings.change_feed_memory_size)
+    if settings.change_feed == "change_stream":
+        return ChangeStreamFeed(user_repository.collection, user_doc_to_wire)
+    database = user_repository.collection.database
+    return ChangeLogFeed(
+        database.user_changes,
+        user_doc_to_wire,
+        retention=timedelta(days=settings.change_feed_retention_days),
+        counters=database.counters,
+        gap_timeout=timedelta(seconds=settings.change_feed_gap_seconds)
+    )
+
+
+# Ping a la base para /ready, cacheado entre sondeos
+readiness = CachedProbe(
+    lambda: app.state.user_repository.ping(),
+    ttl=settings.ready_cache_seconds,
+    timeout=settings.ready_timeout_seconds
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Lo que depende del cliente de MongoDB se crea aquí, en cada worker, y se
+    guarda en app.state: el cliente no es fork-safe y no debe existir antes de
+    que el servidor haga fork
+    """
+    state = app.state
+    state.user_repository = user_repository = create_user_repository()
+    # Altas, modificaciones y bajas en orden para servicios que hoy sondean GET /usuarios
+    state.change_feed = create_change_feed(user_repository)
+    state.cache_invalidation = create_cache_invalidation(user_repository, state.change_feed)
+    # last_login se escribe en diferido y agrupado por usuario
+    state.activity_buffer = WriteBehindBuffer(
+        user_repository.touch_many,
+        max_pending=settings.write_behind_max_pending,
+        flush_interval=settings.write_behind_flush_seconds
+    )
+    # Sin iniciar (EMAIL_FILTER_ENABLED=false) nunca descarta una consulta
+    state.email_filter = EmailFilter(
+        user_repository.iterate_emails,
+        capacity=settings.email_filter_capacity,
+        error_rate=settings.email_filter_error_rate,
+        rebuild_interval=settings.email_filter_rebuild_seconds,
+        # Un solo worker recorre los correos; los demás cargan la copia que publica
+        lease=create_lease(user_repository, "email_filter"),
+        snapshot=create_email_filter_snapshot(user_repository),
+        sync_interval=settings.email_filter_sync_seconds
+    )
+    state.archiver = UserArchiver(
+        user_repository.archive_inactive,
+        timedelta(days=settings.archive_after_days),
+        batch_size=settings.archive_batch_size,
+        batch_pause=settings.archive_batch_pause_seconds,
+        interval=settings.archive_interval_seconds,
+        on_archived=_invalidate_archived,
+        lease=create_lease(user_repository, "archiver")
+    )
+    # Reintentos con Idempotency-Key reciben la respuesta original sin repetir bcrypt ni escrituras
+    idempotency_store = create_idempotency_store(user_repository)
+    state.idempotency = IdempotencyManager(idempotency_store, wait_timeout=settings.idempotency_wait_seconds)
+
+    await user_repository.ensure_indexes()
+    await state.change_feed.ensure_indexes()
+    await idempotency_store.ensure_indexes()
+    await state.cache_invalidation.start()
+    await state.activity_buffer.start()
+    if settings.email_filter_enabled:
+        await state.email_filter.start()
+    if settings.archive_enabled:
+        await state.archiver.start()
+    yield
+    # El servidor ya dejó de aceptar conexiones y esperó los requests en curso
+    await state.archiver.stop()
+    await state.email_filter.stop()
+    await state.activity_buffer.stop()
+    await state.cache_invalidation.stop()
+    password_hasher.shutdown()
+    await user_repository.close()
+    mark_worker_stopped()
 
-# Configuración de logging
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
 
-# Cliente MongoDB como singleton
-mongodb_client = MongoClient("users_service_mongodb", 27017)
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
 
 
 class UserResponse(BaseModel):
@@ -35,10 +329,34 @@ class UserResponse(BaseModel):
     created: datetime
     modified: datetime
     last_login: datetime
-    token: str
     isactive: bool
 
 
+class UserTokenResponse(UserResponse):
+    """Respuesta al propio usuario (registro, login y sus modificaciones), con su token"""
+    token: str
+
+
+class UserPage(BaseModel):
+    usuarios: List[UserResponse]
+    next_cursor: Optional[str] = None
+    total: Optional[int] = None
+    total_aproximado: Optional[bool] = None
+
+
+class BulkUserResult(BaseModel):
+    index: int
+    id: Optional[str] = None
+    token: Optional[str] = None
+    error: Optional[str] = None
+
+
+class BulkUserResponse(BaseModel):
+    creados: int
+    errores: int
+    resultados: List[BulkUserResult]
+
+
 class MessageResponse(BaseModel):
     mensaje: str
 
@@ -47,10 +365,16 @@ class MessageResponse(BaseModel):
 async def http_exception_handler(request, exc):
     return JSONResponse(
         status_code=exc.status_code,
-        content={"mensaje": exc.detail}
+        content={"mensaje": exc.detail},
+        headers=getattr(exc, "headers", None)
     )
 
 
+@app.exception_handler(CircuitOpen)
+async def circuit_open_handler(request, exc):
+    return await http_exception_handler(request, _circuit_open_error(exc))
+
+
 @app.exception_handler(ValueError)
 async def value_error_handler(request, exc):
     return JSONResponse(
@@ -65,84 +389,608 @@ async def root():
     return {"mensaje": "API de gestión usuarios funcionando"}
 
 
-@app.get("/usuarios", response_model=List[UserResponse])
-def get_users():
+def _overloaded_error(exc: HashingOverloaded) -> HTTPException:
+    logging.warning("Cola de hashing llena, rechazando request")
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Servicio sobrecargado, intente nuevamente",
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+def _circuit_open_error(exc: CircuitOpen) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Base de datos no disponible, intente nuevamente",
+        headers={"Retry-After": str(exc.retry_after)}
+    )
+
+
+def _server_error(exc: Exception, message: str) -> HTTPException:
     """
-    Obtener todos los usuarios
+    500 genérico, salvo que la base no esté disponible (circuito abierto, red o
+    timeout): entonces 503, para que el cliente reintente más tarde
     """
-    logging.info("Obteniendo todos los usuarios")
+    if isinstance(exc, CircuitOpen):
+        return _circuit_open_error(exc)
+    logging.error("%s: %s", message, exc)
+    if is_unavailable_error(exc):
+        return HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Base de datos no disponible, intente nuevamente"
+        )
+    return HTTPException(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        detail="Error interno del servidor"
+    )
+
+
+async def require_database():
+    """
+    Rechazar con 503 antes de hacer trabajo caro (bcrypt) si el circuito de la
+    base está abierto: la escritura posterior fallaría igual
+    """
+    if database_breaker.state == OPEN:
+        raise CircuitOpen(database_breaker.retry_after)
+
+
+async def _hash_password(password: str) -> str:
+    """Hash en el pool de procesos; si la cola está llena responde 503 con Retry-After"""
     try:
-        users = []
-        for user_doc in mongodb_client.users_service.users.find():
-            user_response = UserResponse(
-                id=user_doc["id"],
-                name=user_doc["name"],
-                email=user_doc["email"],
-                phones=[Phone(**phone) for phone in user_doc["phones"]],
-                created=user_doc["created"],
-                modified=user_doc["modified"],
-                last_login=user_doc["last_login"],
-                token=user_doc["token"],
-                isactive=user_doc["isactive"]
-            )
-            users.append(user_response)
-        return users
+        return await password_hasher.hash(password)
+    except HashingOverloaded as exc:
+        raise _overloaded_error(exc)
+
+
+async def _verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verificación en el pool de procesos, con el mismo control de admisión que el hash"""
+    try:
+        return await password_hasher.verify(plain_password, hashed_password)
+    except HashingOverloaded as exc:
+        raise _overloaded_error(exc)
+
+
+def _issue_token(user_id: str, email: Optional[str]) -> str:
+    """JWT con expiración según ACCESS_TOKEN_EXPIRE_MINUTES"""
+    token_data = {"user_id": user_id}
+    if email is not None:
+        token_data["email"] = email
+    return create_access_token(token_data, timedelta(minutes=settings.access_token_expire_minutes))
+
+
+def _unauthorized(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"}
+    )
+
+
+async def require_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)
+) -> dict:
+    """
+    Dependencia de autenticación. El token debe tener firma y exp válidos y ser
+    el vigente de un usuario activo; el resultado se cachea hasta su expiración.
+    """
+    if credentials is None:
+        raise _unauthorized("Token requerido")
+    token = credentials.credentials
+    claims = token_cache.get(token)
+    if claims is not None:
+        return claims
+
+    generation = token_cache.generation
+    try:
+        claims = decode_access_token(token)
+    except jwt.PyJWTError:
+        raise _unauthorized("Token inválido o expirado")
+    user_doc = await app.state.user_repository.get(claims["user_id"], fields=("isactive", "token"))
+    if not user_doc or not user_doc["isactive"] or user_doc["token"] != token:
+        raise _unauthorized("Token inválido o expirado")
+    token_cache.set(token, claims, generation)
+    return claims
+
+
+def _token_owner(credentials: Optional[HTTPAuthorizationCredentials]) -> Optional[str]:
+    """user_id de un JWT con firma y exp válidos, aunque ya no sea el vigente"""
+    if credentials is None:
+        return None
+    try:
+        return decode_access_token(credentials.credentials)["user_id"]
+    except jwt.PyJWTError:
+        return None
+
+
+def _require_self(claims: dict, user_id: str):
+    """Solo el propio usuario puede modificar o eliminar su cuenta"""
+    if claims["user_id"] != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="No autorizado para modificar este usuario"
+        )
+
+
+async def _record_change(operation: str, user_id: str, user_doc: Optional[dict] = None):
+    """
+    Agregar el cambio al feed. La escritura del usuario ya se hizo, así que un
+    error aquí se registra en el log pero no hace fallar la solicitud.
+    """
+    try:
+        await app.state.change_feed.record(operation, user_id, user_doc)
     except Exception as e:
-        logging.error(f"Error al obtener usuarios: {str(e)}")
+        logging.error("Error al registrar cambio %s de %s en el feed: %s", operation, user_id, e)
+
+
+async def _invalidate_archived(user_ids: List[str]):
+    for user_id in user_ids:
+        await _invalidate_user(user_id)
+
+
+async def _invalidate_user(user_id: str):
+    """Invalidar el usuario en el cache local y en las demás réplicas"""
+    await app.state.cache_invalidation.publish(user_id)
+
+
+def _to_user_response(user_doc: dict, include_token: bool = False) -> UserResponse:
+    """Construir la respuesta pública (con el token, solo para su dueño) a partir del documento de MongoDB"""
+    values = dict(
+        id=user_doc["id"],
+        name=user_doc["name"],
+        email=user_doc["email"],
+        phones=[Phone(**phone) for phone in user_doc["phones"]],
+        created=user_doc["created"],
+        modified=user_doc["modified"],
+        last_login=user_doc["last_login"],
+        isactive=user_doc["isactive"]
+    )
+    if include_token:
+        return UserTokenResponse(token=user_doc["token"], **values)
+    return UserResponse(**values)
+
+
+def _user_wire(user_doc: dict, fields: Optional[tuple] = None, include_token: bool = False):
+    """
+    Forma serializable del usuario. Por defecto se mapea el documento directo a
+    dict (sin pydantic); con VALIDATE_RESPONSES se construye y valida UserResponse
+    (solo para respuestas completas, sin `fields`). El token solo se incluye con
+    `include_token`.
+    """
+    if settings.validate_responses and fields is None:
+        return _to_user_response(user_doc, include_token).model_dump(mode="json")
+    if include_token and fields is None:
+        fields = TOKEN_RESPONSE_FIELDS
+    return user_doc_to_wire(user_doc, fields)
+
+
+def _json_response(content, status_code: int = status.HTTP_200_OK, headers: Optional[dict] = None) -> Response:
+    """
+    Respuesta ya serializada con orjson. Al devolver un Response, FastAPI no vuelve
+    a validar el contenido contra response_model.
+    """
+    return Response(content=dumps(content), status_code=status_code, media_type="application/json",
+                    headers=headers)
+
+
+def _user_json_response(user_doc: dict, fields: Optional[tuple] = None,
+                        status_code: int = status.HTTP_200_OK, include_token: bool = False) -> Response:
+    """Usuario serializado con su ETag"""
+    return _json_response(_user_wire(user_doc, fields, include_token), status_code,
+                          headers={"ETag": user_etag(user_version(user_doc))})
+
+
+async def _stored_response(handler: Callable[[], Awaitable[Response]]) -> StoredResponse:
+    """Ejecutar el handler y capturar su respuesta, incluidos los errores HTTP"""
+    try:
+        response = await handler()
+    except HTTPException as exc:
+        return StoredResponse(exc.status_code, dumps({"mensaje": exc.detail}), dict(exc.headers or {}))
+    headers = {name: value for name, value in response.headers.items() if name in ("etag", "retry-after")}
+    return StoredResponse(response.status_code, response.body, headers)
+
+
+async def _idempotent(idempotency_key: Optional[str], scope: str, fingerprint: str,
+                      handler: Callable[[], Awaitable[Response]]) -> Response:
+    """
+    Con Idempotency-Key el handler se ejecuta una sola vez por clave y ruta; los
+    reintentos reciben la misma respuesta con el header Idempotent-Replayed.
+    """
+    if idempotency_key is None:
+        return await handler()
+    try:
+        stored, replayed = await app.state.idempotency.run(
+            f"{scope} {idempotency_key}", fingerprint, lambda: _stored_response(handler)
+        )
+    except IdempotencyConflict:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Error interno del servidor"
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="La Idempotency-Key ya se usó con otra solicitud"
         )
+    except IdempotencyInProgress:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Hay una solicitud en curso con la misma Idempotency-Key"
+        )
+    return _from_stored(stored, replayed)
+
+
+def _from_stored(stored: StoredResponse, replayed: bool) -> Response:
+    headers = dict(stored.headers)
+    if replayed:
+        headers["Idempotent-Replayed"] = "true"
+    return Response(content=stored.body, status_code=stored.status_code,
+                    media_type="application/json", headers=headers)
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+
+def _precondition_failed() -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_412_PRECONDITION_FAILED,
+        detail="El usuario fue modificado por otra solicitud"
+    )
+
+
+async def _stream_users(user_docs: AsyncIterator[dict], fields: Optional[tuple] = None) -> AsyncIterator[bytes]:
+    """Emitir cada usuario como una línea NDJSON a medida que sale del cursor"""
+    async for user_doc in user_docs:
+        yield dumps(_user_wire(user_doc, fields)) + b"\n"
+
+
+@app.get("/usuarios", response_model=UserPage, dependencies=[Depends(require_user)])
+async def get_users(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    filters: UserFilters = Depends(),
+    count: bool = False,
+    explain: bool = False,
+    fields: Optional[str] = None
+):
+    """
+    Obtener usuarios paginados por cursor (orden por _id), opcionalmente filtrados.
+    Con fields=id,name,email solo se leen y devuelven esos campos.
+    Con stream=true se envían como NDJSON directamente desde el cursor de MongoDB.
+    Con count=true se agrega el total (aproximado sin filtros o sobre COUNT_LIMIT)
+    y con explain=true se devuelve el plan de ejecución en lugar de los usuarios.
+    """
+    logging.info("Obteniendo usuarios")
+    after = decode_cursor(cursor) if cursor is not None else None
+    filters = None if filters.is_empty() else filters
+    projection = parse_fields(fields)
+    page_size = limit or DEFAULT_PAGE_SIZE
+
+    try:
+        if explain:
+            return _json_response(await app.state.user_repository.explain(after, page_size + 1, filters))
+
+        if stream:
+            return StreamingResponse(
+                _stream_users(
+                    app.state.user_repository.iterate(after=after, limit=limit, fields=projection, filters=filters),
+                    projection
+                ),
+                media_type="application/x-ndjson"
+            )
+
+        # Se pide un documento extra para saber si existe una página siguiente
+        docs = await app.state.user_repository.list_page(after, page_size + 1, filters, projection)
+        next_cursor = None
+        if len(docs) > page_size:
+            docs = docs[:page_size]
+            next_cursor = encode_cursor(docs[-1]["_id"])
+
+        page = {
+            "usuarios": [_user_wire(user_doc, projection) for user_doc in docs],
+            "next_cursor": next_cursor
+        }
+        if count:
+            page["total"], page["total_aproximado"] = await app.state.user_repository.count(filters, COUNT_LIMIT)
+        return _json_response(page)
+    except Exception as e:
+        raise _server_error(e, "Error al obtener usuarios")
+
+
+@app.get("/usuarios/export", dependencies=[Depends(require_user), Depends(require_database)])
+async def export_users(
+    request: Request,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    modified_since: Optional[datetime] = None
+):
+    """
+    Exportar usuarios en streaming como NDJSON o CSV (sin password ni token).
+    Con modified_since solo se exportan los modificados desde esa fecha.
+    Se comprime en gzip si el Accept-Encoding del cliente lo admite (q > 0).
+    """
+    logging.info("Exportando usuarios en formato %s", format)
+    user_docs = app.state.user_repository.iterate(fields=EXPORT_FIELDS, modified_since=modified_since)
+    if format == "csv":
+        chunks = csv_chunks(user_docs)
+        media_type = "text/csv"
+    else:
+        chunks = ndjson_chunks(user_docs)
+        media_type = "application/x-ndjson"
+
+    # La respuesta depende de Accept-Encoding: un cache intermedio no debe mezclarlas
+    headers = {"Content-Disposition": f"attachment; filename=usuarios.{format}", "Vary": "Accept-Encoding"}
+    if accepts_gzip(request.headers.get("accept-encoding")):
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+
+def _changes_gone(exc: ChangeFeedExpired) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_410_GONE,
+        detail="El token ya no está disponible, se debe volver a sincronizar con GET /usuarios"
+    )
+
+
+def _sse_message(event: dict) -> bytes:
+    return (
+        f"id: {event['token']}\nevent: {event['operacion']}\ndata: ".encode()
+        + dumps(event) + b"\n\n"
+    )
+
+
+async def _stream_changes(since: Optional[str]) -> AsyncIterator[bytes]:
+    """
+    Eventos SSE a medida que ocurren, con un comentario keepalive si no hay
+    cambios. Si el feed falla se envía un evento `error` y se cierra el stream:
+    los encabezados ya salieron y no se puede responder 503.
+    """
+    idle = 0.0
+    try:
+        async for event in app.state.change_feed.follow(since, settings.change_feed_poll_seconds):
+            if event is not None:
+                idle = 0.0
+                yield _sse_message(event)
+                continue
+            idle += settings.change_feed_poll_seconds
+            if idle >= settings.change_feed_keepalive_seconds:
+                idle = 0.0
+                yield b": keepalive\n\n"
+    except ChangeFeedExpired:
+        yield b"event: expired\ndata: {}\n\n"
+    except Exception as e:
+        error = _server_error(e, "Error al leer el feed de cambios")
+        yield b"event: error\ndata: " + dumps({"mensaje": error.detail}) + b"\n\n"
+
+
+@app.get("/usuarios/changes", dependencies=[Depends(require_user)])
+async def get_user_changes(
+    since: Optional[str] = None,
+    limit: int = Query(DEFAULT_CHANGES_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+):
+    """
+    Altas, modificaciones y bajas (create, update, delete) posteriores a `since`,
+    en orden. Se continúa pasando `next_token` como `since`; sin `since` se lee
+    desde el inicio de lo conservado (o desde ahora con change streams).
+    Si el token ya no se conserva responde 410 y se debe resincronizar.
+    """
+    try:
+        events, next_token = await app.state.change_feed.read(since, limit)
+    except ChangeFeedExpired as exc:
+        raise _changes_gone(exc)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise _server_error(e, "Error al obtener cambios")
+    return _json_response({"cambios": events, "next_token": next_token})
+
+
+@app.get("/usuarios/changes/stream", dependencies=[Depends(require_user)])
+async def stream_user_changes(
+    since: Optional[str] = None,
+    last_event_id: Optional[str] = Header(None)
+):
+    """
+    Variante Server-Sent Events de GET /usuarios/changes. Cada evento lleva su
+    token como `id`, por lo que al reconectar el cliente SSE reanuda solo con
+    Last-Event-ID.
+    """
+    since = last_event_id or since
+    try:
+        await app.state.change_feed.validate(since)
+    except ChangeFeedExpired as exc:
+        raise _changes_gone(exc)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise _server_error(e, "Error al obtener cambios")
+    return StreamingResponse(
+        _stream_changes(since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+def _worker_stats(stats: dict) -> dict:
+    """
+    Los contadores de las rutas /stats son del worker que atiende el request: con
+    WEB_CONCURRENCY > 1 cada llamada puede venir de otro proceso, por eso se
+    indica su pid. Las métricas agregadas entre workers están en /metrics.
+    """
+    return {"worker_pid": os.getpid(), **stats}
+
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """
+    Contadores del cache de usuarios
+    """
+    return _worker_stats(user_cache.stats())
+
+
+@app.get("/write-behind/stats")
+async def get_write_behind_stats():
+    """
+    Marcas de last_login recibidas, fusionadas en memoria y escritas
+    """
+    return _worker_stats(app.state.activity_buffer.stats())
+
+
+@app.get("/email-filter/stats")
+async def get_email_filter_stats():
+    """
+    Tamaño, memoria y tasa de falsos positivos (esperada y observada) del filtro de correos
+    """
+    return _worker_stats(app.state.email_filter.stats())
+
+
+@app.get("/idempotency/stats")
+async def get_idempotency_stats():
+    """
+    Solicitudes con Idempotency-Key ejecutadas, repetidas desde el store y en espera
+    """
+    return _worker_stats(app.state.idempotency.stats())
 
 
-@app.get("/usuarios/{user_id}", response_model=UserResponse)
-def get_user(user_id: str):
+@app.get("/circuit-breaker/stats")
+async def get_circuit_breaker_stats():
     """
-    Obtener un usuario específico por ID
+    Estado del circuito de MongoDB y tasas de fallos y de llamadas lentas de la ventana actual
     """
-    logging.info(f"Obteniendo usuario: {user_id}")
+    return _worker_stats(database_breaker.stats())
+
+
+@app.get("/archive/stats")
+async def get_archive_stats():
+    """
+    Pasadas, lotes y usuarios movidos a users_archive
+    """
+    return _worker_stats(app.state.archiver.stats())
+
+
+@app.get("/health", include_in_schema=False)
+async def get_health():
+    """
+    Liveness: el proceso atiende requests (no consulta la base)
+    """
+    return {"status": "ok"}
+
+
+@app.get("/ready", include_in_schema=False)
+async def get_ready():
+    """
+    Readiness: la base responde a un ping (cacheado por READY_CACHE_SECONDS)
+    """
+    if await readiness():
+        return {"status": "ready"}
+    logging.warning("Servicio no disponible: %s", readiness.error)
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"status": "unavailable"})
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """
+    Métricas en formato Prometheus
+    """
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/usuarios/{user_id}", response_model=UserResponse, dependencies=[Depends(require_user)])
+async def get_user(
+    user_id: str,
+    fields: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None)
+):
+    """
+    Obtener un usuario específico por ID (con cache de lectura).
+    Con fields=id,name,email solo se leen y devuelven esos campos.
+    Con If-None-Match responde 304 si el ETag no cambió, desde el cache o desde
+    el índice {id, version}, sin leer el documento.
+    """
+    logging.info("Obteniendo usuario: %s", user_id)
+    projection = parse_fields(fields)
+    cached = user_cache.get(user_id)
+    if cached is not None:
+        body, etag = cached
+        if if_none_match is not None and etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+        if projection is not None:
+            body = dumps({field: value for field, value in orjson.loads(body).items() if field in projection})
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
     try:
-        user_doc = mongodb_client.users_service.users.find_one({"id": user_id})
+        if if_none_match is not None:
+            version = await app.state.user_repository.get_version(user_id)
+            if version is not None and etag_matches(if_none_match, user_etag(version)):
+                return _not_modified(user_etag(version))
+
+        generation = user_cache.generation
+        # Sin proyección se lee completo para poder cachear; version es necesaria para el ETag
+        user_doc = await app.state.user_repository.get(
+            user_id, fields=None if projection is None else projection + ("version",)
+        )
         if not user_doc:
+            # Sigue siendo 404; el detalle distingue a los eliminados que ya se archivaron
+            archived = await app.state.user_repository.is_archived(user_id)
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
-                detail="Usuario no encontrado"
+                detail="Usuario archivado" if archived else "Usuario no encontrado"
             )
-        
-        return UserResponse(
-            id=user_doc["id"],
-            name=user_doc["name"],
-            email=user_doc["email"],
-            phones=[Phone(**phone) for phone in user_doc["phones"]],
-            created=user_doc["created"],
-            modified=user_doc["modified"],
-            last_login=user_doc["last_login"],
-            token=user_doc["token"],
-            isactive=user_doc["isactive"]
-        )
+
+        # El cache guarda solo respuestas completas; una proyección no se cachea
+        if projection is not None:
+            return _user_json_response(user_doc, projection)
+
+        body = dumps(_user_wire(user_doc))
+        etag = user_etag(user_version(user_doc))
+        user_cache.set(user_id, (body, etag), generation)
+        return Response(content=body, media_type="application/json", headers={"ETag": etag})
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error al obtener usuario: {str(e)}")
+        raise _server_error(e, "Error al obtener usuario")
+
+async def _apply_user_update(user_id: str, update_doc: dict, if_match: Optional[str] = None) -> dict:
+    """
+    Aplicar la actualización de forma atómica y devolver el documento ya actualizado.
+    La unicidad del correo la garantiza el índice único sobre email. Con If-Match
+    la escritura es condicional a `version` y un cambio concurrente responde 412.
+    """
+    expected_versions = parse_if_match(if_match) if if_match is not None else None
+    try:
+        updated_user = await app.state.user_repository.update(user_id, update_doc, expected_versions)
+    except VersionMismatchError:
+        raise _precondition_failed()
+    except DuplicateEmailError:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Error interno del servidor"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El correo ya registrado"
         )
+    if not updated_user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Usuario no encontrado"
+        )
+    await _invalidate_user(user_id)
+    await _record_change(UPDATE, user_id, updated_user)
+    if "email" in update_doc:
+        app.state.email_filter.add(update_doc["email"])
+    return updated_user
+
 
-@app.patch("/usuarios/{user_id}", response_model=UserResponse)
-def partial_update_user(user_id: str, user_update: UserUpdateRequest):
+@app.patch("/usuarios/{user_id}", response_model=UserTokenResponse,
+           dependencies=[Depends(require_database)])
+async def partial_update_user(
+    user_id: str,
+    user_update: UserUpdateRequest,
+    if_match: Optional[str] = Header(None),
+    claims: dict = Depends(require_user)
+):
     """
-    Actualizar parcialmente un usuario (solo los campos enviados)
+    Actualizar parcialmente un usuario (solo los campos enviados).
+    Solo el propio usuario (403 si no).
     """
-    logging.info(f"Actualizando parcialmente usuario: {user_id}")
+    logging.info("Actualizando parcialmente usuario: %s", user_id)
+    _require_self(claims, user_id)
     try:
-        existing_user = mongodb_client.users_service.users.find_one({"id": user_id})
-        if not existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Usuario no encontrado"
-            )
-        
         # Prepara documento de actualización solo con campos enviados
         update_doc = {}
         
@@ -150,86 +998,83 @@ def partial_update_user(user_id: str, user_update: UserUpdateRequest):
             update_doc["name"] = user_update.name
             
         if user_update.email is not None:
-            # Verifica si el nuevo email ya existe en otro usuario
-            if user_update.email != existing_user["email"]:
-                email_exists = mongodb_client.users_service.users.find_one({
-                    "email": user_update.email,
-                    "id": {"$ne": user_id}
-                })
-                if email_exists:
-                    raise HTTPException(
-                        status_code=status.HTTP_400_BAD_REQUEST,
-                        detail="El correo ya registrado"
-                    )
             update_doc["email"] = user_update.email
             
         if user_update.password is not None:
-            update_doc["password"] = hash_password(user_update.password)
+            update_doc["password"] = await _hash_password(user_update.password)
+            # Con la nueva contraseña se emite otro token y el anterior deja de valer.
+            # El claim email es el correo que queda guardado: el nuevo o el actual
+            email = user_update.email
+            if email is None:
+                stored = await app.state.user_repository.get(user_id, fields=("email",))
+                if not stored:
+                    raise HTTPException(
+                        status_code=status.HTTP_404_NOT_FOUND,
+                        detail="Usuario no encontrado"
+                    )
+                email = stored["email"]
+            update_doc["token"] = _issue_token(user_id, email)
             
         if user_update.phones is not None:
             update_doc["phones"] = [phone.model_dump() for phone in user_update.phones]
         
-        # Solo actualizar si hay campos para actualizar
+        # Sin campos para actualizar solo se lee el usuario
         if update_doc:
             update_doc["modified"] = datetime.now(timezone.utc)
-            
-            mongodb_client.users_service.users.update_one(
-                {"id": user_id},
-                {"$set": update_doc}
-            )
+            updated_user = await _apply_user_update(user_id, update_doc, if_match)
+        else:
+            updated_user = await app.state.user_repository.get(user_id)
+            if not updated_user:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Usuario no encontrado"
+                )
+            expected_versions = parse_if_match(if_match) if if_match is not None else None
+            if expected_versions is not None and user_version(updated_user) not in expected_versions:
+                raise _precondition_failed()
         
-        # Obtener usuario actualizado
-        updated_user = mongodb_client.users_service.users.find_one({"id": user_id})
-        
-        return UserResponse(
-            id=updated_user["id"],
-            name=updated_user["name"],
-            email=updated_user["email"],
-            phones=[Phone(**phone) for phone in updated_user["phones"]],
-            created=updated_user["created"],
-            modified=updated_user["modified"],
-            last_login=updated_user["last_login"],
-            token=updated_user["token"],
-            isactive=updated_user["isactive"]
-        )
+        return _user_json_response(updated_user, include_token=True)
         
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error al actualizar usuario: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Error interno del servidor"
-        )
+        raise _server_error(e, "Error al actualizar usuario")
 
-@app.put("/usuarios/{user_id}", response_model=UserResponse)
-def update_user(user_id: str, user_request: UserRequest):
+@app.put("/usuarios/{user_id}", response_model=UserTokenResponse,
+         dependencies=[Depends(require_database)])
+async def update_user(
+    user_id: str,
+    user_request: UserRequest,
+    if_match: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None),
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme)
+):
     """
-    Actualizar un usuario existente
+    Actualizar un usuario existente. Solo el propio usuario (403 si no).
+    Con Idempotency-Key un reintento devuelve la respuesta original sin repetir el hash.
+    Como la contraseña cambia se emite otro token, y el reintento llega con el
+    anterior: la respuesta guardada se busca antes de exigir el token vigente,
+    con un JWT válido del mismo usuario y el mismo cuerpo (contraseña incluida).
     """
-    logging.info(f"Actualizando usuario: {user_id}")
+    logging.info("Actualizando usuario: %s", user_id)
+    scope = f"PUT /usuarios/{user_id}"
+    fingerprint = request_fingerprint(user_request.model_dump(mode="json"), if_match, secret=SECRET_KEY)
+    if idempotency_key is not None and _token_owner(credentials) == user_id:
+        stored = await app.state.idempotency.replay(f"{scope} {idempotency_key}", fingerprint)
+        if stored is not None:
+            return _from_stored(stored, replayed=True)
+    claims = await require_user(credentials)
+    _require_self(claims, user_id)
+    return await _idempotent(
+        idempotency_key, scope, fingerprint,
+        lambda: _replace_user(user_id, user_request, if_match)
+    )
+
+
+async def _replace_user(user_id: str, user_request: UserRequest, if_match: Optional[str]) -> Response:
     try:
-        existing_user = mongodb_client.users_service.users.find_one({"id": user_id})
-        if not existing_user:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Usuario no encontrado"
-            )
-        
-        # Verificar si el nuevo email ya existe en otro usuario
-        if user_request.email != existing_user["email"]:
-            email_exists = mongodb_client.users_service.users.find_one({
-                "email": user_request.email,
-                "id": {"$ne": user_id}
-            })
-            if email_exists:
-                raise HTTPException(
-                    status_code=status.HTTP_400_BAD_REQUEST,
-                    detail="El correo ya registrado"
-                )
-        
         now = datetime.now(timezone.utc)
-        hashed_password = hash_password(user_request.password)
+        hashed_password = await _hash_password(user_request.password)
         
         # Actualizar usuario
         update_doc = {
@@ -237,134 +1082,291 @@ def update_user(user_id: str, user_request: UserRequest):
             "email": user_request.email,
             "password": hashed_password,
             "phones": [phone.model_dump() for phone in user_request.phones],
-            "modified": now
+            "modified": now,
+            # Cambia la contraseña: se emite otro token y el anterior deja de valer
+            "token": _issue_token(user_id, user_request.email)
         }
 
-        mongodb_client.users_service.users.update_one(
-            {"id": user_id},
-            {"$set": update_doc}
-        )
-        
-        # Obtener usuario actualizado
-        updated_user = mongodb_client.users_service.users.find_one({"id": user_id})
-
-        return UserResponse(
-            id=updated_user["id"],
-            name=updated_user["name"],
-            email=updated_user["email"],
-            phones=[Phone(**phone) for phone in updated_user["phones"]],
-            created=updated_user["created"],
-            modified=updated_user["modified"],
-            last_login=updated_user["last_login"],
-            token=updated_user["token"],
-            isactive=updated_user["isactive"]
-        )
+        updated_user = await _apply_user_update(user_id, update_doc, if_match)
+
+        return _user_json_response(updated_user, include_token=True)
         
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error al actualizar usuario: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Error interno del servidor"
-        )
+        raise _server_error(e, "Error al actualizar usuario")
 
 
 @app.delete("/usuarios/{user_id}")
-def delete_user(user_id: str):
+async def delete_user(
+    user_id: str,
+    if_match: Optional[str] = Header(None),
+    claims: dict = Depends(require_user)
+):
     """
-    Eliminar un usuario (soft delete - marcar como inactivo)
+    Eliminar un usuario (soft delete - marcar como inactivo). Solo el propio
+    usuario (403 si no). Con If-Match solo se elimina si el ETag sigue vigente (412 si no).
     """
-    logging.info(f"Eliminando usuario: {user_id}")
+    logging.info("Eliminando usuario: %s", user_id)
+    _require_self(claims, user_id)
     try:
-        existing_user = mongodb_client.users_service.users.find_one({"id": user_id})
-        if not existing_user:
+        # Soft delete - marcar como inactivo
+        expected_versions = parse_if_match(if_match) if if_match is not None else None
+        try:
+            deactivated = await app.state.user_repository.deactivate(
+                user_id, datetime.now(timezone.utc), expected_versions
+            )
+        except VersionMismatchError:
+            raise _precondition_failed()
+        if not deactivated:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="Usuario no encontrado"
             )
-        
-        # Soft delete - marcar como inactivo
-        mongodb_client.users_service.users.update_one(
-            {"id": user_id},
-            {"$set": {"isactive": False, "modified": datetime.now(timezone.utc)}}
-        )
+        await _invalidate_user(user_id)
+        await _record_change(DELETE, user_id)
         
         return {"mensaje": "Usuario eliminado correctamente"}
         
     except HTTPException:
         raise
     except Exception as e:
-        logging.error(f"Error al eliminar usuario: {str(e)}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Error interno del servidor"
-        )
+        raise _server_error(e, "Error al eliminar usuario")
+
+
+def _build_user_doc(user_id: str, user_request: UserRequest, hashed_password: str,
+                    access_token: str, now: datetime) -> dict:
+    """Documento de MongoDB para un usuario nuevo"""
+    return {
+        "id": user_id,
+        "name": user_request.name,
+        "email": user_request.email,
+        "password": hashed_password,
+        "phones": [phone.model_dump() for phone in user_request.phones],
+        "created": now,
+        "modified": now,
+        "last_login": now,
+        "token": access_token,
+        "isactive": True,
+        "version": 1
+    }
 
 
-@app.post("/usuarios", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-def create_user(user_request: UserRequest):
+@app.post("/usuarios", response_model=UserTokenResponse, status_code=status.HTTP_201_CREATED,
+          dependencies=[Depends(require_database)])
+async def create_user(user_request: UserRequest, idempotency_key: Optional[str] = Header(None)):
     """
-    Endpoint para crear un nuevo usuario
+    Endpoint para crear un nuevo usuario.
+    Con Idempotency-Key un reintento devuelve el usuario creado en lugar de
+    repetir el hash y responder "El correo ya registrado".
     """
-    logging.info(f"Creando nuevo usuario con email: {user_request.email}")
-    
-    # Verificar si el correo ya existe
-    existing_user = mongodb_client.users_service.users.find_one({"email": user_request.email})
-    if existing_user:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="El correo ya registrado"
-        )
-    
+    logging.info("Creando nuevo usuario con email: %s", user_request.email)
+    fingerprint = request_fingerprint(user_request.model_dump(mode="json"), secret=SECRET_KEY)
+    return await _idempotent(
+        idempotency_key, "POST /usuarios", fingerprint, lambda: _create_user(user_request)
+    )
+
+
+async def _create_user(user_request: UserRequest) -> Response:
     # Crear el nuevo usuario
     user_id = str(uuid.uuid4())
     now = datetime.now(timezone.utc)
     
     # Hash de la contraseña
-    hashed_password = hash_password(user_request.password)
+    hashed_password = await _hash_password(user_request.password)
     
     # Crear token JWT
-    token_data = {"user_id": user_id, "email": user_request.email}
-    access_token = create_access_token(token_data)
+    access_token = _issue_token(user_id, user_request.email)
     
     # Preparar documento del usuario
-    user_doc = {
-        "id": user_id,
-        "name": user_request.name,
-        "email": user_request.email,
-        "password": hashed_password,
-        "phones": [phone.model_dump() for phone in user_request.phones],
-        "created": now,
-        "modified": now,
-        "last_login": now,
-        "token": access_token,
-        "isactive": True
-    }
+    user_doc = _build_user_doc(user_id, user_request, hashed_password, access_token, now)
     
-    # Insertar en la base de datos
+    # Insertar en la base de datos (el índice único rechaza correos repetidos)
     try:
-        mongodb_client.users_service.users.insert_one(user_doc)
-        logging.info(f" Nuevo usuario creado: {user_request.name}")
+        await app.state.user_repository.insert(user_doc)
+        logging.info(" Nuevo usuario creado: %s", user_request.name)
+        app.state.email_filter.add(user_request.email)
+        await _record_change(CREATE, user_id, user_doc)
         
         # Preparar respuesta
-        response = UserResponse(
-            id=user_id,
-            name=user_request.name,
-            email=user_request.email,
-            phones=user_request.phones,
-            created=now,
-            modified=now,
-            last_login=now,
-            token=access_token,
-            isactive=True
-        )
+        return _user_json_response(user_doc, status_code=status.HTTP_201_CREATED, include_token=True)
         
-        return response
-        
-    except Exception as e:
-        logging.error(f"Error al crear usuario: {str(e)}")
+    except DuplicateEmailError:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Error interno del servidor"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="El correo ya registrado"
         )
+    except Exception as e:
+        raise _server_error(e, "Error al crear usuario")
+
+
+def _parse_bulk_body(body: bytes, content_type: str) -> list:
+    """
+    Separar el cuerpo en items crudos: arreglo JSON o NDJSON (un usuario por línea).
+    Una línea NDJSON inválida queda como error de ese item, no de todo el lote.
+    """
+    if "ndjson" in content_type:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError:
+                items.append(ValueError("JSON inválido"))
+        return items
+
+    try:
+        items = json.loads(body)
+    except json.JSONDecodeError:
+        raise ValueError("El cuerpo debe ser un arreglo JSON o NDJSON")
+    if not isinstance(items, list):
+        raise ValueError("El cuerpo debe ser un arreglo JSON o NDJSON")
+    return items
+
+
+def _validation_message(exc: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+        for error in exc.errors()
+    )
+
+
+@app.post("/usuarios/bulk", response_model=BulkUserResponse,
+          dependencies=[Depends(require_user), Depends(require_database)])
+async def create_users_bulk(request: Request):
+    """
+    Crear usuarios en lote desde un arreglo JSON o NDJSON.
+    Devuelve un resultado por item; un item inválido no hace fallar el lote.
+    """
+    items = _parse_bulk_body(await request.body(), request.headers.get("content-type", ""))
+    if len(items) > settings.bulk_max_items:
+        raise ValueError(f"El lote supera el máximo de {settings.bulk_max_items} usuarios")
+    logging.info("Creando %s usuarios en lote", len(items))
+
+    results = [BulkUserResult(index=index) for index in range(len(items))]
+
+    # Validar cada item y detectar correos repetidos dentro del mismo lote
+    valid = {}
+    seen_emails = set()
+    for index, item in enumerate(items):
+        if isinstance(item, Exception):
+            results[index].error = str(item)
+            continue
+        try:
+            user_request = UserRequest.model_validate(item)
+        except ValidationError as e:
+            results[index].error = _validation_message(e)
+            continue
+        if user_request.email in seen_emails:
+            results[index].error = "El correo ya registrado"
+            continue
+        seen_emails.add(user_request.email)
+        valid[index] = user_request
+
+    try:
+        # Una sola consulta para los correos que ya existen en la base, limitada a
+        # los que el filtro de Bloom no descarta (se omite si descarta todos)
+        if not valid:
+            return BulkUserResponse(creados=0, errores=len(results), resultados=results)
+
+        candidates = [email for email in seen_emails if app.state.email_filter.might_contain(email)]
+        existing_emails = await app.state.user_repository.existing_emails(candidates) if candidates else set()
+        app.state.email_filter.record_false_positives(len(candidates) - len(existing_emails))
+        for index, user_request in list(valid.items()):
+            if user_request.email in existing_emails:
+                results[index].error = "El correo ya registrado"
+                del valid[index]
+
+        try:
+            hashed_passwords = await password_hasher.hash_many(
+                [user_request.password for user_request in valid.values()]
+            )
+        except HashingOverloaded as exc:
+            raise _overloaded_error(exc)
+
+        now = datetime.now(timezone.utc)
+        pending = []
+        for (index, user_request), hashed_password in zip(valid.items(), hashed_passwords):
+            user_id = str(uuid.uuid4())
+            access_token = _issue_token(user_id, user_request.email)
+            pending.append((index, _build_user_doc(user_id, user_request, hashed_password, access_token, now)))
+
+        # Inserción no ordenada por bloques: un duplicado no detiene el resto del bloque
+        chunk_size = settings.bulk_insert_chunk_size
+        for start in range(0, len(pending), chunk_size):
+            chunk = pending[start:start + chunk_size]
+            failed = await app.state.user_repository.insert_many([user_doc for _, user_doc in chunk])
+            created_docs = []
+            for position, (index, user_doc) in enumerate(chunk):
+                if position in failed:
+                    results[index].error = (
+                        "El correo ya registrado" if isinstance(failed[position], DuplicateEmailError)
+                        else "Error interno del servidor"
+                    )
+                else:
+                    results[index].id = user_doc["id"]
+                    results[index].token = user_doc["token"]
+                    created_docs.append(user_doc)
+                    app.state.email_filter.add(user_doc["email"])
+            try:
+                await app.state.change_feed.record_many(CREATE, created_docs)
+            except Exception as e:
+                logging.error("Error al registrar %s altas en el feed: %s", len(created_docs), e)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise _server_error(e, "Error al crear usuarios en lote")
+
+    created = sum(1 for result in results if result.error is None)
+    logging.info("Lote procesado: %s creados, %s con error", created, len(results) - created)
+    return BulkUserResponse(creados=created, errores=len(results) - created, resultados=results)
+
+
+def _token_is_fresh(token: str) -> bool:
+    """El token es válido y le queda al menos la mitad de su vigencia"""
+    try:
+        claims = decode_access_token(token)
+    except jwt.PyJWTError:
+        return False
+    return claims["exp"] - time.time() > settings.access_token_expire_minutes * 30
+
+
+@app.post("/login", response_model=UserTokenResponse)
+async def login(login_request: LoginRequest):
+    """
+    Verificar credenciales y registrar last_login. Si el token vigente del usuario
+    aún tiene al menos la mitad de su vigencia se devuelve el mismo y last_login
+    se escribe en diferido; si no, se emite uno nuevo y el anterior deja de valer.
+    """
+    logging.info("Login de usuario: %s", login_request.email)
+    try:
+        user_doc = await app.state.user_repository.get_by_email(login_request.email)
+    except Exception as e:
+        raise _server_error(e, "Error al iniciar sesión")
+    if user_doc and user_doc["isactive"]:
+        valid = await _verify_password(login_request.password, user_doc["password"])
+    else:
+        await _verify_password(login_request.password, DUMMY_PASSWORD_HASH)
+        valid = False
+    if not valid:
+        raise _unauthorized("Credenciales inválidas")
+
+    now = datetime.now(timezone.utc)
+    if _token_is_fresh(user_doc["token"]):
+        app.state.activity_buffer.touch(user_doc["id"], "last_login", now)
+        user_doc["last_login"] = now
+        return _user_json_response(user_doc, include_token=True)
+
+    try:
+        updated_user = await app.state.user_repository.update(user_doc["id"], {
+            "last_login": now,
+            "token": _issue_token(user_doc["id"], user_doc["email"])
+        })
+    except Exception as e:
+        raise _server_error(e, "Error al registrar login")
+    if not updated_user:
+        raise _unauthorized("Credenciales inválidas")
+    await _invalidate_user(user_doc["id"])
+    await _record_change(UPDATE, user_doc["id"], updated_user)
+    return _user_json_response(updated_user, include_token=True)
@@ -0,0 +1,215 @@
+# metrics.py - Métricas Prometheus de HTTP, MongoDB y bcrypt
+import os
+import time
+from typing import Dict, Tuple
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+from pymongo import monitoring
+
+# Con varios workers cada proceso escribe sus métricas en este directorio y
+# /metrics las agrega, sin importar qué worker atienda el scrape
+MULTIPROCESS = bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "users_http_request_duration_seconds",
+    "Latencia de requests HTTP por ruta y status",
+    ["method", "route", "status"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
+HTTP_IN_FLIGHT = Gauge(
+    "users_http_requests_in_flight",
+    "Requests HTTP en curso",
+    multiprocess_mode="livesum"
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "users_mongo_command_duration_seconds",
+    "Duración de comandos MongoDB por comando y colección",
+    ["command", "collection", "outcome"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+MONGO_POOL_CONNECTIONS = Gauge(
+    "users_mongo_pool_connections",
+    "Conexiones del pool de MongoDB por servidor y estado",
+    ["address", "state"],
+    multiprocess_mode="livesum"
+)
+MONGO_POOL_CHECKOUT_SECONDS = Histogram(
+    "users_mongo_pool_checkout_duration_seconds",
+    "Espera para obtener una conexión del pool de MongoDB",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+)
+MONGO_POOL_CHECKOUT_FAILURES = Counter(
+    "users_mongo_pool_checkout_failures_total",
+    "Checkouts fallidos del pool de MongoDB por motivo",
+    ["reason"]
+)
+MONGO_CIRCUIT_STATE = Gauge(
+    "users_mongo_circuit_state",
+    "Estado del circuit breaker de MongoDB (0 cerrado, 1 semiabierto, 2 abierto)",
+    multiprocess_mode="max"
+)
+MONGO_CIRCUIT_TRANSITIONS = Counter(
+    "users_mongo_circuit_transitions_total",
+    "Cambios de estado del circuit breaker de MongoDB por estado nuevo",
+    ["state"]
+)
+CIRCUIT_STATE_VALUES = {"closed": 0, "half_open": 1, "open": 2}
+PASSWORD_HASH_SECONDS = Histogram(
+    "users_password_hash_duration_seconds",
+    "Tiempo de CPU de bcrypt por operación (medido en el proceso del pool)",
+    ["operation"],
+    buckets=(0.01, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1, 2, 5)
+)
+
+
+def observe_password_hash(operation: str, seconds: float):
+    PASSWORD_HASH_SECONDS.labels(operation).observe(seconds)
+
+
+def observe_circuit_state(state: str):
+    MONGO_CIRCUIT_STATE.set(CIRCUIT_STATE_VALUES[state])
+    MONGO_CIRCUIT_TRANSITIONS.labels(state).inc()
+
+
+def render() -> Tuple[bytes, str]:
+    """Métricas en formato de texto de Prometheus"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
+
+
+def mark_worker_stopped():
+    """Descartar los gauges de este worker al apagarse (modo multiproceso)"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+    """
+    Middleware ASGI que mide cada request. La ruta se etiqueta con la plantilla
+    (/usuarios/{user_id}) y no con la URL, para no multiplicar las series.
+    Los hijos etiquetados se cachean para no pasar por el registro en cada request.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._route_paths: Dict = {}
+        self._histograms: Dict[Tuple[str, str, int], object] = {}
+
+    def _route_path(self, scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        path = self._route_paths.get(endpoint)
+        if path is None:
+            for route in scope["app"].routes:
+                self._route_paths[getattr(route, "endpoint", None)] = getattr(route, "path", "unmatched")
+            path = self._route_paths.get(endpoint, "unmatched")
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_IN_FLIGHT.dec()
+            key = (scope["method"], self._route_path(scope), status_code)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = HTTP_REQUEST_SECONDS.labels(*key)
+            histogram.observe(elapsed)
+
+
+class CommandMetricsListener(monitoring.CommandListener):
+    """Duración de cada comando MongoDB, agrupada por comando y colección"""
+
+    def __init__(self):
+        self._started: Dict[Tuple, Tuple[str, str]] = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = ""
+        self._started[(event.connection_id, event.request_id)] = (event.command_name, collection)
+
+    def _finish(self, event, outcome: str):
+        command, collection = self._started.pop(
+            (event.connection_id, event.request_id), (event.command_name, "")
+        )
+        MONGO_COMMAND_SECONDS.labels(command, collection, outcome).observe(event.duration_micros / 1e6)
+
+    def succeeded(self, event):
+        self._finish(event, "ok")
+
+    def failed(self, event):
+        self._finish(event, "error")
+
+
+class PoolMetricsListener(monitoring.ConnectionPoolListener):
+    """Conexiones abiertas y en uso del pool, y espera de checkout"""
+
+    def _address(self, event) -> str:
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        address = self._address(event)
+        MONGO_POOL_CONNECTIONS.labels(address, "open").set(0)
+        MONGO_POOL_CONNECTIONS.labels(address, "checked_out").set(0)
+
+    def connection_created(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self._address(event), "open").inc()
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self._address(event), "open").dec()
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        MONGO_POOL_CHECKOUT_FAILURES.labels(str(event.reason)).inc()
+
+    def connection_checked_out(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self._address(event), "checked_out").inc()
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            MONGO_POOL_CHECKOUT_SECONDS.observe(duration)
+
+    def connection_checked_in(self, event):
+        MONGO_POOL_CONNECTIONS.labels(self._address(event), "checked_out").dec()
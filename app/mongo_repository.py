@@ -0,0 +1,331 @@
+# mongo_repository.py - Persistencia de usuarios en MongoDB
+import functools
+import json
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from bson import ObjectId, json_util
+from pymongo import ASCENDING, AsyncMongoClient, ReplaceOne, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError, ConnectionFailure, DuplicateKeyError, PyMongoError
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+
+from .circuit import CircuitBreaker
+from .indexes import ARCHIVE_INDEXES, ensure_indexes
+from .repository import DuplicateEmailError, UserRepository, VersionMismatchError
+from .search import plan_summary
+from .serialization import user_version
+
+DUPLICATE_KEY = 11000
+# Proyección por defecto: el hash de la contraseña solo se lee para el login
+DEFAULT_PROJECTION = {"password": 0}
+# El archivo no guarda credenciales
+ARCHIVE_PROJECTION = {"password": 0, "token": 0}
+READ_PREFERENCES = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+def read_preference(mode: str, max_staleness_seconds: Optional[int] = None):
+    """Read preference por nombre, como en la URI de MongoDB (ej. "secondaryPreferred")"""
+    if mode not in READ_PREFERENCES:
+        raise ValueError(f"Read preference desconocida: {mode}")
+    if mode == "primary":
+        return Primary()
+    return READ_PREFERENCES[mode](max_staleness=-1 if max_staleness_seconds is None else max_staleness_seconds)
+
+
+def is_unavailable_error(exc: BaseException) -> bool:
+    """
+    Errores que indican que MongoDB no responde (red, selección de servidor,
+    timeouts), a diferencia de los errores propios de la operación
+    """
+    return isinstance(exc, ConnectionFailure) or (isinstance(exc, PyMongoError) and exc.timeout)
+
+
+def _guarded(method):
+    """Pasar la operación por el circuit breaker del repositorio, si tiene"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if self.breaker is None:
+            return await method(self, *args, **kwargs)
+        return await self.breaker.call(lambda: method(self, *args, **kwargs))
+    return wrapper
+
+
+def _guarded_stream(method):
+    """Como _guarded, para los recorridos con cursor (generadores asíncronos)"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        items = method(self, *args, **kwargs)
+        return items if self.breaker is None else self.breaker.stream(items)
+    return wrapper
+
+
+def _projection(fields: Optional[Sequence[str]], keep_id: bool) -> dict:
+    if fields is None:
+        return DEFAULT_PROJECTION
+    projection = dict.fromkeys(fields, 1)
+    if not keep_id:
+        projection["_id"] = 0
+    return projection
+
+
+def _versioned_filter(user_id: str, expected_versions: Optional[List[int]]) -> dict:
+    """Filtro por id que además exige una de las `version` esperadas (If-Match)"""
+    query = {"id": user_id}
+    if expected_versions is not None:
+        # Los documentos creados antes del campo no lo tienen: son la versión 0
+        query["version"] = {"$in": expected_versions + [None] if 0 in expected_versions else expected_versions}
+    return query
+
+
+def _query(after: Optional[ObjectId], filters) -> dict:
+    query = {} if filters is None else filters.to_query()
+    if after is not None:
+        query["_id"] = {"$gt": after}
+    return query
+
+
+class MongoUserRepository(UserRepository):
+    """
+    Repositorio sobre la colección users del driver asíncrono de pymongo.
+
+    Los listados, conteos, planes y exportaciones se leen con
+    `list_read_preference` (por ejemplo desde secundarios); las lecturas por id o
+    correo y las escrituras siempre van al primario. Con `breaker`, las
+    operaciones de datos fallan de inmediato con CircuitOpen mientras la base
+    está caída o lenta; el ping de /ready no pasa por él.
+    """
+
+    def __init__(
+        self,
+        client: AsyncMongoClient,
+        database: str,
+        batch_size: int = 500,
+        list_read_preference=None,
+        breaker: Optional[CircuitBreaker] = None
+    ):
+        self.client = client
+        self.collection = client[database].users
+        self.list_collection = self.collection
+        if list_read_preference is not None:
+            self.list_collection = self.collection.with_options(read_preference=list_read_preference)
+        self.archive = client[database].users_archive
+        self.breaker = breaker
+        self._batch_size = batch_size
+
+    async def ensure_indexes(self):
+        await ensure_indexes(self.collection)
+        await ensure_indexes(self.archive, ARCHIVE_INDEXES)
+
+    @_guarded
+    async def get(self, user_id: str, fields: Optional[Sequence[str]] = None) -> Optional[dict]:
+        return await self.collection.find_one({"id": user_id}, _projection(fields, keep_id=False))
+
+    @_guarded
+    async def get_version(self, user_id: str) -> Optional[int]:
+        # Consulta cubierta por el índice {id, version}: no se lee el documento
+        user_doc = await self.collection.find_one(
+            {"id": user_id}, {"_id": 0, "version": 1}, hint="id_version"
+        )
+        return None if user_doc is None else user_version(user_doc)
+
+    @_guarded
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        return await self.collection.find_one({"email": email})
+
+    @_guarded
+    async def list_page(
+        self,
+        after: Optional[ObjectId],
+        limit: int,
+        filters=None,
+        fields: Optional[Sequence[str]] = None
+    ) -> List[dict]:
+        projection = _projection(fields, keep_id=True)
+        cursor = self.list_collection.find(_query(after, filters), projection).sort("_id", ASCENDING).limit(limit)
+        return await cursor.to_list()
+
+    @_guarded_stream
+    async def iterate(
+        self,
+        after: Optional[ObjectId] = None,
+        limit: Optional[int] = None,
+        fields: Optional[Sequence[str]] = None,
+        modified_since: Optional[datetime] = None,
+        filters=None
+    ) -> AsyncIterator[dict]:
+        query = _query(after, filters)
+        if modified_since is not None:
+            query["modified"] = {"$gte": modified_since}
+        projection = _projection(fields, keep_id=False)
+
+        cursor = self.list_collection.find(query, projection).batch_size(self._batch_size)
+        # Con modified_since se deja que el planner use el índice sobre modified
+        if modified_since is None:
+            cursor = cursor.sort("_id", ASCENDING)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        # Cerrar el cursor aunque el cliente se desconecte a mitad del stream
+        try:
+            async for user_doc in cursor:
+                yield user_doc
+        finally:
+            await cursor.close()
+
+    @_guarded
+    async def count(self, filters=None, limit: Optional[int] = None) -> Tuple[int, bool]:
+        # Sin filtros se usa el conteo de los metadatos de la colección, sin recorrerla
+        if filters is None:
+            return await self.list_collection.estimated_document_count(), True
+        options = {} if limit is None else {"limit": limit}
+        total = await self.list_collection.count_documents(filters.to_query(), **options)
+        return total, limit is not None and total >= limit
+
+    @_guarded
+    async def explain(self, after: Optional[ObjectId], limit: int, filters=None) -> dict:
+        query = _query(after, filters)
+        explanation = await self.list_collection.find(query).sort("_id", ASCENDING).limit(limit).explain()
+        return {
+            "engine": "mongo",
+            "query": json.loads(json_util.dumps(query)),
+            **plan_summary(explanation["queryPlanner"]["winningPlan"]),
+        }
+
+    @_guarded
+    async def insert(self, user_doc: dict):
+        try:
+            await self.collection.insert_one(user_doc)
+        except DuplicateKeyError as e:
+            raise DuplicateEmailError(user_doc["email"]) from e
+
+    @_guarded
+    async def insert_many(self, user_docs: List[dict]) -> Dict[int, Exception]:
+        try:
+            await self.collection.insert_many(user_docs, ordered=False)
+        except BulkWriteError as e:
+            errors = {}
+            for write_error in e.details.get("writeErrors", []):
+                position = write_error["index"]
+                if write_error.get("code") == DUPLICATE_KEY:
+                    errors[position] = DuplicateEmailError(user_docs[position]["email"])
+                else:
+                    errors[position] = Exception(write_error.get("errmsg"))
+            return errors
+        return {}
+
+    async def _raise_if_version_mismatch(self, user_id: str, expected_versions: Optional[List[int]]):
+        """Tras una escritura condicional sin match: distinguir usuario inexistente de versión distinta"""
+        if expected_versions is not None and await self.get_version(user_id) is not None:
+            raise VersionMismatchError(user_id)
+
+    @_guarded
+    async def update(
+        self,
+        user_id: str,
+        fields: dict,
+        expected_versions: Optional[List[int]] = None
+    ) -> Optional[dict]:
+        try:
+            updated = await self.collection.find_one_and_update(
+                _versioned_filter(user_id, expected_versions),
+                {"$set": fields, "$inc": {"version": 1}},
+                projection=DEFAULT_PROJECTION,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError as e:
+            raise DuplicateEmailError(fields.get("email")) from e
+        if updated is None:
+            await self._raise_if_version_mismatch(user_id, expected_versions)
+        return updated
+
+    @_guarded
+    async def deactivate(
+        self,
+        user_id: str,
+        modified: datetime,
+        expected_versions: Optional[List[int]] = None
+    ) -> bool:
+        result = await self.collection.update_one(
+            _versioned_filter(user_id, expected_versions),
+            {"$set": {"isactive": False, "modified": modified}, "$inc": {"version": 1}}
+        )
+        if result.matched_count == 0:
+            await self._raise_if_version_mismatch(user_id, expected_versions)
+            return False
+        return True
+
+    @_guarded
+    async def touch_many(self, updates: Dict[str, Dict[str, datetime]]):
+        await self.collection.bulk_write(
+            [
+                UpdateOne({"id": user_id}, {"$max": fields, "$inc": {"version": 1}})
+                for user_id, fields in updates.items()
+            ],
+            ordered=False
+        )
+
+    @_guarded
+    async def existing_emails(self, emails: Iterable[str]) -> Set[str]:
+        return {
+            user_doc["email"]
+            async for user_doc in self.collection.find(
+                {"email": {"$in": list(emails)}},
+                {"_id": 0, "email": 1}
+            )
+        }
+
+    @_guarded_stream
+    async def iterate_emails(self) -> AsyncIterator[str]:
+        # Consulta cubierta por el índice único sobre email: no se leen los documentos
+        cursor = self.collection.find({}, {"_id": 0, "email": 1}, hint="email_unique").batch_size(
+            self._batch_size
+        )
+        try:
+            async for user_doc in cursor:
+                yield user_doc["email"]
+        finally:
+            await cursor.close()
+
+    @_guarded
+    async def archive_inactive(self, cutoff: datetime, limit: int) -> List[str]:
+        # El filtro coincide con el del índice parcial inactive_modified
+        eligible = {"isactive": False, "modified": {"$lt": cutoff}}
+        batch = await self.collection.find(eligible, ARCHIVE_PROJECTION, hint="inactive_modified").sort(
+            "modified", ASCENDING
+        ).limit(limit).to_list()
+        if not batch:
+            return []
+        archived_at = datetime.now(timezone.utc)
+        # Copia idempotente por id: repetir un lote interrumpido no duplica
+        await self.archive.bulk_write(
+            [ReplaceOne({"id": user_doc["id"]}, dict(user_doc, archived=archived_at), upsert=True)
+             for user_doc in batch],
+            ordered=False
+        )
+        # Solo se borra si sigue cumpliendo el plazo (una escritura concurrente lo excluye)
+        ids = [user_doc["_id"] for user_doc in batch]
+        result = await self.collection.delete_many(dict(eligible, _id={"$in": ids}))
+        remaining = set()
+        if result.deleted_count < len(batch):
+            remaining = {
+                user_doc["id"] async for user_doc in self.collection.find(
+                    {"_id": {"$in": ids}}, {"_id": 0, "id": 1}
+                )
+            }
+            await self.archive.delete_many({"id": {"$in": list(remaining)}})
+        return [user_doc["id"] for user_doc in batch if user_doc["id"] not in remaining]
+
+    @_guarded
+    async def is_archived(self, user_id: str) -> bool:
+        return await self.archive.find_one({"id": user_id}, {"_id": 1}) is not None
+
+    async def ping(self):
+        await self.client.admin.command("ping")
+
+    async def close(self):
+        await self.client.close()
@@ -0,0 +1,424 @@
+# repository.py - Interfaz de persistencia de usuarios y motor en memoria
+import asyncio
+import bisect
+from abc import ABC, abstractmethod
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+from bson import ObjectId
+
+
+class DuplicateEmailError(Exception):
+    """El correo ya pertenece a otro usuario"""
+
+
+class VersionMismatchError(Exception):
+    """El usuario existe pero su `version` no es ninguna de las esperadas (If-Match)"""
+
+
+class UserRepository(ABC):
+    """
+    Operaciones de persistencia que usa la API. Los documentos se intercambian
+    como dict con la misma forma que en MongoDB (incluido `_id`, que define el
+    orden de la paginación).
+    """
+
+    @abstractmethod
+    async def ensure_indexes(self):
+        """Preparar índices o estructuras auxiliares al iniciar la aplicación"""
+
+    @abstractmethod
+    async def get(self, user_id: str, fields: Optional[Sequence[str]] = None) -> Optional[dict]:
+        """
+        Usuario por id público, o None. Se lee sin password; con `fields` solo
+        esos campos (sin _id).
+        """
+
+    @abstractmethod
+    async def get_version(self, user_id: str) -> Optional[int]:
+        """`version` del usuario, o None; MongoDB lo resuelve solo con el índice id_version"""
+
+    @abstractmethod
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        """Usuario completo por correo (incluye password, para el login), o None"""
+
+    @abstractmethod
+    async def list_page(
+        self,
+        after: Optional[ObjectId],
+        limit: int,
+        filters=None,
+        fields: Optional[Sequence[str]] = None
+    ) -> List[dict]:
+        """
+        Hasta `limit` usuarios con _id mayor que `after`, ordenados por _id.
+        `filters` es un search.UserFilters opcional. Se leen sin password; con
+        `fields` solo esos campos más _id.
+        """
+
+    @abstractmethod
+    def iterate(
+        self,
+        after: Optional[ObjectId] = None,
+        limit: Optional[int] = None,
+        fields: Optional[Sequence[str]] = None,
+        modified_since: Optional[datetime] = None,
+        filters=None
+    ) -> AsyncIterator[dict]:
+        """
+        Recorrer usuarios en streaming ordenados por _id, sin password. Con
+        `fields` solo se devuelven esos campos (sin _id).
+        """
+
+    @abstractmethod
+    async def count(self, filters=None, limit: Optional[int] = None) -> Tuple[int, bool]:
+        """
+        Cantidad de usuarios que cumplen `filters` y si es aproximada (estimada
+        desde los metadatos o cortada en `limit`).
+        """
+
+    @abstractmethod
+    async def explain(self, after: Optional[ObjectId], limit: int, filters=None) -> dict:
+        """Plan de ejecución de la consulta de list_page, para depuración"""
+
+    @abstractmethod
+    async def insert(self, user_doc: dict):
+        """Insertar un usuario; DuplicateEmailError si el correo ya existe"""
+
+    @abstractmethod
+    async def insert_many(self, user_docs: List[dict]) -> Dict[int, Exception]:
+        """
+        Inserción no ordenada. Devuelve los errores por posición en `user_docs`
+        (DuplicateEmailError para correos repetidos); los demás se insertan.
+        """
+
+    @abstractmethod
+    async def update(
+        self,
+        user_id: str,
+        fields: dict,
+        expected_versions: Optional[List[int]] = None
+    ) -> Optional[dict]:
+        """
+        Aplicar `fields` de forma atómica, incrementar `version` y devolver el
+        documento actualizado, o None si el usuario no existe. DuplicateEmailError
+        si el correo es de otro. Con `expected_versions` la escritura solo ocurre
+        si `version` es una de esas; si no, VersionMismatchError.
+        """
+
+    @abstractmethod
+    async def deactivate(
+        self,
+        user_id: str,
+        modified: datetime,
+        expected_versions: Optional[List[int]] = None
+    ) -> bool:
+        """Soft delete; False si el usuario no existe. `version` y `expected_versions` como en update"""
+
+    @abstractmethod
+    async def touch_many(self, updates: Dict[str, Dict[str, datetime]]):
+        """
+        Escritura no ordenada de timestamps por usuario. Cada campo solo avanza
+        ($max), así un lote que llega tarde no retrocede un valor más nuevo.
+        También incrementa `version`: cambia la representación del usuario.
+        """
+
+    @abstractmethod
+    async def existing_emails(self, emails: Iterable[str]) -> Set[str]:
+        """Subconjunto de `emails` que ya está registrado"""
+
+    @abstractmethod
+    def iterate_emails(self) -> AsyncIterator[str]:
+        """Recorrer en streaming todos los correos registrados"""
+
+    @abstractmethod
+    async def archive_inactive(self, cutoff: datetime, limit: int) -> List[str]:
+        """
+        Mover al archivo hasta `limit` usuarios desactivados con `modified`
+        anterior a `cutoff` (sin password ni token). Idempotente: copiar y luego
+        borrar, de modo que un lote interrumpido se repite sin duplicar.
+        Devuelve los id que se quitaron de la colección de usuarios.
+        """
+
+    @abstractmethod
+    async def is_archived(self, user_id: str) -> bool:
+        """El usuario fue movido al archivo"""
+
+    async def ping(self):
+        """Comprobar que la base responde; lanza una excepción si no"""
+
+    async def close(self):
+        """Liberar conexiones"""
+
+
+def _as_stored(value):
+    """
+    Como MongoDB: los datetimes se guardan en UTC con precisión de milisegundos
+    y se leen sin zona horaria
+    """
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    return value
+
+
+class _UserRecord:
+    """Registro compacto de un usuario; los teléfonos se guardan como tuplas"""
+
+    FIELDS = (
+        "_id", "id", "name", "email", "password", "phones",
+        "created", "modified", "last_login", "token", "isactive", "version"
+    )
+    __slots__ = FIELDS + ("extra",)
+    # Lo que se lee por defecto: nunca el hash de la contraseña
+    READ_FIELDS = tuple(field for field in FIELDS if field != "password")
+
+    def __init__(self, user_doc: dict):
+        self.extra = None
+        for field, value in user_doc.items():
+            self.set(field, value)
+
+    def set(self, field: str, value):
+        value = _as_stored(value)
+        if field == "phones":
+            value = tuple((phone["number"], phone["citycode"], phone["contrycode"]) for phone in value)
+        if field in self.FIELDS:
+            setattr(self, field, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[field] = value
+
+    def get(self, field: str):
+        if field == "phones":
+            return [
+                {"number": number, "citycode": citycode, "contrycode": contrycode}
+                for number, citycode, contrycode in self.phones
+            ]
+        if field in self.FIELDS:
+            return getattr(self, field, None)
+        return (self.extra or {}).get(field)
+
+    def to_doc(self, fields: Optional[Sequence[str]] = None) -> dict:
+        if fields is None:
+            doc = {field: self.get(field) for field in self.FIELDS}
+            doc.update(self.extra or {})
+            return doc
+        return {field: self.get(field) for field in fields}
+
+
+class InMemoryUserRepository(UserRepository):
+    """
+    Motor en memoria para tests y benchmarks sin MongoDB. Los registros viven en
+    un arreglo de slots ordenado por _id (posición = orden de inserción) con
+    índices hash sobre `id` y `email` que apuntan al slot. Todas las operaciones
+    son síncronas dentro del event loop, por lo que cada una es atómica.
+    """
+
+    # Cada cuántos registros se cede el event loop al recorrer en streaming
+    YIELD_EVERY = 1000
+
+    def __init__(self):
+        self._slots: List[Optional[_UserRecord]] = []
+        self._object_ids: List[ObjectId] = []
+        self._by_id: Dict[str, int] = {}
+        self._by_email: Dict[str, int] = {}
+        self._archive: Dict[str, dict] = {}
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    async def ensure_indexes(self):
+        pass
+
+    def _record(self, user_id: str) -> Optional[_UserRecord]:
+        slot = self._by_id.get(user_id)
+        return None if slot is None else self._slots[slot]
+
+    async def get(self, user_id: str, fields: Optional[Sequence[str]] = None) -> Optional[dict]:
+        record = self._record(user_id)
+        return None if record is None else record.to_doc(fields or _UserRecord.READ_FIELDS)
+
+    async def get_version(self, user_id: str) -> Optional[int]:
+        record = self._record(user_id)
+        return None if record is None else record.get("version") or 0
+
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        slot = self._by_email.get(email)
+        return None if slot is None else self._slots[slot].to_doc()
+
+    def _start_slot(self, after: Optional[ObjectId]) -> int:
+        return 0 if after is None else bisect.bisect_right(self._object_ids, after)
+
+    @staticmethod
+    def _matches(record: Optional[_UserRecord], filters) -> bool:
+        return record is not None and (filters is None or filters.matches(record.get))
+
+    async def list_page(
+        self,
+        after: Optional[ObjectId],
+        limit: int,
+        filters=None,
+        fields: Optional[Sequence[str]] = None
+    ) -> List[dict]:
+        fields = ("_id",) + tuple(fields) if fields else _UserRecord.READ_FIELDS
+        page = []
+        slot = self._start_slot(after)
+        while slot < len(self._slots) and len(page) < limit:
+            record = self._slots[slot]
+            slot += 1
+            if self._matches(record, filters):
+                page.append(record.to_doc(fields))
+        return page
+
+    async def iterate(
+        self,
+        after: Optional[ObjectId] = None,
+        limit: Optional[int] = None,
+        fields: Optional[Sequence[str]] = None,
+        modified_since: Optional[datetime] = None,
+        filters=None
+    ) -> AsyncIterator[dict]:
+        emitted = 0
+        modified_since = _as_stored(modified_since)
+        slot = self._start_slot(after)
+        while slot < len(self._slots) and (limit is None or emitted < limit):
+            record = self._slots[slot]
+            slot += 1
+            if not self._matches(record, filters) or (
+                modified_since is not None and record.modified < modified_since
+            ):
+                continue
+            yield record.to_doc(fields or _UserRecord.READ_FIELDS)
+            emitted += 1
+            if emitted % self.YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+
+    async def count(self, filters=None, limit: Optional[int] = None) -> Tuple[int, bool]:
+        if filters is None:
+            return len(self), False
+        total = 0
+        for record in self._slots:
+            if self._matches(record, filters):
+                total += 1
+                if total == limit:
+                    return total, True
+        return total, False
+
+    async def explain(self, after: Optional[ObjectId], limit: int, filters=None) -> dict:
+        # Los slots están ordenados por _id; los filtros no tienen índices secundarios
+        if filters is None:
+            return {"engine": "memory", "stages": ["IXSCAN"], "indexes": ["_id"], "collscan": False}
+        return {"engine": "memory", "stages": ["COLLSCAN"], "indexes": [], "collscan": True}
+
+    def _insert_one(self, user_doc: dict):
+        if user_doc["email"] in self._by_email:
+            raise DuplicateEmailError(user_doc["email"])
+        if user_doc["id"] in self._by_id:
+            raise ValueError(f"id duplicado: {user_doc['id']}")
+        user_doc.setdefault("_id", ObjectId())
+        slot = len(self._slots)
+        self._slots.append(_UserRecord(user_doc))
+        self._object_ids.append(user_doc["_id"])
+        self._by_id[user_doc["id"]] = slot
+        self._by_email[user_doc["email"]] = slot
+
+    async def insert(self, user_doc: dict):
+        self._insert_one(user_doc)
+
+    async def insert_many(self, user_docs: List[dict]) -> Dict[int, Exception]:
+        errors = {}
+        for position, user_doc in enumerate(user_docs):
+            try:
+                self._insert_one(user_doc)
+            except (DuplicateEmailError, ValueError) as e:
+                errors[position] = e
+        return errors
+
+    @staticmethod
+    def _check_version(record: _UserRecord, expected_versions: Optional[List[int]]):
+        if expected_versions is not None and (record.get("version") or 0) not in expected_versions:
+            raise VersionMismatchError(record.id)
+
+    @staticmethod
+    def _bump_version(record: _UserRecord):
+        # Como $inc: un registro sin version pasa a 1
+        record.version = (record.get("version") or 0) + 1
+
+    async def update(
+        self,
+        user_id: str,
+        fields: dict,
+        expected_versions: Optional[List[int]] = None
+    ) -> Optional[dict]:
+        slot = self._by_id.get(user_id)
+        if slot is None:
+            return None
+        record = self._slots[slot]
+        self._check_version(record, expected_versions)
+        new_email = fields.get("email")
+        if new_email is not None and new_email != record.email:
+            if new_email in self._by_email:
+                raise DuplicateEmailError(new_email)
+            del self._by_email[record.email]
+            self._by_email[new_email] = slot
+        for field, value in fields.items():
+            record.set(field, value)
+        self._bump_version(record)
+        return record.to_doc(_UserRecord.READ_FIELDS)
+
+    async def deactivate(
+        self,
+        user_id: str,
+        modified: datetime,
+        expected_versions: Optional[List[int]] = None
+    ) -> bool:
+        record = self._record(user_id)
+        if record is None:
+            return False
+        self._check_version(record, expected_versions)
+        record.isactive = False
+        record.modified = _as_stored(modified)
+        self._bump_version(record)
+        return True
+
+    async def touch_many(self, updates: Dict[str, Dict[str, datetime]]):
+        for user_id, fields in updates.items():
+            record = self._record(user_id)
+            if record is None:
+                continue
+            for field, value in fields.items():
+                current = record.get(field)
+                if current is None or current < _as_stored(value):
+                    record.set(field, value)
+            self._bump_version(record)
+
+    async def existing_emails(self, emails: Iterable[str]) -> Set[str]:
+        return {email for email in emails if email in self._by_email}
+
+    async def iterate_emails(self) -> AsyncIterator[str]:
+        for email in list(self._by_email):
+            yield email
+
+    async def archive_inactive(self, cutoff: datetime, limit: int) -> List[str]:
+        cutoff = _as_stored(cutoff)
+        archived = []
+        archived_at = _as_stored(datetime.now(timezone.utc))
+        for slot, record in enumerate(self._slots):
+            if len(archived) == limit:
+                break
+            if record is None or record.isactive or record.modified >= cutoff:
+                continue
+            doc = record.to_doc(tuple(field for field in _UserRecord.READ_FIELDS if field != "token"))
+            doc["archived"] = archived_at
+            self._archive[record.id] = doc
+            # El slot queda vacío para no mover los demás (el orden por _id se mantiene)
+            self._slots[slot] = None
+            del self._by_id[record.id]
+            del self._by_email[record.email]
+            archived.append(record.id)
+        return archived
+
+    async def is_archived(self, user_id: str) -> bool:
+        return user_id in self._archive
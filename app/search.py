@@ -0,0 +1,121 @@
+# search.py - Filtros de búsqueda de usuarios, su traducción a consultas de MongoDB y resumen de sus planes
+import re
+from datetime import datetime, timezone
+from typing import Any, Callable, Optional
+
+from pydantic import BaseModel
+
+
+def _naive_utc(value: datetime) -> datetime:
+    """Mismo criterio que MongoDB: comparar en UTC y sin zona horaria"""
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+class UserFilters(BaseModel):
+    """
+    Filtros de GET /usuarios. Cada uno tiene un índice que lo respalda (ver
+    indexes.py), por lo que cualquier combinación se resuelve con un index scan.
+    Los prefijos se traducen a regex anclados, que MongoDB acota con el índice.
+    """
+    email: Optional[str] = None
+    email_prefix: Optional[str] = None
+    name_prefix: Optional[str] = None
+    isactive: Optional[bool] = None
+    created_from: Optional[datetime] = None
+    created_to: Optional[datetime] = None
+    modified_from: Optional[datetime] = None
+    modified_to: Optional[datetime] = None
+    contrycode: Optional[str] = None
+    citycode: Optional[str] = None
+
+    def is_empty(self) -> bool:
+        return not self.model_dump(exclude_none=True)
+
+    def to_query(self) -> dict:
+        """Consulta de MongoDB equivalente a los filtros"""
+        query = {}
+        if self.email is not None:
+            query["email"] = self.email
+        if self.email_prefix is not None:
+            prefix = {"$regex": "^" + re.escape(self.email_prefix)}
+            if "email" in query:
+                query["$and"] = [{"email": prefix}]
+            else:
+                query["email"] = prefix
+        if self.name_prefix is not None:
+            query["name"] = {"$regex": "^" + re.escape(self.name_prefix)}
+        if self.isactive is not None:
+            query["isactive"] = self.isactive
+        for field in ("created", "modified"):
+            bounds = {}
+            if getattr(self, f"{field}_from") is not None:
+                bounds["$gte"] = getattr(self, f"{field}_from")
+            if getattr(self, f"{field}_to") is not None:
+                bounds["$lt"] = getattr(self, f"{field}_to")
+            if bounds:
+                query[field] = bounds
+        # Código de país y de ciudad deben coincidir en el mismo teléfono
+        phone = {}
+        if self.contrycode is not None:
+            phone["contrycode"] = self.contrycode
+        if self.citycode is not None:
+            phone["citycode"] = self.citycode
+        if phone:
+            query["phones"] = {"$elemMatch": phone}
+        return query
+
+    def matches(self, get: Callable[[str], Any]) -> bool:
+        """Evaluar los filtros en memoria; `get` devuelve el valor de un campo"""
+        if self.email is not None and get("email") != self.email:
+            return False
+        if self.email_prefix is not None and not get("email").startswith(self.email_prefix):
+            return False
+        if self.name_prefix is not None and not get("name").startswith(self.name_prefix):
+            return False
+        if self.isactive is not None and get("isactive") != self.isactive:
+            return False
+        for field in ("created", "modified"):
+            lower = getattr(self, f"{field}_from")
+            upper = getattr(self, f"{field}_to")
+            if lower is None and upper is None:
+                continue
+            value = get(field)
+            if lower is not None and value < _naive_utc(lower):
+                return False
+            if upper is not None and value >= _naive_utc(upper):
+                return False
+        if self.contrycode is not None or self.citycode is not None:
+            return any(
+                (self.contrycode is None or phone["contrycode"] == self.contrycode)
+                and (self.citycode is None or phone["citycode"] == self.citycode)
+                for phone in get("phones")
+            )
+        return True
+
+
+def _walk_plan(plan: dict, stages: list, indexes: list, filtered: list):
+    """Recorrer el árbol del plan ganador juntando etapas, índices usados y etapas con filtro residual"""
+    stages.append(plan.get("stage"))
+    if plan.get("indexName"):
+        indexes.append(plan["indexName"])
+    if plan.get("filter"):
+        filtered.append(plan.get("stage"))
+    for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+        if child:
+            _walk_plan(child, stages, indexes, filtered)
+
+
+def plan_summary(winning_plan: dict) -> dict:
+    """
+    Etapas e índices del plan ganador y si recorre toda la colección: un
+    COLLSCAN, o el índice `_id_` (el orden de la paginación) con los filtros
+    evaluados documento por documento, que lee lo mismo que un COLLSCAN
+    """
+    # Con el motor SBE el árbol clásico queda bajo queryPlan
+    winning_plan = winning_plan.get("queryPlan", winning_plan)
+    stages, indexes, filtered = [], [], []
+    _walk_plan(winning_plan, stages, indexes, filtered)
+    id_scan = bool(filtered) and set(indexes) <= {"_id_"}
+    return {"stages": stages, "indexes": indexes, "collscan": "COLLSCAN" in stages or id_scan}
@@ -0,0 +1,86 @@
+# serialization.py - Serialización directa de documentos de MongoDB a JSON
+from typing import Any, List, Optional, Sequence, Tuple
+
+import orjson
+
+# Mismo formato que pydantic para datetimes UTC ("...Z")
+ORJSON_OPTIONS = orjson.OPT_UTC_Z
+
+USER_RESPONSE_FIELDS = (
+    "id", "name", "email", "phones", "created", "modified", "last_login", "isactive"
+)
+# El token es una credencial: solo se devuelve a su dueño (registro, login y
+# sus propias modificaciones), nunca en lecturas, listados ni el feed de cambios
+TOKEN_RESPONSE_FIELDS = USER_RESPONSE_FIELDS + ("token",)
+PHONE_FIELDS = ("number", "citycode", "contrycode")
+
+def parse_fields(fields: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """
+    Campos pedidos con `fields=id,name,email`, en el orden de UserResponse.
+    None si no se pidió ninguno; ValueError si alguno no es parte de la respuesta.
+    """
+    if fields is None:
+        return None
+    requested = {field.strip() for field in fields.split(",") if field.strip()}
+    unknown = requested.difference(USER_RESPONSE_FIELDS)
+    if unknown:
+        raise ValueError(f"Campos desconocidos: {', '.join(sorted(unknown))}")
+    if not requested:
+        raise ValueError("Se debe indicar al menos un campo")
+    return tuple(field for field in USER_RESPONSE_FIELDS if field in requested)
+
+
+def user_doc_to_wire(user_doc: dict, fields: Optional[Sequence[str]] = None) -> dict:
+    """
+    Documento de MongoDB con la forma de UserResponse, sin pasar por pydantic.
+    Descarta _id, password, token y cualquier campo interno. Con `fields` solo
+    se incluyen esos campos.
+    """
+    wire = {field: user_doc[field] for field in fields or USER_RESPONSE_FIELDS}
+    if "phones" in wire:
+        wire["phones"] = [
+            {field: phone[field] for field in PHONE_FIELDS} for phone in user_doc["phones"]
+        ]
+    return wire
+
+
+def dumps(value: Any) -> bytes:
+    """Serializar a JSON con orjson"""
+    return orjson.dumps(value, option=ORJSON_OPTIONS)
+
+
+def user_version(user_doc: dict) -> int:
+    """`version` del documento; 0 si se creó antes de que existiera el campo"""
+    return user_doc.get("version") or 0
+
+
+def user_etag(version: int) -> str:
+    """
+    ETag fuerte: la `version` del documento, que se incrementa en cada escritura
+    (incluido el last_login diferido)
+    """
+    return f'"{version}"'
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """If-None-Match: comparación débil contra cualquiera de las etiquetas"""
+    if header.strip() == "*":
+        return True
+    value = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == value for tag in header.split(","))
+
+
+def parse_if_match(header: str) -> Optional[List[int]]:
+    """
+    Versiones aceptadas por un If-Match; None si es "*" (basta con que el usuario
+    exista). If-Match usa comparación fuerte: las etiquetas débiles (W/) y las
+    que no vienen de user_etag no coinciden con ninguna versión.
+    """
+    if header.strip() == "*":
+        return None
+    versions = []
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith('"') and tag.endswith('"') and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
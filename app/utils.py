@@ -1,5 +1,12 @@
 # utils.py - Funciones puras
+import base64
+import binascii
+import time
+from datetime import timedelta
+
 import jwt
+from bson import ObjectId
+from bson.errors import InvalidId
 from passlib.context import CryptContext
 from pydantic import BaseModel, EmailStr, validator
 from typing import List, Optional
@@ -66,13 +73,27 @@ class UserUpdateRequest(BaseModel):
         return v
 
 
-def create_access_token(data: dict) -> str:
-    """Crear token JWT"""
+class LoginRequest(BaseModel):
+    email: EmailStr
+    password: str
+
+
+def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
+    """Crear token JWT; con expires_delta incluye iat y exp"""
     to_encode = data.copy()
+    if expires_delta is not None:
+        now = time.time()
+        to_encode["iat"] = now
+        to_encode["exp"] = now + expires_delta.total_seconds()
     token = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return token
 
 
+def decode_access_token(token: str) -> dict:
+    """Verificar firma y expiración del token; jwt.PyJWTError si no es válido"""
+    return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM], options={"require": ["exp", "user_id"]})
+
+
 def hash_password(password: str) -> str:
     """Hash de la contraseña"""
     return pwd_context.hash(password)
@@ -81,3 +102,17 @@ def hash_password(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verificar contraseña"""
     return pwd_context.verify(plain_password, hashed_password)
+
+
+def encode_cursor(object_id: ObjectId) -> str:
+    """Codificar el _id del último documento como cursor opaco"""
+    return base64.urlsafe_b64encode(object_id.binary).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> ObjectId:
+    """Decodificar un cursor opaco al _id desde el que continuar la paginación"""
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        return ObjectId(base64.urlsafe_b64decode(cursor + padding))
+    except (binascii.Error, InvalidId, TypeError, ValueError):
+        raise ValueError('El cursor de paginación no es válido')
@@ -0,0 +1,106 @@
+# write_behind.py - Buffer write-behind que agrupa actualizaciones de timestamps por usuario
+import asyncio
+import logging
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, Optional
+
+# user_id -> {campo: timestamp}
+PendingWrites = Dict[str, Dict[str, datetime]]
+
+
+class WriteBehindBuffer:
+    """
+    Acumula timestamps de baja prioridad (last_login) en memoria y los escribe
+    en lote con `flush_fn`. Varias marcas del mismo usuario y campo antes del
+    flush se fusionan en una (gana la más reciente). El flush ocurre cada
+    `flush_interval` segundos o antes si hay `max_pending` usuarios pendientes.
+    Se usa solo desde el event loop, por lo que no requiere locks.
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[PendingWrites], Awaitable[None]],
+        max_pending: int = 1000,
+        flush_interval: float = 1.0
+    ):
+        self._flush_fn = flush_fn
+        self._max_pending = max_pending
+        self._flush_interval = flush_interval
+        self._pending: PendingWrites = {}
+        self._wake = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+        self.touched = 0
+        self.coalesced = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.errors = 0
+
+    def touch(self, user_id: str, field: str, value: datetime):
+        """Registrar la marca sin esperar a la base"""
+        self.touched += 1
+        fields = self._pending.setdefault(user_id, {})
+        current = fields.get(field)
+        if current is not None:
+            self.coalesced += 1
+            if current >= value:
+                return
+        fields[field] = value
+        if len(self._pending) >= self._max_pending:
+            self._wake.set()
+
+    async def flush(self):
+        """Escribir lo pendiente; si falla se reencola para el siguiente intento"""
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            await self._flush_fn(batch)
+        except Exception as e:
+            self.errors += 1
+            logging.error("Error al escribir %s actualizaciones diferidas: %s", len(batch), e)
+            for user_id, fields in batch.items():
+                for field, value in fields.items():
+                    current = self._pending.setdefault(user_id, {}).get(field)
+                    if current is None or current < value:
+                        self._pending[user_id][field] = value
+            return
+        self.flushed += len(batch)
+        self.flushes += 1
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+            if self._stopping:
+                return
+
+    async def start(self):
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detener el flush periódico y escribir lo que quede pendiente"""
+        # Sin cancelar la tarea: un flush en curso termina en lugar de perder su lote
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        await self.flush()
+        logging.info("Write-behind detenido: %s", self.stats())
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "touched": self.touched,
+            "coalesced": self.coalesced,
+            "flushed": self.flushed,
+            "flushes": self.flushes,
+            "errors": self.errors,
+        }
@@ -0,0 +1,127 @@
+# async_vs_sync.py - Compara el camino síncrono (pymongo + threadpool) con el asíncrono
+#
+# Uso (requiere un MongoDB accesible):
+#   MONGO_HOST=localhost python benchmarks/async_vs_sync.py --concurrency 200 --duration 20
+#
+# Levanta dos aplicaciones mínimas con uvicorn que resuelven GET /usuarios/{id}
+# con find_one: una con handlers `def` y MongoClient, otra con `async def` y
+# AsyncMongoClient. Ambas se cargan con el mismo número de clientes concurrentes
+# y se reporta req/s, p50 y p99.
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+from fastapi import FastAPI, HTTPException
+from pymongo import AsyncMongoClient, MongoClient
+
+MONGO_HOST = os.environ.get("MONGO_HOST", "localhost")
+MONGO_PORT = int(os.environ.get("MONGO_PORT", "27017"))
+BENCH_DATABASE = "users_service_bench"
+
+# Aplicación con el camino síncrono actual (threadpool de Starlette)
+sync_app = FastAPI()
+sync_client = MongoClient(MONGO_HOST, MONGO_PORT, connect=False)
+
+
+@sync_app.get("/usuarios/{user_id}")
+def sync_get_user(user_id: str):
+    user_doc = sync_client[BENCH_DATABASE].users.find_one({"id": user_id}, {"_id": 0})
+    if not user_doc:
+        raise HTTPException(status_code=404)
+    return user_doc
+
+
+# Aplicación con la capa de datos asíncrona
+async_app = FastAPI()
+async_client = AsyncMongoClient(MONGO_HOST, MONGO_PORT)
+
+
+@async_app.get("/usuarios/{user_id}")
+async def async_get_user(user_id: str):
+    user_doc = await async_client[BENCH_DATABASE].users.find_one({"id": user_id}, {"_id": 0})
+    if not user_doc:
+        raise HTTPException(status_code=404)
+    return user_doc
+
+
+def seed(users: int) -> list:
+    """Poblar la base de benchmark y devolver los ids creados"""
+    collection = MongoClient(MONGO_HOST, MONGO_PORT)[BENCH_DATABASE].users
+    collection.drop()
+    collection.create_index("id", unique=True)
+    ids = [str(uuid.uuid4()) for _ in range(users)]
+    collection.insert_many(
+        [{"id": user_id, "name": "bench", "email": f"{user_id}@bench.cl"} for user_id in ids]
+    )
+    return ids
+
+
+async def drive(base_url: str, ids: list, concurrency: int, duration: float) -> dict:
+    """Ejecutar `concurrency` clientes en paralelo durante `duration` segundos"""
+    latencies = []
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as client:
+        async def worker():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await client.get(f"/usuarios/{random.choice(ids)}")
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "rps": len(latencies) / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+    }
+
+
+def run_variant(app_name: str, port: int, ids: list, args) -> dict:
+    """Levantar la aplicación indicada en un proceso uvicorn y medirla"""
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", f"async_vs_sync:{app_name}",
+         "--port", str(port), "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env={**os.environ, "MONGO_HOST": MONGO_HOST, "MONGO_PORT": str(MONGO_PORT)},
+    )
+    try:
+        time.sleep(2)
+        base_url = f"http://127.0.0.1:{port}"
+        asyncio.run(drive(base_url, ids, args.concurrency, 2))  # calentamiento
+        return asyncio.run(drive(base_url, ids, args.concurrency, args.duration))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sync vs async de GET /usuarios/{id}")
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=128)
+    parser.add_argument("--duration", type=float, default=15)
+    args = parser.parse_args()
+
+    ids = seed(args.users)
+    for label, app_name, port in (("sync", "sync_app", 8101), ("async", "async_app", 8102)):
+        result = run_variant(app_name, port, ids, args)
+        print(f"{label:>5}: {result['rps']:8.1f} req/s  p50 {result['p50_ms']:7.2f} ms  "
+              f"p99 {result['p99_ms']:7.2f} ms  ({result['requests']} requests, "
+              f"{args.concurrency} clientes)")
+
+
+if __name__ == "__main__":
+    main()
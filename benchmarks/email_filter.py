@@ -0,0 +1,69 @@
+# email_filter.py - Filtro de Bloom de correos frente a un set de Python
+#
+# Uso:
+#   python benchmarks/email_filter.py --emails 1000000 --error-rate 0.01
+#
+# Construye el filtro con `--emails` correos, mide el tiempo de construcción y de
+# consulta, la memoria frente a un set con los mismos correos y la tasa de falsos
+# positivos observada sobre correos que no están registrados (el caso habitual al
+# registrar un usuario nuevo).
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.bloom import BloomFilter  # noqa: E402
+
+
+def make_emails(count: int) -> list:
+    return [f"{uuid.uuid4().hex}@bench.cl" for _ in range(count)]
+
+
+def set_memory(emails: list) -> int:
+    """Memoria del set sin contar los strings, que el filtro no guarda"""
+    tracemalloc.start()
+    email_set = set(emails)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del email_set
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--emails", type=int, default=1000000)
+    parser.add_argument("--error-rate", type=float, default=0.01)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    emails = make_emails(args.emails)
+    absent = make_emails(args.lookups)
+
+    bloom = BloomFilter(args.emails, args.error_rate)
+    start = time.perf_counter()
+    for email in emails:
+        bloom.add(email)
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    false_positives = sum(1 for email in absent if email in bloom)
+    lookup_seconds = time.perf_counter() - start
+
+    assert all(email in bloom for email in emails[:args.lookups]), "el filtro no debe dar falsos negativos"
+
+    print(f"Correos:                     {args.emails:,}")
+    print(f"Bits / hashes:               {bloom.size:,} / {bloom.hashes}")
+    print(f"Memoria del filtro:          {bloom.memory_bytes / 2 ** 20:.2f} MiB")
+    print(f"Memoria de un set (sin str): {set_memory(emails) / 2 ** 20:.2f} MiB")
+    print(f"Construcción:                {build_seconds:.2f} s ({args.emails / build_seconds:,.0f} correos/s)")
+    print(f"Consulta:                    {lookup_seconds / args.lookups * 1e6:.2f} µs por correo")
+    print(f"Falsos positivos esperados:  {bloom.false_positive_rate():.4%}")
+    print(f"Falsos positivos medidos:    {false_positives / args.lookups:.4%} ({false_positives:,} de {args.lookups:,})")
+
+
+if __name__ == "__main__":
+    main()
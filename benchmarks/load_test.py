@@ -0,0 +1,302 @@
+# load_test.py - Carga end-to-end de todos los endpoints de usuarios sin MongoDB
+#
+# Uso:
+#   python benchmarks/load_test.py --users 1000,100000,1000000 --concurrency 64 \
+#       --duration 30 --output results.json [--compare baseline.json]
+#
+# Por cada tamaño de datos levanta la API con USER_REPOSITORY=memory en un proceso
+# uvicorn aparte, la puebla directamente en el repositorio (sin pasar por bcrypt
+# por usuario), inicia sesión con un usuario dedicado y la carga con una mezcla
+# de lecturas y escrituras autenticadas (cada escritura con el token del usuario
+# que modifica, ya que solo el propio usuario puede hacerlo). Reporta req/s
+# y p50/p95/p99 por endpoint y guarda todo en un JSON. Con --compare se marca como
+# regresión cualquier endpoint cuyo p95 empeore o cuyo req/s caiga más que
+# --tolerance respecto de un resultado anterior.
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import httpx
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from app.utils import create_access_token  # noqa: E402
+
+PASSWORD = "Bench12"
+# Usuario fuera del rango sembrado: delete_user nunca lo desactiva
+AUTH_EMAIL = "auth@bench.cl"
+PHONES = [{"number": "123456789", "citycode": "02", "contrycode": "+56"}]
+# Vencimiento fijo (2100-01-01) de los tokens sembrados: el servidor y los
+# clientes generan el mismo JWT para cada usuario sin intercambiarlos
+SEED_TOKEN_EXP = 4102444800
+
+# Peso de cada operación en la mezcla por defecto
+DEFAULT_MIX = {
+    "get_user": 50,
+    "get_users": 15,
+    "partial_update_user": 15,
+    "update_user": 5,
+    "create_user": 10,
+    "delete_user": 5,
+}
+
+
+def seed_user_id(number: int) -> str:
+    return f"seed-{number:07d}"
+
+
+def seed_token(user_id: str) -> str:
+    return create_access_token({"user_id": user_id, "exp": SEED_TOKEN_EXP})
+
+
+def serve(users: int, port: int):
+    """Proceso servidor: poblar el repositorio en memoria y levantar uvicorn"""
+    os.environ["USER_REPOSITORY"] = "memory"
+
+    import logging
+    import uvicorn
+    from app import main
+    from app.repository import InMemoryUserRepository
+    from app.utils import hash_password
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    now = datetime.now(timezone.utc)
+    hashed_password = hash_password(PASSWORD)
+
+    def seed_doc(user_id: str, email: str) -> dict:
+        return {
+            "id": user_id,
+            "name": f"Seed {user_id}",
+            "email": email,
+            "password": hashed_password,
+            "phones": PHONES,
+            "created": now,
+            "modified": now,
+            "last_login": now,
+            "token": seed_token(user_id),
+            "isactive": True,
+        }
+
+    user_docs = [seed_doc(seed_user_id(number), f"seed-{number}@bench.cl") for number in range(users)]
+    user_docs.append(seed_doc("bench-auth", AUTH_EMAIL))
+    repository = InMemoryUserRepository()
+    asyncio.run(repository.insert_many(user_docs))
+    del user_docs
+    # El lifespan crea el repositorio: se le entrega el ya poblado
+    main.create_user_repository = lambda: repository
+
+    uvicorn.run(main.app, host="127.0.0.1", port=port, log_level="warning")
+
+
+def new_user_body() -> dict:
+    return {"name": "Bench", "email": f"{uuid.uuid4().hex}@bench.cl", "password": PASSWORD, "phones": PHONES}
+
+
+async def run_operation(client: httpx.AsyncClient, operation: str, users: int, tokens: dict):
+    user_id = seed_user_id(random.randrange(users))
+    if operation == "get_user":
+        return await client.get(f"/usuarios/{user_id}")
+    if operation == "get_users":
+        return await client.get("/usuarios", params={"limit": 50})
+    if operation == "create_user":
+        return await client.post("/usuarios", json=new_user_body())
+    # Las escrituras sobre un usuario se hacen con su propio token (el último emitido)
+    owner = {"Authorization": f"Bearer {tokens.get(user_id) or seed_token(user_id)}"}
+    if operation == "partial_update_user":
+        return await client.patch(f"/usuarios/{user_id}", json={"name": f"Bench {random.random()}"}, headers=owner)
+    if operation == "update_user":
+        body = new_user_body()
+        response = await client.put(f"/usuarios/{user_id}", json=body, headers=owner)
+        # PUT reemplaza la contraseña y con ella el token
+        if response.status_code == 200:
+            tokens[user_id] = response.json()["token"]
+        return response
+    if operation == "delete_user":
+        return await client.delete(f"/usuarios/{user_id}", headers=owner)
+    raise ValueError(f"Operación desconocida: {operation}")
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    return sorted_values[int(fraction * (len(sorted_values) - 1))]
+
+
+async def drive(base_url: str, users: int, mix: dict, concurrency: int, duration: float) -> dict:
+    """Ejecutar la mezcla con `concurrency` clientes durante `duration` segundos"""
+    operations = list(mix)
+    weights = [mix[operation] for operation in operations]
+    latencies = {operation: [] for operation in operations}
+    errors = {operation: 0 for operation in operations}
+    tokens = {}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        login = await client.post("/login", json={"email": AUTH_EMAIL, "password": PASSWORD})
+        login.raise_for_status()
+        client.headers["Authorization"] = f"Bearer {login.json()['token']}"
+        deadline = time.perf_counter() + duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                operation = random.choices(operations, weights)[0]
+                start = time.perf_counter()
+                response = await run_operation(client, operation, users, tokens)
+                elapsed = time.perf_counter() - start
+                if response.status_code >= 500:
+                    errors[operation] += 1
+                else:
+                    latencies[operation].append(elapsed)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    endpoints = {}
+    for operation, values in latencies.items():
+        values.sort()
+        endpoints[operation] = {
+            "requests": len(values),
+            "errors": errors[operation],
+            "rps": len(values) / elapsed,
+            "p50_ms": percentile(values, 0.50) * 1000 if values else None,
+            "p95_ms": percentile(values, 0.95) * 1000 if values else None,
+            "p99_ms": percentile(values, 0.99) * 1000 if values else None,
+        }
+    total = sum(len(values) for values in latencies.values())
+    return {"total_rps": total / elapsed, "endpoints": endpoints}
+
+
+def wait_until_ready(base_url: str, server: subprocess.Popen, timeout: float = 600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("El servidor terminó antes de estar disponible")
+        try:
+            if httpx.get(f"{base_url}/", timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError("El servidor no respondió a tiempo")
+
+
+def run_scenario(users: int, args, mix: dict) -> dict:
+    port = args.port
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "serve", "--users", str(users), "--port", str(port)]
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_ready(base_url, server)
+        asyncio.run(drive(base_url, users, mix, args.concurrency, args.warmup))
+        result = asyncio.run(drive(base_url, users, mix, args.concurrency, args.duration))
+    finally:
+        server.terminate()
+        server.wait()
+    return {"users": users, "concurrency": args.concurrency, "duration": args.duration, **result}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """Lista de regresiones respecto de un resultado anterior"""
+    regressions = []
+    previous = {scenario["users"]: scenario for scenario in baseline["scenarios"]}
+    for scenario in results["scenarios"]:
+        before = previous.get(scenario["users"])
+        if before is None:
+            continue
+        for operation, current in scenario["endpoints"].items():
+            old = before["endpoints"].get(operation)
+            if not old or not old["p95_ms"] or not current["p95_ms"]:
+                continue
+            if current["p95_ms"] > old["p95_ms"] * (1 + tolerance):
+                regressions.append(
+                    f"{scenario['users']} usuarios / {operation}: p95 {old['p95_ms']:.2f} -> {current['p95_ms']:.2f} ms"
+                )
+            if current["rps"] < old["rps"] * (1 - tolerance):
+                regressions.append(
+                    f"{scenario['users']} usuarios / {operation}: {old['rps']:.1f} -> {current['rps']:.1f} req/s"
+                )
+    return regressions
+
+
+def parse_mix(value: str) -> dict:
+    mix = {}
+    for part in value.split(","):
+        operation, weight = part.split("=")
+        if operation not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"Operación desconocida: {operation}")
+        mix[operation] = int(weight)
+    return mix
+
+
+def print_scenario(scenario: dict):
+    print(f"\n{scenario['users']} usuarios, {scenario['concurrency']} clientes: "
+          f"{scenario['total_rps']:.1f} req/s totales")
+    print(f"{'endpoint':<22}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'5xx':>6}")
+    for operation, stats in scenario["endpoints"].items():
+        if not stats["requests"]:
+            continue
+        print(f"{operation:<22}{stats['rps']:>10.1f}{stats['p50_ms']:>10.2f}"
+              f"{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}{stats['errors']:>6}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Carga end-to-end de la API de usuarios")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve")
+    serve_parser.add_argument("--users", type=int, required=True)
+    serve_parser.add_argument("--port", type=int, required=True)
+
+    parser.add_argument("--users", default="1000,100000",
+                        help="Tamaños de datos separados por coma (ej. 1000,100000,1000000)")
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="Pesos por endpoint, ej. get_user=80,create_user=20")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--output", default="load_test_results.json")
+    parser.add_argument("--compare", help="JSON de una ejecución anterior para detectar regresiones")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve(args.users, args.port)
+        return
+
+    results = {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "mix": args.mix,
+        "scenarios": [],
+    }
+    for users in (int(value) for value in args.users.split(",")):
+        scenario = run_scenario(users, args, args.mix)
+        print_scenario(scenario)
+        results["scenarios"].append(scenario)
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+    print(f"\nResultados guardados en {args.output}")
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESIÓN: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
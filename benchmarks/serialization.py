@@ -0,0 +1,97 @@
+# serialization.py - Costo de serializar usuarios: camino pydantic vs camino directo
+#
+# Uso:
+#   python benchmarks/serialization.py --users 10000
+#
+# "antes" reproduce lo que hacía cada handler: construir UserResponse (con un
+# Phone por teléfono), que FastAPI vuelve a validar contra response_model, pasar
+# por jsonable_encoder y codificar con json de la librería estándar.
+# "después" mapea el documento de MongoDB a dict y lo codifica con orjson.
+import argparse
+import json
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime, timezone
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.main import UserResponse, _to_user_response  # noqa: E402
+from app.serialization import dumps, user_doc_to_wire  # noqa: E402
+
+
+def make_user_doc() -> dict:
+    now = datetime.now(timezone.utc)
+    user_id = str(uuid.uuid4())
+    return {
+        "_id": ObjectId(),
+        "id": user_id,
+        "name": "Usuario Benchmark",
+        "email": f"{user_id}@bench.cl",
+        "password": "$2b$12$" + "x" * 53,
+        "phones": [
+            {"number": "123456789", "citycode": "02", "contrycode": "+56"},
+            {"number": "987654321", "citycode": "09", "contrycode": "+56"},
+        ],
+        "created": now,
+        "modified": now,
+        "last_login": now,
+        "token": "eyJ" + "a" * 150,
+        "isactive": True,
+    }
+
+
+single_adapter = TypeAdapter(UserResponse)
+
+
+def before_one(user_doc: dict) -> bytes:
+    model = _to_user_response(user_doc)
+    validated = single_adapter.validate_python(model, from_attributes=True)
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def before_many(user_docs: list) -> bytes:
+    models = [_to_user_response(user_doc) for user_doc in user_docs]
+    validated = [single_adapter.validate_python(model, from_attributes=True) for model in models]
+    return json.dumps(jsonable_encoder(validated)).encode()
+
+
+def after_one(user_doc: dict) -> bytes:
+    return dumps(user_doc_to_wire(user_doc))
+
+
+def after_many(user_docs: list) -> bytes:
+    return dumps([user_doc_to_wire(user_doc) for user_doc in user_docs])
+
+
+def measure(fn, arg, number: int) -> float:
+    """Mejor de 5 repeticiones, en microsegundos por llamada"""
+    return min(timeit.repeat(lambda: fn(arg), number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de serialización de usuarios")
+    parser.add_argument("--users", type=int, default=10000)
+    args = parser.parse_args()
+
+    user_doc = make_user_doc()
+    user_docs = [make_user_doc() for _ in range(args.users)]
+
+    one_before = measure(before_one, user_doc, 2000)
+    one_after = measure(after_one, user_doc, 2000)
+    many_before = measure(before_many, user_docs, 3)
+    many_after = measure(after_many, user_docs, 3)
+
+    print(f"1 usuario:       antes {one_before:9.1f} us   después {one_after:9.1f} us   "
+          f"x{one_before / one_after:.1f}")
+    print(f"{args.users} usuarios: antes {many_before / 1000:9.1f} ms   después {many_after / 1000:9.1f} ms   "
+          f"x{many_before / many_after:.1f}  ({many_after / args.users:.2f} us/usuario)")
+
+
+if __name__ == "__main__":
+    main()
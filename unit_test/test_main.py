@@ -1,7 +1,41 @@
 # test_main.py
-from utils import hash_password, create_access_token, Phone, UserRequest, UserUpdateRequest
+import os
+# La API se prueba con el repositorio en memoria, sin MongoDB
+os.environ.setdefault("USER_REPOSITORY", "memory")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+from fastapi.testclient import TestClient
+from app import main as api
+from app.utils import hash_password, verify_password, create_access_token, decode_access_token, Phone, UserRequest, UserUpdateRequest, encode_cursor, decode_cursor
+from app.auth import VerifiedTokenCache
+from app.write_behind import WriteBehindBuffer
+from app.search import UserFilters, plan_summary
+from app.changes import ChangeFeedExpired, ChangeLogFeed, ChangeStreamFeed, InMemoryChangeFeed, decode_resume_token, encode_resume_token
+from app.hashing import HashingOverloaded, PasswordHasher
+from app.health import CachedProbe
+from app.circuit import CircuitBreaker, CircuitOpen
+from app.bloom import BloomFilter, EmailFilter, MongoFilterSnapshot
+from app.archive import UserArchiver
+from app.lease import MongoLease
+from app.idempotency import IdempotencyConflict, IdempotencyManager, InMemoryIdempotencyStore, StoredResponse, request_fingerprint
+from app.cache import ChangeFeedInvalidationBackend, ChangeStreamInvalidationBackend, InMemoryInvalidationBackend, LRUTTLCache
+from app.export import CSV_COLUMNS, accepts_gzip, csv_chunks, gzip_chunks, ndjson_chunks
+from app.serialization import dumps, etag_matches, parse_fields, parse_if_match, user_doc_to_wire, user_etag
+from app.repository import DuplicateEmailError, InMemoryUserRepository, VersionMismatchError
+from app.metrics import CommandMetricsListener, MetricsMiddleware
+from app.logs import JsonFormatter, NonBlockingQueueHandler, SamplingFilter
+from prometheus_client import REGISTRY
+from types import SimpleNamespace
+from contextlib import contextmanager
+import gzip
+import json
+import logging
+import queue
+import asyncio
 import unittest
-from datetime import datetime, timezone
+import uuid
+from bson import ObjectId
+from pymongo.errors import DuplicateKeyError, ServerSelectionTimeoutError
+from datetime import datetime, timedelta, timezone
 import jwt
 from pydantic import ValidationError
 
@@ -43,6 +77,14 @@ class TestCreateAccessToken(unittest.TestCase):
         self.assertIsInstance(token, str)
         decoded = jwt.decode(token, TEST_SECRET_KEY, algorithms=["HS256"])
         self.assertEqual(decoded, {})
+    
+    def test_create_access_token_with_expiry(self):
+        token = create_access_token({"user_id": "123"}, timedelta(minutes=5))
+        claims = decode_access_token(token)
+        self.assertAlmostEqual(claims["exp"] - claims["iat"], 300, places=3)
+        expired = create_access_token({"user_id": "123"}, timedelta(seconds=-1))
+        with self.assertRaises(jwt.ExpiredSignatureError):
+            decode_access_token(expired)
 
 class TestPhoneModel(unittest.TestCase):
     def test_phone_valid_data(self):
@@ -154,5 +196,1339 @@ class TestUserUpdateRequestModel(unittest.TestCase):
         self.assertEqual(len(user_update.phones), 1)
         self.assertEqual(user_update.phones[0].number, "987654321")
 
+class TestCursor(unittest.TestCase):
+    def test_cursor_round_trip(self):
+        object_id = ObjectId()
+        self.assertEqual(decode_cursor(encode_cursor(object_id)), object_id)
+    
+    def test_cursor_is_opaque_string(self):
+        cursor = encode_cursor(ObjectId())
+        self.assertIsInstance(cursor, str)
+        self.assertNotIn("=", cursor)
+    
+    def test_decode_cursor_invalid(self):
+        with self.assertRaises(ValueError):
+            decode_cursor("cursor-invalido")
+
+class TestPasswordHasher(unittest.TestCase):
+    def setUp(self):
+        self.hasher = PasswordHasher(hash_password, verify_password, workers=1, max_queue=0, retry_after=3)
+    
+    def tearDown(self):
+        self.hasher.shutdown()
+    
+    def test_hash_and_verify_in_pool(self):
+        async def run():
+            hashed = await self.hasher.hash("TestPass123")
+            return await self.hasher.verify("TestPass123", hashed)
+        self.assertTrue(asyncio.run(run()))
+    
+    def test_hash_many_keeps_order(self):
+        passwords = ["TestPass12", "TestPass34", "TestPass56"]
+        hashes = asyncio.run(self.hasher.hash_many(passwords))
+        self.assertEqual(len(hashes), 3)
+        for password, hashed in zip(passwords, hashes):
+            self.assertTrue(verify_password(password, hashed))
+    
+    def test_rejects_when_queue_full(self):
+        async def run():
+            return await asyncio.gather(
+                self.hasher.hash("TestPass123"),
+                self.hasher.hash("TestPass456"),
+                return_exceptions=True
+            )
+        first, second = asyncio.run(run())
+        self.assertIsInstance(first, str)
+        self.assertIsInstance(second, HashingOverloaded)
+        self.assertEqual(second.retry_after, 3)
+        self.assertEqual(self.hasher.pending, 0)
+    
+    def test_hash_many_rejected_without_free_slots(self):
+        async def run():
+            return await asyncio.gather(
+                self.hasher.hash("TestPass123"),
+                self.hasher.hash_many(["TestPass12", "TestPass34"]),
+                return_exceptions=True
+            )
+        single, batch = asyncio.run(run())
+        self.assertIsInstance(single, str)
+        self.assertIsInstance(batch, HashingOverloaded)
+        self.assertEqual(self.hasher.pending, 0)
+    
+    def test_single_hash_interleaves_with_batch(self):
+        hasher = PasswordHasher(hash_password, verify_password, workers=1, max_queue=1, bulk_chunk_size=1)
+        finished = []
+        async def track(name, operation):
+            await operation
+            finished.append(name)
+        async def run():
+            batch = asyncio.create_task(track("batch", hasher.hash_many(["TestPass12", "TestPass34", "TestPass56"])))
+            await asyncio.sleep(0)
+            await asyncio.gather(batch, track("single", hasher.hash("TestPass78")))
+        try:
+            asyncio.run(run())
+        finally:
+            hasher.shutdown()
+        # El hash individual no espera a que termine el lote completo
+        self.assertEqual(finished, ["single", "batch"])
+    
+    def test_reports_duration_per_hash(self):
+        durations = []
+        hasher = PasswordHasher(hash_password, verify_password, workers=1,
+                                on_duration=lambda operation, seconds: durations.append((operation, seconds)))
+        try:
+            asyncio.run(hasher.hash_many(["TestPass12", "TestPass34"]))
+        finally:
+            hasher.shutdown()
+        self.assertEqual([operation for operation, _ in durations], ["hash", "hash"])
+        self.assertTrue(all(seconds > 0 for _, seconds in durations))
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self):
+        return self.now
+
+class TestLRUTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = LRUTTLCache(maxsize=2, ttl=10, clock=self.clock)
+    
+    def test_hit_and_miss_counters(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.set("a", b"1")
+        self.assertEqual(self.cache.get("a"), b"1")
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+    
+    def test_evicts_least_recently_used(self):
+        self.cache.set("a", b"1")
+        self.cache.set("b", b"2")
+        self.cache.get("a")
+        self.cache.set("c", b"3")
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(self.cache.get("a"), b"1")
+    
+    def test_expires_after_ttl(self):
+        self.cache.set("a", b"1")
+        self.clock.now = 10
+        self.assertIsNone(self.cache.get("a"))
+    
+    def test_set_ignored_after_concurrent_invalidation(self):
+        generation = self.cache.generation
+        self.cache.invalidate("a")
+        self.cache.set("a", b"viejo", generation)
+        self.assertIsNone(self.cache.get("a"))
+    
+    def test_invalidation_backend_reaches_all_caches(self):
+        other = LRUTTLCache(maxsize=2, ttl=10, clock=self.clock)
+        backend = InMemoryInvalidationBackend()
+        backend.subscribe(self.cache.invalidate)
+        backend.subscribe(other.invalidate)
+        self.cache.set("a", b"1")
+        other.set("a", b"1")
+        asyncio.run(backend.publish("a"))
+        self.assertIsNone(self.cache.get("a"))
+        self.assertIsNone(other.get("a"))
+
+    def test_change_stream_delete_invalidates_archived_user(self):
+        events = [
+            {"operationType": "update", "documentKey": {"_id": 1}, "fullDocument": {"id": "user-1"}},
+            {"operationType": "delete", "documentKey": {"_id": 2}},
+            {"operationType": "delete", "documentKey": {"_id": 3}},
+        ]
+        backend = ChangeStreamInvalidationBackend(FakeWatchCollection(events), FakeArchive({2: "user-2"}))
+        received = []
+        backend.subscribe(received.append)
+        async def run():
+            await backend.start()
+            for _ in range(100):
+                if len(received) == len(events):
+                    break
+                await asyncio.sleep(0.01)
+            await backend.stop()
+        asyncio.run(run())
+        # Un borrado sin copia en el archivo vacía todo el cache (None)
+        self.assertEqual(received, ["user-1", "user-2", None])
+
+class FakeWatchCollection:
+    """Change stream que entrega los eventos dados y luego queda abierto"""
+    def __init__(self, events):
+        self.events = events
+    
+    async def watch(self, pipeline, **kwargs):
+        return self
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        return False
+    
+    async def __aiter__(self):
+        for event in self.events:
+            yield event
+        await asyncio.Event().wait()
+
+class FakeArchive:
+    def __init__(self, ids):
+        self.ids = ids
+    
+    async def find_one(self, query, projection=None):
+        user_id = self.ids.get(query["_id"])
+        return None if user_id is None else {"id": user_id}
+
+async def _aiter(items):
+    for item in items:
+        yield item
+
+async def _collect(chunks):
+    return b"".join([chunk async for chunk in chunks])
+
+EXPORT_DOC = {
+    "id": "123",
+    "name": "Test User",
+    "email": "test@domain.cl",
+    "phones": [{"number": "123456789", "citycode": "02", "contrycode": "+56"}],
+    "created": datetime(2024, 1, 1, tzinfo=timezone.utc),
+    "modified": datetime(2024, 1, 2, tzinfo=timezone.utc),
+    "last_login": datetime(2024, 1, 3, tzinfo=timezone.utc),
+    "isactive": True
+}
+
+class TestCachedProbe(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.calls = 0
+    
+    async def _ping(self):
+        self.calls += 1
+        if self.calls > 1:
+            raise ConnectionError("sin conexión")
+    
+    def test_result_is_cached_until_ttl(self):
+        probe = CachedProbe(self._ping, ttl=2, clock=self.clock)
+        self.assertTrue(asyncio.run(probe()))
+        self.assertTrue(asyncio.run(probe()))
+        self.assertEqual(self.calls, 1)
+        self.clock.now += 3
+        self.assertFalse(asyncio.run(probe()))
+        self.assertEqual(probe.error, "sin conexión")
+    
+    def test_slow_check_times_out(self):
+        async def hang():
+            await asyncio.sleep(10)
+        probe = CachedProbe(hang, timeout=0.01, clock=self.clock)
+        self.assertFalse(asyncio.run(probe()))
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.states = []
+        self.breaker = CircuitBreaker(
+            failure_rate=0.5, slow_call_rate=0.5, slow_call_seconds=1, window_size=10, min_calls=4,
+            open_seconds=5, half_open_calls=2, is_failure=lambda exc: isinstance(exc, ConnectionError),
+            clock=self.clock, on_state_change=self.states.append
+        )
+    
+    def _call(self, error=None, seconds=0):
+        async def operation():
+            self.clock.now += seconds
+            if error is not None:
+                raise error
+            return "ok"
+        try:
+            return asyncio.run(self.breaker.call(operation))
+        except (ConnectionError, ValueError, CircuitOpen) as exc:
+            return exc
+    
+    def test_opens_on_failure_rate_ignoring_other_errors(self):
+        for _ in range(4):
+            self._call(ValueError("correo duplicado"))
+        self.assertEqual(self.breaker.state, "closed")
+        self._call(ConnectionError())
+        self._call(ConnectionError())
+        self._call(ConnectionError())
+        self.assertEqual(self.breaker.state, "closed")
+        self._call(ConnectionError())
+        self.assertEqual(self.breaker.state, "open")
+        rejected = self._call()
+        self.assertIsInstance(rejected, CircuitOpen)
+        self.assertEqual(rejected.retry_after, 5)
+    
+    def test_half_open_closes_after_successful_trials_or_reopens(self):
+        for _ in range(4):
+            self._call(seconds=2)
+        self.assertEqual(self.breaker.state, "open")
+        self.clock.now += 5
+        self.assertEqual(self._call(), "ok")
+        self.assertEqual(self._call(ConnectionError()).__class__, ConnectionError)
+        self.assertEqual(self.breaker.state, "open")
+        self.clock.now += 5
+        self._call()
+        self._call()
+        self.assertEqual(self.states, ["open", "half_open", "open", "half_open", "closed"])
+    
+    def test_stream_counts_failure_once_without_measuring_duration(self):
+        async def users(fail):
+            yield {"id": "user-1"}
+            self.clock.now += 100
+            if fail:
+                raise ConnectionError()
+        async def collect(fail):
+            return [user async for user in self.breaker.stream(users(fail))]
+        self.assertEqual(len(asyncio.run(collect(False))), 1)
+        with self.assertRaises(ConnectionError):
+            asyncio.run(collect(True))
+        self.assertEqual(self.breaker.stats()["calls"], 2)
+        self.assertEqual(self.breaker.stats()["failure_rate"], 0.5)
+        self.assertEqual(self.breaker.stats()["slow_call_rate"], 0.0)
+
+class TestVerifiedTokenCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.now = 1000.0
+        self.tokens = VerifiedTokenCache(LRUTTLCache(maxsize=10, ttl=300, clock=self.clock), wall_clock=lambda: self.now)
+    
+    def test_entry_expires_with_token(self):
+        self.tokens.set("token-a", {"user_id": "user-1", "exp": self.now + 30})
+        self.assertEqual(self.tokens.get("token-a")["user_id"], "user-1")
+        self.clock.now += 31
+        self.assertIsNone(self.tokens.get("token-a"))
+    
+    def test_invalidate_user_drops_its_token(self):
+        self.tokens.set("token-a", {"user_id": "user-1", "exp": self.now + 60})
+        self.tokens.set("token-b", {"user_id": "user-2", "exp": self.now + 60})
+        self.tokens.invalidate("user-1")
+        self.assertIsNone(self.tokens.get("token-a"))
+        self.assertIsNotNone(self.tokens.get("token-b"))
+        self.tokens.invalidate()
+        self.assertIsNone(self.tokens.get("token-b"))
+    
+    def test_set_ignored_after_concurrent_invalidation(self):
+        generation = self.tokens.generation
+        self.tokens.invalidate("user-1")
+        self.tokens.set("token-a", {"user_id": "user-1", "exp": self.now + 60}, generation)
+        self.assertIsNone(self.tokens.get("token-a"))
+
+    def test_user_index_bounded_by_cache(self):
+        tokens = VerifiedTokenCache(LRUTTLCache(maxsize=2, ttl=300, clock=self.clock), wall_clock=lambda: self.now)
+        for number in range(5):
+            tokens.set(f"token-{number}", {"user_id": f"user-{number}", "exp": self.now + 60})
+        self.assertEqual(tokens.stats()["users"], 2)
+        # Un token reemplazado que sale del cache no borra el vigente del usuario
+        tokens.set("token-new", {"user_id": "user-4", "exp": self.now + 60})
+        tokens.set("token-other", {"user_id": "user-5", "exp": self.now + 60})
+        self.assertEqual(tokens.stats()["users"], 2)
+        tokens.invalidate("user-4")
+        self.assertIsNone(tokens.get("token-new"))
+        self.clock.now += 301
+        self.assertIsNone(tokens.get("token-other"))
+        self.assertEqual(tokens.stats()["users"], 0)
+
+class TestWriteBehindBuffer(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        async def flush(batch):
+            self.batches.append(batch)
+        self.buffer = WriteBehindBuffer(flush, max_pending=2, flush_interval=60)
+    
+    def test_coalesces_per_user_keeping_latest(self):
+        early = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        late = datetime(2024, 1, 2, tzinfo=timezone.utc)
+        self.buffer.touch("user-1", "last_login", late)
+        self.buffer.touch("user-1", "last_login", early)
+        asyncio.run(self.buffer.flush())
+        self.assertEqual(self.batches, [{"user-1": {"last_login": late}}])
+        self.assertEqual(self.buffer.stats()["coalesced"], 1)
+        self.assertEqual(self.buffer.stats()["flushed"], 1)
+    
+    def test_flushes_on_size_and_on_stop(self):
+        now = datetime.now(timezone.utc)
+        async def run():
+            await self.buffer.start()
+            self.buffer.touch("user-1", "last_login", now)
+            self.buffer.touch("user-2", "last_login", now)
+            await asyncio.sleep(0.01)
+            self.buffer.touch("user-3", "last_login", now)
+            await self.buffer.stop()
+        asyncio.run(run())
+        self.assertEqual([sorted(batch) for batch in self.batches], [["user-1", "user-2"], ["user-3"]])
+    
+    def test_failed_flush_is_requeued(self):
+        async def failing(batch):
+            raise RuntimeError("sin conexión")
+        buffer = WriteBehindBuffer(failing)
+        buffer.touch("user-1", "last_login", datetime.now(timezone.utc))
+        with self.assertLogs(level="ERROR"):
+            asyncio.run(buffer.flush())
+        self.assertEqual(buffer.stats()["pending"], 1)
+        self.assertEqual(buffer.stats()["errors"], 1)
+
+class TestExport(unittest.TestCase):
+    def test_ndjson_one_user_per_line(self):
+        body = asyncio.run(_collect(ndjson_chunks(_aiter([EXPORT_DOC, EXPORT_DOC]))))
+        lines = body.decode().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0])["created"], "2024-01-01T00:00:00Z")
+    
+    def test_csv_header_and_phones(self):
+        body = asyncio.run(_collect(csv_chunks(_aiter([EXPORT_DOC])))).decode()
+        header, row = body.splitlines()
+        self.assertEqual(header.split(","), CSV_COLUMNS)
+        self.assertIn("+56-02-123456789", row)
+    
+    def test_gzip_round_trip(self):
+        body = asyncio.run(_collect(gzip_chunks(ndjson_chunks(_aiter([EXPORT_DOC])))))
+        self.assertEqual(json.loads(gzip.decompress(body))["id"], "123")
+    
+    def test_accepts_gzip_honours_qvalues(self):
+        self.assertTrue(accepts_gzip("gzip, deflate, br"))
+        self.assertTrue(accepts_gzip("br;q=1.0, GZIP;q=0.5"))
+        self.assertTrue(accepts_gzip("*"))
+        self.assertFalse(accepts_gzip("gzip;q=0"))
+        self.assertFalse(accepts_gzip("gzip;q=0.0, *"))
+        self.assertFalse(accepts_gzip("identity"))
+        self.assertFalse(accepts_gzip(None))
+
+class TestSerialization(unittest.TestCase):
+    def setUp(self):
+        self.user_doc = dict(
+            EXPORT_DOC,
+            _id=ObjectId(),
+            password="hash",
+            token="token",
+            phones=[{"number": "123456789", "citycode": "02", "contrycode": "+56", "extra": "x"}]
+        )
+    
+    def test_wire_drops_internal_fields(self):
+        wire = user_doc_to_wire(self.user_doc)
+        self.assertNotIn("_id", wire)
+        self.assertNotIn("password", wire)
+        self.assertNotIn("token", wire)
+        self.assertEqual(wire["phones"], [{"number": "123456789", "citycode": "02", "contrycode": "+56"}])
+    
+    def test_wire_with_fields(self):
+        self.assertEqual(user_doc_to_wire(self.user_doc, ("id", "email")), {"id": "123", "email": "test@domain.cl"})
+    
+    def test_parse_fields(self):
+        self.assertIsNone(parse_fields(None))
+        self.assertEqual(parse_fields("email, id,name"), ("id", "name", "email"))
+        with self.assertRaises(ValueError):
+            parse_fields("id,password")
+        with self.assertRaises(ValueError):
+            parse_fields("id,token")
+    
+    def test_if_match_uses_strong_comparison(self):
+        self.assertEqual(user_etag(7), '"7"')
+        self.assertEqual(parse_if_match('"otro", "7", W/"8", "9"'), [7, 9])
+        self.assertEqual(parse_if_match('W/"7"'), [])
+        self.assertIsNone(parse_if_match("*"))
+    
+    def test_etag_matches_weak_comparison(self):
+        etag = user_etag(7)
+        self.assertTrue(etag_matches('"otro", W/"7"', etag))
+        self.assertTrue(etag_matches("*", etag))
+        self.assertFalse(etag_matches('"1"', etag))
+    
+    def test_dumps_matches_pydantic_datetime_format(self):
+        body = json.loads(dumps(user_doc_to_wire(self.user_doc)))
+        self.assertEqual(body["created"], "2024-01-01T00:00:00Z")
+
+def _repo_user(number):
+    return dict(EXPORT_DOC, id=f"user-{number}", email=f"user{number}@domain.cl", password="hash", token="token")
+
+class TestUserFilters(unittest.TestCase):
+    def test_to_query_uses_anchored_prefixes_and_elem_match(self):
+        since = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        query = UserFilters(email_prefix="a.b", name_prefix="Ju", isactive=True,
+                            created_from=since, contrycode="56", citycode="2").to_query()
+        self.assertEqual(query, {
+            "email": {"$regex": "^a\\.b"},
+            "name": {"$regex": "^Ju"},
+            "isactive": True,
+            "created": {"$gte": since},
+            "phones": {"$elemMatch": {"contrycode": "56", "citycode": "2"}}
+        })
+    
+    def test_matches_in_memory(self):
+        # Como en el repositorio: datetimes guardados en UTC sin zona horaria
+        doc = dict(EXPORT_DOC, email="juan@rodriguez.org", modified=datetime(2024, 1, 2))
+        modified = datetime(2024, 1, 2, tzinfo=timezone.utc)
+        self.assertTrue(UserFilters(email_prefix="juan@", contrycode="+56").matches(doc.get))
+        self.assertFalse(UserFilters(contrycode="+56", citycode="2").matches(doc.get))
+        self.assertFalse(UserFilters(modified_to=modified).matches(doc.get))
+        self.assertTrue(UserFilters(modified_from=modified).matches(doc.get))
+    
+    def test_is_empty(self):
+        self.assertTrue(UserFilters().is_empty())
+        self.assertFalse(UserFilters(isactive=False).is_empty())
+
+    def test_plan_summary_flags_id_index_with_residual_filter(self):
+        id_scan = {"stage": "FETCH", "filter": {"phones": {"$elemMatch": {"citycode": {"$eq": "2"}}}},
+                   "inputStage": {"stage": "IXSCAN", "indexName": "_id_"}}
+        self.assertTrue(plan_summary(id_scan)["collscan"])
+        # Solo el rango de _id del cursor: se recorre el índice sin filtrar documentos
+        page = {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "indexName": "_id_"}}
+        self.assertFalse(plan_summary(page)["collscan"])
+        by_city = {"queryPlan": {"stage": "FETCH", "filter": {"phones": {}},
+                                 "inputStage": {"stage": "IXSCAN", "indexName": "phones_citycode_id"}}}
+        self.assertEqual(plan_summary(by_city), {
+            "stages": ["FETCH", "IXSCAN"], "indexes": ["phones_citycode_id"], "collscan": False
+        })
+        self.assertTrue(plan_summary({"stage": "COLLSCAN"})["collscan"])
+
+class TestChangeFeed(unittest.TestCase):
+    def setUp(self):
+        self.feed = InMemoryChangeFeed(user_doc_to_wire, maxlen=3)
+        asyncio.run(self.feed.record("create", "user-1", _repo_user(1)))
+        asyncio.run(self.feed.record("update", "user-1", _repo_user(1)))
+        asyncio.run(self.feed.record("delete", "user-1", _repo_user(1)))
+    
+    def test_read_resumes_from_token_in_order(self):
+        first, token = asyncio.run(self.feed.read(None, 2))
+        self.assertEqual([event["operacion"] for event in first], ["create", "update"])
+        self.assertNotIn("password", first[0]["usuario"])
+        rest, next_token = asyncio.run(self.feed.read(token, 10))
+        self.assertEqual([event["operacion"] for event in rest], ["delete"])
+        self.assertIsNone(rest[0]["usuario"])
+        self.assertEqual(asyncio.run(self.feed.read(next_token, 10)), ([], next_token))
+    
+    def test_invalid_and_expired_tokens(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(self.feed.read("basura", 10))
+        # Con maxlen=3 la cuarta alta descarta la primera: el token "0" ya no se conserva
+        asyncio.run(self.feed.record("create", "user-2", _repo_user(2)))
+        with self.assertRaises(ChangeFeedExpired):
+            asyncio.run(self.feed.read("0", 10))
+        events, _ = asyncio.run(self.feed.read("1", 10))
+        self.assertEqual(len(events), 3)
+    
+    def test_invalidation_backend_follows_feed(self):
+        received = []
+        backend = ChangeFeedInvalidationBackend(self.feed, poll_interval=0.01)
+        backend.subscribe(received.append)
+        async def run():
+            await backend.start()
+            # Otro worker escribe: llega como evento del feed, no por publish
+            await self.feed.record("update", "user-2", _repo_user(2))
+            for _ in range(100):
+                if received:
+                    break
+                await asyncio.sleep(0.01)
+            await backend.stop()
+        asyncio.run(run())
+        # Los cambios anteriores al arranque no se vuelven a invalidar
+        self.assertEqual(received, ["user-2"])
+    
+    def test_change_stream_events(self):
+        feed = ChangeStreamFeed(None, user_doc_to_wire)
+        user_doc = _repo_user(1)
+        def change(operation, updated=None):
+            return {"_id": {"_data": "82AB"}, "operationType": operation, "fullDocument": user_doc,
+                    "updateDescription": {"updatedFields": updated or {}}}
+        event = feed._to_event(change("insert"))
+        self.assertEqual((event["operacion"], event["id"]), ("create", "user-1"))
+        self.assertEqual(decode_resume_token(event["token"]), {"_data": "82AB"})
+        self.assertEqual(feed._to_event(change("update", {"isactive": False}))["operacion"], "delete")
+        # Las escrituras diferidas de last_login no son cambios para los consumidores
+        self.assertIsNone(feed._to_event(change("update", {"last_login": datetime(2024, 1, 1)})))
+        self.assertEqual(encode_resume_token({"_data": "82AB"}), event["token"])
+
+class FakeCursor:
+    def __init__(self, docs):
+        self._docs = docs
+    
+    def sort(self, field, direction):
+        self._docs = sorted(self._docs, key=lambda doc: doc[field])
+        return self
+    
+    def limit(self, limit):
+        self._docs = self._docs[:limit]
+        return self
+    
+    async def to_list(self):
+        return self._docs
+
+class FakeChangeLog:
+    """user_changes y counters en memoria; las inserciones de `held` esperan a `release`"""
+    def __init__(self):
+        self.docs = {}
+        self.seq = 0
+        self.held = set()
+        self.release = asyncio.Event()
+    
+    async def find_one_and_update(self, query, update, upsert, return_document):
+        self.seq += update["$inc"]["seq"]
+        return {"_id": query["_id"], "seq": self.seq}
+    
+    async def insert_one(self, doc):
+        if doc["_id"] in self.held:
+            await self.release.wait()
+        self.docs[doc["_id"]] = doc
+    
+    async def find_one(self, query, sort=None):
+        if query.get("_id") == ChangeLogFeed.COUNTER_ID:
+            return {"_id": ChangeLogFeed.COUNTER_ID, "seq": self.seq} if self.seq else None
+        return min(self.docs.values(), key=lambda doc: doc["_id"], default=None)
+    
+    def find(self, query):
+        after = query["_id"]["$gt"]
+        return FakeCursor([doc for seq, doc in self.docs.items() if seq > after])
+
+class TestChangeLogFeed(unittest.TestCase):
+    def setUp(self):
+        self.log = FakeChangeLog()
+        self.feed = ChangeLogFeed(self.log, user_doc_to_wire, counters=self.log)
+    
+    def test_read_waits_for_sequence_committed_out_of_order(self):
+        async def run():
+            # La secuencia 1 se reserva primero pero se confirma después que la 2
+            self.log.held.add(1)
+            first = asyncio.create_task(self.feed.record("create", "user-1", _repo_user(1)))
+            await asyncio.sleep(0)
+            await self.feed.record("create", "user-2", _repo_user(2))
+            pending, token = await self.feed.read(None, 10)
+            self.log.release.set()
+            await first
+            events, next_token = await self.feed.read(token, 10)
+            return pending, token, events, next_token
+        pending, token, events, next_token = asyncio.run(run())
+        self.assertEqual((pending, token), ([], None))
+        self.assertEqual([(event["token"], event["id"]) for event in events], [("1", "user-1"), ("2", "user-2")])
+        self.assertEqual(next_token, "2")
+    
+    def test_stale_gap_is_skipped(self):
+        # La escritura de la secuencia 2 falló hace más de gap_timeout
+        asyncio.run(self.feed.record("create", "user-1", _repo_user(1)))
+        self.log.seq += 1
+        asyncio.run(self.feed.record("update", "user-1", _repo_user(1)))
+        self.log.docs[3]["fecha"] -= timedelta(seconds=11)
+        events, token = asyncio.run(self.feed.read("1", 10))
+        self.assertEqual(([event["token"] for event in events], token), (["3"], "3"))
+    
+    def test_expired_and_invalid_tokens(self):
+        asyncio.run(self.feed.record("create", "user-1", _repo_user(1)))
+        asyncio.run(self.feed.record("create", "user-2", _repo_user(2)))
+        del self.log.docs[1]
+        with self.assertRaises(ChangeFeedExpired):
+            asyncio.run(self.feed.read("0", 10))
+        # Sin eventos conservados, un token anterior al contador también expiró
+        self.log.docs.clear()
+        with self.assertRaises(ChangeFeedExpired):
+            asyncio.run(self.feed.read("1", 10))
+        self.assertEqual(asyncio.run(self.feed.read("2", 10)), ([], "2"))
+        for token in ("basura", "-1"):
+            with self.assertRaises(ValueError):
+                asyncio.run(self.feed.validate(token))
+
+class TestBloomFilter(unittest.TestCase):
+    def test_no_false_negatives_and_error_rate_near_target(self):
+        bloom = BloomFilter(2000, 0.01)
+        emails = [f"user{number}@domain.cl" for number in range(2000)]
+        for email in emails:
+            bloom.add(email)
+        self.assertTrue(all(email in bloom for email in emails))
+        false_positives = sum(f"otro{number}@domain.cl" in bloom for number in range(10000))
+        self.assertLess(false_positives / 10000, 0.03)
+        self.assertAlmostEqual(bloom.false_positive_rate(), 0.01, delta=0.005)
+    
+    def test_email_filter_skips_only_after_build(self):
+        async def load_emails():
+            yield "user1@domain.cl"
+        email_filter = EmailFilter(load_emails, capacity=100)
+        # Sin construir no puede descartar nada
+        self.assertTrue(email_filter.might_contain("nuevo@domain.cl"))
+        asyncio.run(email_filter.rebuild())
+        self.assertTrue(email_filter.might_contain("user1@domain.cl"))
+        self.assertFalse(email_filter.might_contain("nuevo@domain.cl"))
+        email_filter.add("nuevo@domain.cl")
+        self.assertTrue(email_filter.might_contain("nuevo@domain.cl"))
+        stats = email_filter.stats()
+        self.assertEqual((stats["emails"], stats["skipped"], stats["rebuilds"]), (2, 1, 1))
+    
+    def test_one_worker_scans_and_the_others_load_the_snapshot(self):
+        scans = []
+        async def load_emails():
+            scans.append(1)
+            yield "user1@domain.cl"
+        snapshots, leases = FakeSnapshotCollection(), FakeLeaseCollection()
+        workers = [
+            EmailFilter(load_emails, capacity=100, lease=MongoLease(leases, "email_filter"),
+                        snapshot=MongoFilterSnapshot(snapshots))
+            for _ in range(3)
+        ]
+        async def scenario():
+            for email_filter in workers:
+                await email_filter.sync()
+        asyncio.run(scenario())
+        self.assertEqual(len(scans), 1)
+        self.assertEqual([email_filter.stats()["loads"] for email_filter in workers], [0, 1, 1])
+        self.assertTrue(all(email_filter.might_contain("user1@domain.cl") for email_filter in workers))
+        self.assertFalse(any(email_filter.might_contain("nuevo@domain.cl") for email_filter in workers))
+
+class FakeSnapshotCollection:
+    def __init__(self):
+        self.docs = {}
+    
+    async def find_one(self, query, projection=None):
+        doc = self.docs.get(query["_id"])
+        if doc is None or projection is None:
+            return doc
+        return {field: doc[field] for field in projection}
+    
+    async def replace_one(self, query, doc, upsert=False):
+        self.docs[query["_id"]] = doc
+
+class TestInMemoryUserRepository(unittest.TestCase):
+    def setUp(self):
+        self.repository = InMemoryUserRepository()
+        for number in range(5):
+            asyncio.run(self.repository.insert(_repo_user(number)))
+    
+    def test_get_returns_stored_document(self):
+        user_doc = asyncio.run(self.repository.get("user-1"))
+        self.assertEqual(user_doc["email"], "user1@domain.cl")
+        self.assertEqual(user_doc["phones"], EXPORT_DOC["phones"])
+        self.assertNotIn("password", user_doc)
+        self.assertIsNone(asyncio.run(self.repository.get("no-existe")))
+    
+    def test_get_and_list_page_with_fields(self):
+        self.assertEqual(asyncio.run(self.repository.get("user-1", fields=("id", "name"))), {"id": "user-1", "name": "Test User"})
+        page = asyncio.run(self.repository.list_page(None, 1, fields=("email",)))
+        self.assertEqual(set(page[0]), {"_id", "email"})
+        self.assertEqual(asyncio.run(self.repository.get_by_email("user1@domain.cl"))["password"], "hash")
+    
+    def test_insert_duplicate_email(self):
+        with self.assertRaises(DuplicateEmailError):
+            asyncio.run(self.repository.insert(dict(_repo_user(1), id="otro")))
+    
+    def test_list_page_after_cursor(self):
+        first = asyncio.run(self.repository.list_page(None, 2))
+        second = asyncio.run(self.repository.list_page(first[-1]["_id"], 10))
+        self.assertEqual([doc["id"] for doc in first], ["user-0", "user-1"])
+        self.assertEqual([doc["id"] for doc in second], ["user-2", "user-3", "user-4"])
+    
+    def test_filtered_page_and_count(self):
+        asyncio.run(self.repository.deactivate("user-1", datetime.now(timezone.utc)))
+        asyncio.run(self.repository.deactivate("user-3", datetime.now(timezone.utc)))
+        filters = UserFilters(isactive=False)
+        page = asyncio.run(self.repository.list_page(None, 10, filters))
+        self.assertEqual([doc["id"] for doc in page], ["user-1", "user-3"])
+        self.assertEqual(asyncio.run(self.repository.count(filters)), (2, False))
+        self.assertEqual(asyncio.run(self.repository.count(filters, limit=1)), (1, True))
+    
+    def test_conditional_update_and_deactivate(self):
+        # Sin el campo version (documento anterior) cuenta como versión 0
+        version = asyncio.run(self.repository.get_version("user-1"))
+        self.assertEqual(version, 0)
+        updated = asyncio.run(self.repository.update("user-1", {"name": "Otro"}, [version]))
+        self.assertEqual((updated["name"], updated["version"]), ("Otro", 1))
+        with self.assertRaises(VersionMismatchError):
+            asyncio.run(self.repository.update("user-1", {"name": "Perdido"}, [version]))
+        with self.assertRaises(VersionMismatchError):
+            asyncio.run(self.repository.deactivate("user-1", datetime.now(timezone.utc), [version]))
+        self.assertTrue(asyncio.run(self.repository.deactivate("user-1", datetime.now(timezone.utc), [1])))
+        self.assertEqual(asyncio.run(self.repository.get_version("user-1")), 2)
+        self.assertIsNone(asyncio.run(self.repository.update("no-existe", {"name": "x"}, [version])))
+    
+    def test_get_by_email(self):
+        self.assertEqual(asyncio.run(self.repository.get_by_email("user3@domain.cl"))["id"], "user-3")
+        self.assertIsNone(asyncio.run(self.repository.get_by_email("nadie@domain.cl")))
+    
+    def test_touch_many_only_moves_forward(self):
+        future = datetime(2099, 1, 1, tzinfo=timezone.utc)
+        past = datetime(2000, 1, 1, tzinfo=timezone.utc)
+        asyncio.run(self.repository.touch_many({"user-1": {"last_login": future}, "user-2": {"last_login": past}}))
+        self.assertEqual(asyncio.run(self.repository.get("user-1"))["last_login"], datetime(2099, 1, 1))
+        self.assertNotEqual(asyncio.run(self.repository.get("user-2"))["last_login"], datetime(2000, 1, 1))
+        self.assertEqual(asyncio.run(self.repository.get_version("user-1")), 1)
+    
+    def test_update_moves_email_index(self):
+        updated = asyncio.run(self.repository.update("user-1", {"email": "nuevo@domain.cl"}))
+        self.assertEqual(updated["email"], "nuevo@domain.cl")
+        self.assertEqual(asyncio.run(self.repository.existing_emails(["user1@domain.cl", "nuevo@domain.cl"])), {"nuevo@domain.cl"})
+        with self.assertRaises(DuplicateEmailError):
+            asyncio.run(self.repository.update("user-2", {"email": "nuevo@domain.cl"}))
+    
+    def test_insert_many_reports_duplicates_by_position(self):
+        errors = asyncio.run(self.repository.insert_many([_repo_user(10), _repo_user(2), _repo_user(11)]))
+        self.assertEqual(list(errors), [1])
+        self.assertIsInstance(errors[1], DuplicateEmailError)
+        self.assertEqual(len(self.repository), 7)
+    
+    def test_iterate_with_fields_and_deactivate(self):
+        self.assertTrue(asyncio.run(self.repository.deactivate("user-0", datetime.now(timezone.utc))))
+        self.assertFalse(asyncio.run(self.repository.deactivate("no-existe", datetime.now(timezone.utc))))
+        async def collect():
+            return [doc async for doc in self.repository.iterate(limit=2, fields=("id", "isactive"))]
+        self.assertEqual(asyncio.run(collect()), [
+            {"id": "user-0", "isactive": False},
+            {"id": "user-1", "isactive": True}
+        ])
+    
+    def test_archive_inactive_moves_old_deactivated_users(self):
+        asyncio.run(self.repository.deactivate("user-1", datetime(2024, 1, 1, tzinfo=timezone.utc)))
+        asyncio.run(self.repository.deactivate("user-2", datetime(2024, 6, 1, tzinfo=timezone.utc)))
+        cutoff = datetime(2024, 3, 1, tzinfo=timezone.utc)
+        self.assertEqual(asyncio.run(self.repository.archive_inactive(cutoff, 10)), ["user-1"])
+        self.assertIsNone(asyncio.run(self.repository.get("user-1")))
+        self.assertTrue(asyncio.run(self.repository.is_archived("user-1")))
+        self.assertFalse(asyncio.run(self.repository.is_archived("user-2")))
+        self.assertEqual(len(self.repository), 4)
+        # El correo queda libre y el orden de la paginación no cambia
+        self.assertEqual(asyncio.run(self.repository.existing_emails(["user1@domain.cl"])), set())
+        self.assertEqual([doc["id"] for doc in asyncio.run(self.repository.list_page(None, 10))],
+                         ["user-0", "user-2", "user-3", "user-4"])
+        self.assertEqual(asyncio.run(self.repository.archive_inactive(cutoff, 10)), [])
+
+class TestUserArchiver(unittest.TestCase):
+    def test_runs_batches_until_a_short_one_and_reports_each(self):
+        pending = [f"user-{number}" for number in range(5)]
+        reported = []
+        async def archive_batch(cutoff, limit):
+            batch = pending[:limit]
+            del pending[:limit]
+            return batch
+        async def on_archived(user_ids):
+            reported.append(user_ids)
+        archiver = UserArchiver(archive_batch, timedelta(days=30), batch_size=2, batch_pause=0,
+                                on_archived=on_archived)
+        self.assertEqual(asyncio.run(archiver.run_once()), 5)
+        self.assertEqual(reported, [["user-0", "user-1"], ["user-2", "user-3"], ["user-4"]])
+        self.assertEqual((archiver.stats()["batches"], archiver.stats()["runs"]), (3, 1))
+    
+    def test_cutoff_uses_archive_after(self):
+        cutoffs = []
+        async def archive_batch(cutoff, limit):
+            cutoffs.append(cutoff)
+            return []
+        now = datetime(2024, 2, 1, tzinfo=timezone.utc)
+        asyncio.run(UserArchiver(archive_batch, timedelta(days=31), clock=lambda: now).run_once())
+        self.assertEqual(cutoffs, [datetime(2024, 1, 1, tzinfo=timezone.utc)])
+    
+    def test_lease_held_by_other_worker_skips_batches(self):
+        batches = []
+        async def archive_batch(cutoff, limit):
+            batches.append(cutoff)
+            return []
+        lease = MongoLease(FakeLeaseCollection(), "archiver")
+        other = MongoLease(lease._collection, "archiver")
+        asyncio.run(other.acquire())
+        archiver = UserArchiver(archive_batch, timedelta(days=30), lease=lease)
+        self.assertEqual(asyncio.run(archiver.run_once()), 0)
+        self.assertEqual(batches, [])
+        # Cuando el otro worker lo libera, este lo toma
+        asyncio.run(other.release())
+        asyncio.run(archiver.run_once())
+        self.assertEqual(len(batches), 1)
+
+class FakeLeaseCollection:
+    """find_one_and_update con upsert sobre un _id único, como la colección leases"""
+    def __init__(self):
+        self.docs = {}
+    
+    @staticmethod
+    def _matches(doc, query):
+        return any(
+            doc["holder"] == clause["holder"] if "holder" in clause else doc["expires"] < clause["expires"]["$lt"]
+            for clause in query["$or"]
+        )
+    
+    async def find_one_and_update(self, query, update, upsert=False):
+        doc = self.docs.get(query["_id"])
+        if doc is not None and not self._matches(doc, query):
+            raise DuplicateKeyError("E11000")
+        self.docs[query["_id"]] = dict(update["$set"])
+    
+    async def delete_one(self, query):
+        doc = self.docs.get(query["_id"])
+        if doc is not None and doc["holder"] == query["holder"]:
+            del self.docs[query["_id"]]
+
+class TestIdempotencyManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = IdempotencyManager(InMemoryIdempotencyStore(LRUTTLCache(100, 60)))
+        self.calls = 0
+    
+    def _handler(self, status_code=201, delay=0):
+        async def handler():
+            self.calls += 1
+            await asyncio.sleep(delay)
+            return StoredResponse(status_code, b'{"id": "user-1"}', {"etag": '"v1"'})
+        return handler
+    
+    def test_replays_stored_response_and_rejects_other_fingerprint(self):
+        fingerprint = request_fingerprint({"email": "a@domain.cl"})
+        async def scenario():
+            first = await self.manager.run("POST k1", fingerprint, self._handler())
+            second = await self.manager.run("POST k1", fingerprint, self._handler())
+            with self.assertRaises(IdempotencyConflict):
+                await self.manager.run("POST k1", request_fingerprint({"email": "b@domain.cl"}), self._handler())
+            return first, second
+        first, second = asyncio.run(scenario())
+        self.assertEqual((first[1], second[1]), (False, True))
+        self.assertEqual(first[0], second[0])
+        self.assertEqual(self.calls, 1)
+    
+    def test_fingerprint_with_secret_is_keyed(self):
+        body = {"email": "a@domain.cl", "password": "TestPass123"}
+        keyed = request_fingerprint(body, secret="clave")
+        self.assertEqual(keyed, request_fingerprint(body, secret="clave"))
+        # Sin la clave no se puede recalcular la huella a partir de una contraseña candidata
+        self.assertNotEqual(keyed, request_fingerprint(body))
+        self.assertNotEqual(keyed, request_fingerprint(body, secret="otra"))
+    
+    def test_replay_never_executes(self):
+        async def scenario():
+            missing = await self.manager.replay("PUT k1", "huella")
+            await self.manager.run("PUT k1", "huella", self._handler())
+            return missing, await self.manager.replay("PUT k1", "huella"), await self.manager.replay("PUT k1", "otra")
+        missing, stored, other = asyncio.run(scenario())
+        self.assertIsNone(missing)
+        self.assertEqual(stored.body, b'{"id": "user-1"}')
+        self.assertIsNone(other)
+        self.assertEqual(self.calls, 1)
+    
+    def test_concurrent_duplicates_wait_for_in_flight_request(self):
+        async def scenario():
+            return await asyncio.gather(*[
+                self.manager.run("POST k1", "huella", self._handler(delay=0.01)) for _ in range(5)
+            ])
+        results = asyncio.run(scenario())
+        self.assertEqual(self.calls, 1)
+        self.assertEqual([replayed for _, replayed in results], [False, True, True, True, True])
+        self.assertEqual(self.manager.stats()["waited"], 4)
+    
+    def test_server_errors_are_not_stored(self):
+        async def scenario():
+            await self.manager.run("POST k1", "huella", self._handler(status_code=503))
+            return await self.manager.run("POST k1", "huella", self._handler())
+        response, replayed = asyncio.run(scenario())
+        self.assertEqual((response.status_code, replayed, self.calls), (201, False, 2))
+
+class TestMetrics(unittest.TestCase):
+    def test_command_listener_groups_by_command_and_collection(self):
+        labels = {"command": "find", "collection": "metrics_test", "outcome": "ok"}
+        before = REGISTRY.get_sample_value("users_mongo_command_duration_seconds_count", labels) or 0
+        listener = CommandMetricsListener()
+        listener.started(SimpleNamespace(command={"find": "metrics_test"}, command_name="find", connection_id=("h", 1), request_id=7))
+        listener.succeeded(SimpleNamespace(command_name="find", connection_id=("h", 1), request_id=7, duration_micros=2500))
+        after = REGISTRY.get_sample_value("users_mongo_command_duration_seconds_count", labels)
+        self.assertEqual(after, before + 1)
+    
+    def test_middleware_labels_route_template(self):
+        async def endpoint():
+            pass
+        fake_app = SimpleNamespace(routes=[SimpleNamespace(endpoint=endpoint, path="/metrics_test/{user_id}")])
+        async def inner(scope, receive, send):
+            scope["endpoint"] = endpoint
+            scope["app"] = fake_app
+            await send({"type": "http.response.start", "status": 404})
+        async def send(message):
+            pass
+        middleware = MetricsMiddleware(inner)
+        asyncio.run(middleware({"type": "http", "method": "GET"}, None, send))
+        labels = {"method": "GET", "route": "/metrics_test/{user_id}", "status": "404"}
+        self.assertEqual(REGISTRY.get_sample_value("users_http_request_duration_seconds_count", labels), 1)
+        self.assertEqual(REGISTRY.get_sample_value("users_http_requests_in_flight"), 0)
+
+def _log_record(func, level=logging.INFO, msg="Obteniendo usuario: %s", args=("user-1",), **extra):
+    record = logging.LogRecord("app.main", level, __file__, 1, msg, args, None, func=func)
+    record.__dict__.update(extra)
+    return record
+
+class TestLogging(unittest.TestCase):
+    def test_json_formatter_includes_message_and_extra(self):
+        entry = json.loads(JsonFormatter().format(_log_record("get_user", user_count=3)))
+        self.assertEqual(entry["msg"], "Obteniendo usuario: user-1")
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["func"], "get_user")
+        self.assertEqual(entry["user_count"], 3)
+    
+    def test_sampling_filter_per_route_keeps_warnings(self):
+        sampling = SamplingFilter({"get_user": 10})
+        kept = sum(sampling.filter(_log_record("get_user")) for _ in range(100))
+        self.assertEqual(kept, 10)
+        self.assertTrue(all(sampling.filter(_log_record("get_user", level=logging.WARNING)) for _ in range(5)))
+        self.assertTrue(all(sampling.filter(_log_record("create_user")) for _ in range(5)))
+    
+    def test_queue_handler_drops_when_full(self):
+        handler = NonBlockingQueueHandler(queue.Queue(maxsize=2))
+        for _ in range(5):
+            handler.handle(_log_record("get_user"))
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+        # El mensaje se formatea recién en el hilo del listener
+        self.assertEqual(handler.queue.get_nowait().args, ("user-1",))
+
+_api_client = None
+
+def _client():
+    """TestClient compartido: el lifespan (y el pool de bcrypt) se levanta una sola vez por proceso"""
+    global _api_client
+    if _api_client is None:
+        _api_client = TestClient(api.app)
+        _api_client.__enter__()
+    return _api_client
+
+def tearDownModule():
+    if _api_client is not None:
+        _api_client.__exit__(None, None, None)
+
+def _user_payload(**overrides):
+    payload = {
+        "name": "Test User",
+        "email": f"{uuid.uuid4().hex[:12]}@domain.cl",
+        "password": "TestPass123",
+        "phones": [{"number": "123456789", "citycode": "02", "contrycode": "+56"}]
+    }
+    payload.update(overrides)
+    return payload
+
+STALE_ETAG = user_etag(0)
+
+class ApiTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = _client()
+    
+    def create_user(self, **overrides):
+        response = self.client.post("/usuarios", json=_user_payload(**overrides))
+        self.assertEqual(response.status_code, 201, response.text)
+        return response.json()
+    
+    @staticmethod
+    def auth(user):
+        return {"Authorization": f"Bearer {user['token']}"}
+
+@contextmanager
+def _settings(**values):
+    previous = {name: getattr(api.settings, name) for name in values}
+    for name, value in values.items():
+        setattr(api.settings, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(api.settings, name, value)
+
+class TestStartupChecks(unittest.TestCase):
+    def test_per_worker_stores_rejected_with_several_workers(self):
+        repository = InMemoryUserRepository()
+        with _settings(web_concurrency=2, idempotency_store="memory"):
+            with self.assertRaises(RuntimeError):
+                api.create_idempotency_store(repository)
+        with _settings(web_concurrency=2, user_cache_invalidation="local"):
+            with self.assertRaises(RuntimeError):
+                api.create_cache_invalidation(repository, InMemoryChangeFeed(user_doc_to_wire))
+        with _settings(web_concurrency=1, idempotency_store="memory"):
+            self.assertIsInstance(api.create_idempotency_store(repository), InMemoryIdempotencyStore)
+
+class TestCreateUserEndpoint(ApiTestCase):
+    def test_returns_token_and_etag(self):
+        response = self.client.post("/usuarios", json=_user_payload(name="Nuevo"))
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual(body["name"], "Nuevo")
+        self.assertIn("token", body)
+        self.assertNotIn("password", body)
+        self.assertIn("etag", response.headers)
+    
+    def test_duplicate_email_is_400(self):
+        user = self.create_user()
+        response = self.client.post("/usuarios", json=_user_payload(email=user["email"]))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"mensaje": "El correo ya registrado"})
+    
+    def test_idempotency_key_replays_response(self):
+        payload = _user_payload()
+        headers = {"Idempotency-Key": uuid.uuid4().hex}
+        first = self.client.post("/usuarios", json=payload, headers=headers)
+        retry = self.client.post("/usuarios", json=payload, headers=headers)
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry.headers["idempotent-replayed"], "true")
+        # La misma clave con otro cuerpo es un error del cliente
+        other = self.client.post("/usuarios", json=_user_payload(), headers=headers)
+        self.assertEqual(other.status_code, 422)
+
+class TestLoginEndpoint(ApiTestCase):
+    def test_returns_current_token(self):
+        user = self.create_user()
+        response = self.client.post("/login", json={"email": user["email"], "password": "TestPass123"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["token"], user["token"])
+    
+    def test_wrong_password_is_401(self):
+        user = self.create_user()
+        response = self.client.post("/login", json={"email": user["email"], "password": "OtraPass123"})
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(response.json(), {"mensaje": "Credenciales inválidas"})
+    
+    def test_deleted_user_is_401(self):
+        user = self.create_user()
+        self.client.delete(f"/usuarios/{user['id']}", headers=self.auth(user))
+        response = self.client.post("/login", json={"email": user["email"], "password": "TestPass123"})
+        self.assertEqual(response.status_code, 401)
+
+    def test_unknown_email_is_401_and_outage_is_503(self):
+        self.assertFalse(verify_password("TestPass123", api.DUMMY_PASSWORD_HASH))
+        payload = {"email": f"{uuid.uuid4().hex}@example.com", "password": "TestPass123"}
+        self.assertEqual(self.client.post("/login", json=payload).status_code, 401)
+
+        async def unavailable(email):
+            raise ServerSelectionTimeoutError("sin servidores")
+
+        api.app.state.user_repository.get_by_email = unavailable
+        try:
+            self.assertEqual(self.client.post("/login", json=payload).status_code, 503)
+        finally:
+            del api.app.state.user_repository.get_by_email
+
+class TestGetUsersEndpoint(ApiTestCase):
+    def test_requires_token(self):
+        self.assertEqual(self.client.get("/usuarios").status_code, 401)
+    
+    def test_paginates_with_cursor_without_tokens(self):
+        created = [self.create_user() for _ in range(3)]
+        seen = []
+        params = {"limit": 2}
+        while True:
+            response = self.client.get("/usuarios", params=params, headers=self.auth(created[0]))
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page["usuarios"]), 2)
+            self.assertTrue(all("token" not in user for user in page["usuarios"]))
+            seen.extend(user["id"] for user in page["usuarios"])
+            if page["next_cursor"] is None:
+                break
+            params["cursor"] = page["next_cursor"]
+        self.assertEqual(len(seen), len(set(seen)))
+        self.assertTrue({user["id"] for user in created} <= set(seen))
+
+class TestGetUserEndpoint(ApiTestCase):
+    def test_etag_and_not_modified(self):
+        user = self.create_user()
+        response = self.client.get(f"/usuarios/{user['id']}", headers=self.auth(user))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("token", response.json())
+        etag = response.headers["etag"]
+        headers = dict(self.auth(user), **{"If-None-Match": etag})
+        not_modified = self.client.get(f"/usuarios/{user['id']}", headers=headers)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.headers["etag"], etag)
+    
+    def test_unknown_user_is_404(self):
+        user = self.create_user()
+        response = self.client.get("/usuarios/no-existe", headers=self.auth(user))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"mensaje": "Usuario no encontrado"})
+    
+    def test_archived_user_is_404_archivado(self):
+        reader, archived = self.create_user(), self.create_user()
+        self.client.delete(f"/usuarios/{archived['id']}", headers=self.auth(archived))
+        cutoff = datetime.now(timezone.utc) + timedelta(days=1)
+        self.client.portal.call(api.app.state.user_repository.archive_inactive, cutoff, 1000)
+        response = self.client.get(f"/usuarios/{archived['id']}", headers=self.auth(reader))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {"mensaje": "Usuario archivado"})
+
+class TestPatchUserEndpoint(ApiTestCase):
+    def test_updates_only_sent_fields(self):
+        user = self.create_user()
+        response = self.client.patch(f"/usuarios/{user['id']}", json={"name": "Otro"}, headers=self.auth(user))
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body["name"], "Otro")
+        self.assertEqual(body["email"], user["email"])
+        self.assertEqual(body["token"], user["token"])
+    
+    def test_password_change_rotates_token(self):
+        user = self.create_user()
+        response = self.client.patch(
+            f"/usuarios/{user['id']}", json={"password": "NuevaPass123"}, headers=self.auth(user)
+        )
+        self.assertEqual(response.status_code, 200)
+        token = response.json()["token"]
+        self.assertNotEqual(token, user["token"])
+        # El token nuevo lleva el correo guardado aunque no se haya enviado
+        self.assertEqual(decode_access_token(token)["email"], user["email"])
+        self.assertEqual(self.client.get(f"/usuarios/{user['id']}", headers=self.auth(user)).status_code, 401)
+    
+    def test_duplicate_email_is_400(self):
+        user, other = self.create_user(), self.create_user()
+        response = self.client.patch(
+            f"/usuarios/{user['id']}", json={"email": other["email"]}, headers=self.auth(user)
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"mensaje": "El correo ya registrado"})
+    
+    def test_stale_if_match_is_412(self):
+        user = self.create_user()
+        headers = dict(self.auth(user), **{"If-Match": STALE_ETAG})
+        response = self.client.patch(f"/usuarios/{user['id']}", json={"name": "Otro"}, headers=headers)
+        self.assertEqual(response.status_code, 412)
+    
+    def test_if_match_needs_the_current_strong_etag(self):
+        user = self.create_user()
+        etag = self.client.get(f"/usuarios/{user['id']}", headers=self.auth(user)).headers["etag"]
+        weak = dict(self.auth(user), **{"If-Match": f"W/{etag}"})
+        response = self.client.patch(f"/usuarios/{user['id']}", json={"name": "Otro"}, headers=weak)
+        self.assertEqual(response.status_code, 412)
+        strong = dict(self.auth(user), **{"If-Match": etag})
+        response = self.client.patch(f"/usuarios/{user['id']}", json={"name": "Otro"}, headers=strong)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers["etag"], etag)
+        response = self.client.patch(f"/usuarios/{user['id']}", json={"name": "Otro más"}, headers=strong)
+        self.assertEqual(response.status_code, 412)
+    
+    def test_other_user_is_403(self):
+        user, other = self.create_user(), self.create_user()
+        response = self.client.patch(f"/usuarios/{other['id']}", json={"name": "Otro"}, headers=self.auth(user))
+        self.assertEqual(response.status_code, 403)
+
+class TestPutUserEndpoint(ApiTestCase):
+    def test_replaces_user(self):
+        user = self.create_user()
+        payload = _user_payload(name="Reemplazado")
+        response = self.client.put(f"/usuarios/{user['id']}", json=payload, headers=self.auth(user))
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body["name"], body["email"]), ("Reemplazado", payload["email"]))
+        self.assertIn("etag", response.headers)
+        # La contraseña cambió: el token anterior deja de valer
+        self.assertNotEqual(body["token"], user["token"])
+        self.assertEqual(self.client.get(f"/usuarios/{user['id']}", headers=self.auth(user)).status_code, 401)
+        self.assertEqual(self.client.get(f"/usuarios/{user['id']}", headers=self.auth(body)).status_code, 200)
+    
+    def test_idempotent_retry_with_revoked_token_replays(self):
+        user = self.create_user()
+        payload = _user_payload(name="Reintento")
+        headers = dict(self.auth(user), **{"Idempotency-Key": uuid.uuid4().hex})
+        first = self.client.put(f"/usuarios/{user['id']}", json=payload, headers=headers)
+        retry = self.client.put(f"/usuarios/{user['id']}", json=payload, headers=headers)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(retry.status_code, 200)
+        self.assertEqual(retry.json(), first.json())
+        self.assertEqual(retry.headers["idempotent-replayed"], "true")
+        self.assertEqual(retry.headers["etag"], first.headers["etag"])
+        # Con otro cuerpo el token revocado no sirve
+        other = self.client.put(f"/usuarios/{user['id']}", json=_user_payload(), headers=headers)
+        self.assertEqual(other.status_code, 401)
+    
+    def test_retry_key_of_other_user_is_not_replayed(self):
+        user, other = self.create_user(), self.create_user()
+        payload = _user_payload()
+        key = {"Idempotency-Key": uuid.uuid4().hex}
+        self.client.put(f"/usuarios/{user['id']}", json=payload, headers=dict(self.auth(user), **key))
+        response = self.client.put(f"/usuarios/{user['id']}", json=payload, headers=dict(self.auth(other), **key))
+        self.assertEqual(response.status_code, 403)
+    
+    def test_stale_if_match_is_412(self):
+        user = self.create_user()
+        headers = dict(self.auth(user), **{"If-Match": STALE_ETAG})
+        response = self.client.put(f"/usuarios/{user['id']}", json=_user_payload(), headers=headers)
+        self.assertEqual(response.status_code, 412)
+    
+    def test_other_user_is_403(self):
+        user, other = self.create_user(), self.create_user()
+        response = self.client.put(f"/usuarios/{other['id']}", json=_user_payload(), headers=self.auth(user))
+        self.assertEqual(response.status_code, 403)
+
+class TestDeleteUserEndpoint(ApiTestCase):
+    def test_deactivates_and_revokes_token(self):
+        user = self.create_user()
+        response = self.client.delete(f"/usuarios/{user['id']}", headers=self.auth(user))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"mensaje": "Usuario eliminado correctamente"})
+        self.assertEqual(self.client.get(f"/usuarios/{user['id']}", headers=self.auth(user)).status_code, 401)
+    
+    def test_stale_if_match_is_412(self):
+        user = self.create_user()
+        headers = dict(self.auth(user), **{"If-Match": STALE_ETAG})
+        self.assertEqual(self.client.delete(f"/usuarios/{user['id']}", headers=headers).status_code, 412)
+    
+    def test_other_user_is_403(self):
+        user, other = self.create_user(), self.create_user()
+        self.assertEqual(self.client.delete(f"/usuarios/{other['id']}", headers=self.auth(user)).status_code, 403)
+
+class TestBulkEndpoint(ApiTestCase):
+    def test_partial_failure(self):
+        user = self.create_user()
+        new = _user_payload()
+        items = [new, _user_payload(email="invalido"), dict(new), _user_payload(email=user["email"])]
+        response = self.client.post("/usuarios/bulk", json=items, headers=self.auth(user))
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual((body["creados"], body["errores"]), (1, 3))
+        results = body["resultados"]
+        self.assertIsNotNone(results[0]["id"])
+        self.assertIsNotNone(results[0]["token"])
+        self.assertIn("email", results[1]["error"])
+        self.assertEqual(results[2]["error"], "El correo ya registrado")
+        self.assertEqual(results[3]["error"], "El correo ya registrado")
+    
+    def test_over_max_items_is_400(self):
+        user = self.create_user()
+        items = [{}] * (api.settings.bulk_max_items + 1)
+        response = self.client.post("/usuarios/bulk", json=items, headers=self.auth(user))
+        self.assertEqual(response.status_code, 400)
+
+class TestUserChangesEndpoint(ApiTestCase):
+    def test_events_in_order_without_tokens(self):
+        since = self.client.portal.call(api.app.state.change_feed.head)
+        user = self.create_user()
+        self.client.patch(f"/usuarios/{user['id']}", json={"name": "Otro"}, headers=self.auth(user))
+        reader = self.create_user()
+        self.client.delete(f"/usuarios/{user['id']}", headers=self.auth(user))
+        response = self.client.get("/usuarios/changes", params={"since": since}, headers=self.auth(reader))
+        self.assertEqual(response.status_code, 200)
+        events = [event for event in response.json()["cambios"] if event["id"] == user["id"]]
+        self.assertEqual([event["operacion"] for event in events], ["create", "update", "delete"])
+        self.assertTrue(all("token" not in (event["usuario"] or {}) for event in events))
+
+    def test_feed_outage_answers_503_and_closes_the_stream(self):
+        class DownFeed(InMemoryChangeFeed):
+            async def read(self, since, limit):
+                raise ServerSelectionTimeoutError("sin servidores")
+
+            async def follow(self, since, poll_interval):
+                raise ServerSelectionTimeoutError("sin servidores")
+                yield
+
+        reader = self.create_user()
+        feed = api.app.state.change_feed
+        api.app.state.change_feed = DownFeed(user_doc_to_wire)
+        try:
+            response = self.client.get("/usuarios/changes", headers=self.auth(reader))
+            self.assertEqual(response.status_code, 503)
+            response = self.client.get("/usuarios/changes/stream", headers=self.auth(reader))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.text.startswith("event: error\n"))
+        finally:
+            api.app.state.change_feed = feed
+
+class TestExportEndpoint(ApiTestCase):
+    def test_gzip_only_when_accepted(self):
+        user = self.create_user()
+        for accept_encoding, encoding in (("gzip", "gzip"), ("gzip;q=0, identity", None)):
+            headers = dict(self.auth(user), **{"Accept-Encoding": accept_encoding})
+            response = self.client.get("/usuarios/export", headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers.get("content-encoding"), encoding)
+            self.assertEqual(response.headers["vary"], "Accept-Encoding")
+            self.assertIn(user["id"], response.text)
+
+class TestStatsEndpoints(ApiTestCase):
+    def test_stats_name_the_worker(self):
+        for route in ("/cache/stats", "/write-behind/stats", "/email-filter/stats",
+                      "/idempotency/stats", "/circuit-breaker/stats", "/archive/stats"):
+            response = self.client.get(route)
+            self.assertEqual(response.status_code, 200, route)
+            self.assertEqual(response.json()["worker_pid"], os.getpid(), route)
+
 if __name__ == '__main__':
     unittest.main()